@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# A stand-in for aria2c's JSON-RPC interface that simulates any number of
+# downloads, so the polling and scheduling code can be measured at scale
+# without a network or a real daemon. Downloads progress in simulated time:
+# the first max-concurrent-downloads waiting ones are active and grow by
+# --speed bytes per second each until complete.
+#
+#   python3 benchmarks/fakearia2.py --downloads 1000 --port 0
+#
+# prints the port it listens on as its first line of output.
+
+import argparse
+import itertools
+import json
+import sys
+import threading
+import time
+
+import localserver
+
+class FakeAria2:
+    def __init__(self, downloads=0, total_length=64 * 1024 * 1024, speed=1024 * 1024, secret=""):
+        self.total_length = total_length
+        self.speed = speed
+        self.secret = secret
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.order = []
+        self.downloads = {}
+        self.options = {"max-concurrent-downloads": "5"}
+        self.rpc_calls = 0
+        self.last_update = time.monotonic()
+        for index in range(downloads):
+            self.add([f"http://localhost/file{index}"], {})
+
+    def add(self, uris, options):
+        gid = f"{next(self.counter):016x}"
+        self.downloads[gid] = {
+            "gid": gid,
+            "status": "waiting",
+            "totalLength": self.total_length,
+            "completedLength": 0,
+            "uris": list(uris),
+            "options": dict(options),
+        }
+        self.order.append(gid)
+        return gid
+
+    # Moves simulated time forward to now.
+    def advance(self):
+        now = time.monotonic()
+        elapsed, self.last_update = now - self.last_update, now
+        slots = int(self.options["max-concurrent-downloads"])
+        for gid in self.order:
+            download = self.downloads[gid]
+            if download["status"] == "active":
+                download["completedLength"] = min(download["totalLength"], download["completedLength"] + int(self.speed * elapsed))
+                if download["completedLength"] >= download["totalLength"]:
+                    download["status"] = "complete"
+                else:
+                    slots -= 1
+        for gid in self.order:
+            if slots <= 0:
+                break
+            if self.downloads[gid]["status"] == "waiting":
+                self.downloads[gid]["status"] = "active"
+                slots -= 1
+
+    def struct(self, download, keys=None):
+        speed = self.speed if download["status"] == "active" else 0
+        struct = {
+            "gid": download["gid"],
+            "status": download["status"],
+            "totalLength": str(download["totalLength"]),
+            "completedLength": str(download["completedLength"]),
+            "downloadSpeed": str(speed),
+            "uploadSpeed": "0",
+            "errorCode": "0",
+            "errorMessage": "",
+            "files": [{"index": "1", "path": "", "length": str(download["totalLength"]), "completedLength": str(download["completedLength"]),
+                "selected": "true", "uris": [{"uri": uri, "status": "used"} for uri in download["uris"]]}],
+        }
+        return {key: struct[key] for key in keys if key in struct} if keys else struct
+
+    def listed(self, statuses, offset, num, keys):
+        downloads = [self.downloads[gid] for gid in self.order if self.downloads[gid]["status"] in statuses]
+        return [self.struct(download, keys) for download in downloads[offset:offset + num]]
+
+    def call(self, method, params):
+        self.rpc_calls += 1
+        params = list(params)
+        if self.secret:
+            if not params or params.pop(0) != f"token:{self.secret}":
+                raise ValueError("Unauthorized")
+        name = method.split(".", 1)[-1]
+        if name == "addUri":
+            return self.add(params[0], params[1] if len(params) > 1 else {})
+        if name == "tellActive":
+            return self.listed(("active",), 0, len(self.order), params[0] if params else None)
+        if name == "tellWaiting":
+            return self.listed(("waiting", "paused"), params[0], params[1], params[2] if len(params) > 2 else None)
+        if name == "tellStopped":
+            return self.listed(("complete", "error", "removed"), params[0], params[1], params[2] if len(params) > 2 else None)
+        if name == "tellStatus":
+            return self.struct(self.downloads[params[0]], params[1] if len(params) > 1 else None)
+        if name == "getFiles":
+            return self.struct(self.downloads[params[0]])["files"]
+        if name == "getServers":
+            download = self.downloads[params[0]]
+            if download["status"] != "active":
+                raise ValueError(f"No active download for GID#{params[0]}")
+            return [{"index": "1", "servers": [{"uri": uri, "currentUri": uri, "downloadSpeed": str(self.speed // len(download["uris"]))} for uri in download["uris"]]}]
+        if name == "getGlobalStat":
+            counts = {"active": 0, "waiting": 0, "stopped": 0}
+            for download in self.downloads.values():
+                counts["active" if download["status"] == "active" else "waiting" if download["status"] in ("waiting", "paused") else "stopped"] += 1
+            return {"downloadSpeed": str(self.speed * counts["active"]), "uploadSpeed": "0", "numActive": str(counts["active"]),
+                "numWaiting": str(counts["waiting"]), "numStopped": str(counts["stopped"]), "numStoppedTotal": str(counts["stopped"])}
+        if name in ("pause", "forcePause"):
+            self.downloads[params[0]]["status"] = "paused"
+            return params[0]
+        if name == "unpause":
+            self.downloads[params[0]]["status"] = "waiting"
+            return params[0]
+        if name in ("pauseAll", "forcePauseAll", "unpauseAll"):
+            for download in self.downloads.values():
+                if (name == "unpauseAll") and (download["status"] == "paused"):
+                    download["status"] = "waiting"
+                elif (name != "unpauseAll") and (download["status"] in ("active", "waiting")):
+                    download["status"] = "paused"
+            return "OK"
+        if name in ("remove", "forceRemove"):
+            self.downloads[params[0]]["status"] = "removed"
+            return params[0]
+        if name == "removeDownloadResult":
+            self.order.remove(params[0])
+            del self.downloads[params[0]]
+            return "OK"
+        if name == "changePosition":
+            gid, position, how = params
+            self.order.remove(gid)
+            self.order.insert(position, gid)
+            return position
+        if name == "changeOption":
+            self.downloads[params[0]]["options"].update(params[1])
+            return "OK"
+        if name == "changeGlobalOption":
+            self.options.update(params[0])
+            return "OK"
+        if name == "changeUri":
+            download = self.downloads[params[0]]
+            download["uris"] = [uri for uri in download["uris"] if uri not in params[2]] + params[3]
+            return [len(params[2]), len(params[3])]
+        if name == "getVersion":
+            return {"version": "fake", "enabledFeatures": []}
+        if name in ("saveSession", "shutdown", "forceShutdown"):
+            return "OK"
+        raise ValueError(f"No such method: {method}")
+
+    def handle(self, request):
+        with self.lock:
+            self.advance()
+            if request["method"] == "system.multicall":
+                results = []
+                for call in request["params"][0]:
+                    try:
+                        results.append([self.call(call["methodName"], call.get("params", []))])
+                    except (ValueError, KeyError, IndexError) as error:
+                        results.append({"faultCode": 1, "faultString": str(error)})
+                return {"jsonrpc": "2.0", "id": request["id"], "result": results}
+            try:
+                return {"jsonrpc": "2.0", "id": request["id"], "result": self.call(request["method"], request.get("params", []))}
+            except (ValueError, KeyError, IndexError) as error:
+                return {"jsonrpc": "2.0", "id": request["id"], "error": {"code": 1, "message": str(error)}}
+
+def serve(fake, port=0):
+    class Handler(localserver.QuietHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            body = json.dumps(fake.handle(request)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return localserver.serve(Handler, port)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake aria2 JSON-RPC server.")
+    parser.add_argument("--downloads", type=int, default=0)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--total-length", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--speed", type=int, default=1024 * 1024)
+    parser.add_argument("--secret", default="")
+    arguments = parser.parse_args()
+    localserver.run(serve(FakeAria2(arguments.downloads, arguments.total_length, arguments.speed, arguments.secret), arguments.port))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+# What the benchmark servers have in common: a threaded HTTP/1.1 server on
+# localhost that keeps connections alive and doesn't log every request.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this every
+    # keep-alive response waits out the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+def serve(handler, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    return server
+
+# For running a server on its own: the port goes out as the first line, for
+# whoever started it to read.
+def run(server):
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
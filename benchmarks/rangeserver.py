@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# A local HTTP origin for end-to-end and mirror benchmarks. /<size>/<name>
+# serves <size> bytes of generated content with Range support, so aria2 can
+# split it into segments like it would a real file.
+#
+#   python3 benchmarks/rangeserver.py --port 8080
+#   curl -r 0-99 http://127.0.0.1:8080/1048576/test.bin
+
+import argparse
+import re
+import sys
+
+import localserver
+
+BLOCK = bytes(range(256)) * 256
+RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+def serve(port=0):
+    class Handler(localserver.QuietHandler):
+        def respond(self, body):
+            try:
+                size = int(self.path.strip("/").split("/")[0])
+            except ValueError:
+                self.send_error(404)
+                return
+            start, end = 0, size - 1
+            match = RANGE.fullmatch(self.headers.get("Range", ""))
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    start = max(size - int(match.group(2)), 0)
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("ETag", f'"{size}"')
+            self.end_headers()
+            if not body:
+                return
+            position = start
+            try:
+                while position <= end:
+                    offset = position % len(BLOCK)
+                    chunk = BLOCK[offset:offset + min(len(BLOCK) - offset, end - position + 1)]
+                    self.wfile.write(chunk)
+                    position += len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def do_GET(self):
+            self.respond(True)
+
+        def do_HEAD(self):
+            self.respond(False)
+
+    return localserver.serve(Handler, port)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP server with Range support.")
+    parser.add_argument("--port", type=int, default=0)
+    arguments = parser.parse_args()
+    localserver.run(serve(arguments.port))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# Benchmarks Varia's backend against benchmarks/fakearia2.py (a simulated
+# aria2 with N downloads, in its own process so its CPU time isn't counted)
+# and, where aria2c is installed, end to end against a real aria2c fetching
+# from benchmarks/rangeserver.py. Results are JSON, one entry per download
+# count, so runs from different versions can be compared:
+#
+#   python3 benchmarks/run.py --output before.json
+#   python3 benchmarks/run.py --output after.json --compare before.json
+#
+# --daemons N splits the downloads over N fakes behind Varia's daemon pool.
+# --gui adds main-loop frame latency and memory per row by running the real
+# window against a fake aria2 on port 6801; it needs GTK and a display.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+import gettext
+gettext.install("varia")
+
+from variaconfig import default_appconf, save_appconf
+from variaheadless import HeadlessDaemon
+from variametrics import Metrics
+from variapool import Aria2Pool
+from variarpc import Aria2RPC
+from variastate import StateStore
+
+import rangeserver
+
+DOWNLOAD_COUNTS = [10, 100, 1000, 10000]
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "p50": round(values[len(values) // 2], 3),
+        "p95": round(values[min(int(len(values) * 0.95), len(values) - 1)], 3),
+        "max": round(values[-1], 3),
+    }
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def start_fake(downloads, port=0):
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, "fakearia2.py"), "--downloads", str(downloads), "--port", str(port)],
+        stdout=subprocess.PIPE, text=True)
+    return process, int(process.stdout.readline())
+
+# Gids of the fakes' downloads as Varia sees them: each fake numbers its
+# own from 1, and the pool puts the fake's index in front from the second on.
+def fake_gids(downloads, daemons=1):
+    gids = []
+    for daemon in range(daemons):
+        for index in range(downloads // daemons + (1 if daemon < downloads % daemons else 0)):
+            gids.append(f"{index + 1:016x}" if (daemon == 0) else f"{daemon}:{index + 1:016x}")
+    return gids
+
+# A state store and varia.conf as Varia would have left them for the
+# fakes' downloads.
+def seed_appdir(appdir, downloads, daemons=1):
+    save_appconf(default_appconf(), appdir)
+    store = StateStore(os.path.join(appdir, "varia.db"))
+    for index, gid in enumerate(fake_gids(downloads, daemons)):
+        store.update(gid, url=f"http://localhost/file{index}", options={}, completed_length=0, total_length=0, status="waiting", priority=0, bypass=False)
+    store.close()
+
+# Startup restore, RPC rate, CPU per tick and client memory, through the
+# same code the window and the headless mode run.
+def backend_benchmark(downloads, duration, daemons=1):
+    fakes = [start_fake(downloads // daemons + (1 if daemon < downloads % daemons else 0)) for daemon in range(daemons)]
+    appdir = tempfile.mkdtemp(prefix="varia-benchmark-")
+    try:
+        seed_appdir(appdir, downloads, daemons)
+        # Counts every HTTP request and RPC call the backend really makes,
+        # the scheduler's included.
+        metrics = Metrics()
+        backends = [Aria2RPC(host="http://127.0.0.1", port=port, metrics=metrics) for process, port in fakes]
+        rpc = backends[0] if (daemons == 1) else Aria2Pool(backends, daemons)
+        rpc.wait_until_ready()
+
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        daemon = HeadlessDaemon(rpc, appdir)
+        daemon.restore()
+        restore_seconds = time.perf_counter() - started
+
+        # One tick is what the status poller's thread does every second: a
+        # poll, the status callback and the periodic tasks. Every fifth is a
+        # full poll, as after a notification reconnect.
+        tick_wall = []
+        tick_cpu = []
+        requests_before, calls_before = sum(metrics.requests.values()), sum(metrics.calls.values())
+        deadline = time.perf_counter() + duration
+        tick = 0
+        while (time.perf_counter() < deadline) or (tick < 5):
+            full = (tick % 5 == 0)
+            wall, cpu = time.perf_counter(), time.process_time()
+            statuses, global_stat = daemon.poller.poll(full)
+            daemon.on_status_update(statuses, global_stat)
+            for task in daemon.poller.tasks:
+                task()
+            tick_wall.append((time.perf_counter() - wall) * 1000)
+            tick_cpu.append((time.process_time() - cpu) * 1000)
+            tick += 1
+        elapsed = sum(tick_wall) / 1000
+        http_requests = sum(metrics.requests.values()) - requests_before
+        rpc_calls = sum(metrics.calls.values()) - calls_before
+        memory_after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # Bulk RPC rate on its own: status queries for every download in
+        # one multicall at a time.
+        calls = [("aria2.tellStatus", [gid, ["gid", "status", "completedLength"]]) for gid in fake_gids(downloads, daemons)[:500]]
+        multicall_started = time.perf_counter()
+        multicalls = 0
+        while (time.perf_counter() - multicall_started < duration / 2) or (multicalls < 3):
+            rpc.multicall(calls)
+            multicalls += 1
+        multicall_seconds = time.perf_counter() - multicall_started
+
+        daemon.store.close()
+        return {
+            "restore_seconds": round(restore_seconds, 4),
+            "ticks": tick,
+            "tick_wall_ms": percentiles(tick_wall),
+            "tick_cpu_ms": percentiles(tick_cpu),
+            "tick_http_requests_per_second": round(http_requests / elapsed, 2),
+            "tick_rpc_calls_per_second": round(rpc_calls / elapsed, 2),
+            "multicall_rpc_calls_per_second": round(len(calls) * multicalls / multicall_seconds, 2),
+            "client_memory_bytes_per_download": round((memory_after - memory_before) / downloads),
+        }
+    finally:
+        for process, port in fakes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(appdir, ignore_errors=True)
+
+# Real aria2c fetching from the local range server with Varia's default
+# download options: total_bytes spread over the downloads.
+def end_to_end_benchmark(downloads, total_bytes, timeout):
+    aria2c = shutil.which("aria2c")
+    if not aria2c:
+        return {"skipped": "aria2c not found"}
+    server = rangeserver.serve()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    directory = tempfile.mkdtemp(prefix="varia-benchmark-")
+    appconf = default_appconf()
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen([aria2c, "-d", directory, "--enable-rpc", f"--rpc-listen-port={port}", "--quiet",
+        f"--max-concurrent-downloads={appconf['max_active_downloads']}", "--allow-overwrite=true"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        rpc = Aria2RPC(host="http://127.0.0.1", port=port)
+        rpc.wait_until_ready()
+        size = max(total_bytes // downloads, 64 * 1024)
+        url = f"http://127.0.0.1:{server.server_address[1]}/{size}/file"
+        started = time.perf_counter()
+        rpc.multicall([("aria2.addUri", [[f"{url}{index}"], appconf['download_options']]) for index in range(downloads)])
+        while (time.perf_counter() - started < timeout):
+            global_stat = rpc.get_global_stat()
+            if int(global_stat["numActive"]) + int(global_stat["numWaiting"]) == 0:
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        completed = sum(int(struct["completedLength"]) for struct in rpc.call("aria2.tellStopped", [0, downloads, ["completedLength"]]))
+        return {
+            "seconds": round(elapsed, 3),
+            "bytes": completed,
+            "bytes_per_second": round(completed / elapsed),
+            "downloads_per_second": round(downloads / elapsed, 2),
+        }
+    finally:
+        process.terminate()
+        process.wait()
+        server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+# Runs the real window against a fake aria2 on the port Varia uses, with the
+# app data directory pointed at a seeded temporary one.
+def gui_benchmark(downloads, duration):
+    try:
+        import gi
+        gi.require_version('Gtk', '4.0')
+        gi.require_version('Adw', '1')
+        from gi.repository import Adw, GLib
+        import variamain
+    except (ImportError, ValueError) as error:
+        return {"skipped": str(error)}
+    from variadaemon import RPC_PORT, daemon_running
+    if daemon_running(RPC_PORT):
+        return {"skipped": f"port {RPC_PORT} is in use"}
+    process, port = start_fake(downloads, RPC_PORT)
+    appdir = tempfile.mkdtemp(prefix="varia-benchmark-")
+    seed_appdir(appdir, downloads)
+    variamain.APP_DIR = appdir
+    result = {}
+    frame_times = []
+    lags = []
+
+    def on_activate(app):
+        rss_before = rss_bytes()
+        started = time.perf_counter()
+        window = variamain.MainWindow(application=app)
+        window.present()
+
+        def on_frame(widget, frame_clock):
+            frame_times.append(frame_clock.get_frame_time() / 1000)
+            return True
+
+        def measure_lag(expected):
+            lags.append((time.perf_counter() - expected) * 1000)
+            if (time.perf_counter() - result["restored_at"] < duration):
+                GLib.timeout_add(10, measure_lag, time.perf_counter() + 0.01)
+            else:
+                window.exitProgram(app)
+                app.quit()
+            return False
+
+        def wait_for_restore():
+            if (len(window.downloads) < downloads):
+                return True
+            result["restored_at"] = time.perf_counter()
+            result["restore_seconds"] = round(result["restored_at"] - started, 4)
+            result["rss_bytes_per_download"] = round((rss_bytes() - rss_before) / downloads)
+            window.add_tick_callback(on_frame)
+            GLib.timeout_add(10, measure_lag, time.perf_counter() + 0.01)
+            return False
+
+        GLib.timeout_add(5, wait_for_restore)
+
+    app = Adw.Application(application_id="io.github.giantpinkrobots.varia.Benchmark")
+    app.connect("activate", on_activate)
+    try:
+        app.run([])
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(appdir, ignore_errors=True)
+    result.pop("restored_at", None)
+    result["frame_interval_ms"] = percentiles([b - a for a, b in zip(frame_times, frame_times[1:])])
+    result["main_loop_lag_ms"] = percentiles(lags)
+    return result
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BENCHMARKS_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def flatten(result, prefix=""):
+    values = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = value
+    return values
+
+def compare(results, previous):
+    previous = {entry["downloads"]: flatten(entry) for entry in previous["results"]}
+    for entry in results["results"]:
+        before = previous.get(entry["downloads"], {})
+        for key, value in flatten(entry).items():
+            if (key in before) and before[key] and (key != "downloads"):
+                print(f"{entry['downloads']:>6}  {key:<50} {before[key]:>14} -> {value:<14} {value / before[key]:6.2f}x", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Varia against a fake aria2 and a local HTTP server.")
+    parser.add_argument("--downloads", type=int, nargs="+", default=DOWNLOAD_COUNTS)
+    parser.add_argument("--duration", type=float, default=5, help="seconds to sample each measurement for")
+    parser.add_argument("--end-to-end-bytes", type=int, default=256 * 1024 * 1024)
+    parser.add_argument("--end-to-end-timeout", type=float, default=300)
+    parser.add_argument("--daemons", type=int, default=1, help="split the downloads over this many fake aria2 daemons")
+    parser.add_argument("--gui", action="store_true", help="also measure the window (needs GTK and a display)")
+    parser.add_argument("--output", help="write results here instead of standard output")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    arguments = parser.parse_args()
+
+    results = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.time(),
+        "results": [],
+    }
+    for downloads in arguments.downloads:
+        print(f"{downloads} downloads…", file=sys.stderr)
+        entry = {"downloads": downloads, "backend": backend_benchmark(downloads, arguments.duration, arguments.daemons)}
+        entry["end_to_end"] = end_to_end_benchmark(downloads, arguments.end_to_end_bytes, arguments.end_to_end_timeout)
+        if arguments.gui:
+            entry["gui"] = gui_benchmark(downloads, arguments.duration)
+        results["results"].append(entry)
+
+    output = json.dumps(results, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
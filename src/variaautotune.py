@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+import time
+
+AUDIT_LOG_MAX_SIZE = 1024 * 1024
+SETTING_BOUNDS = {
+    "max-concurrent-downloads": (1, 16),
+    "split": (1, 16),
+}
+# Samples thrown away after a change, while downloads restart with it.
+SETTLE_SAMPLES = 3
+# Share of the throughput found at the best settings that is left for
+# other traffic while the tuner holds there.
+HEADROOM = 0.1
+
+# Max-min fair per-download limits that keep the total within budget:
+# downloads slower than an equal share keep their speed, and what they
+# leave is split evenly between the faster ones, which get capped at it.
+# Returns {} when the downloads already fit.
+def fair_limits(speeds, budget):
+    remaining = budget
+    pending = sorted(speeds.items(), key=lambda item: item[1])
+    while pending:
+        share = remaining / len(pending)
+        if (pending[0][1] > share):
+            return {gid: max(1, int(share)) for gid, speed in pending}
+        remaining -= pending.pop(0)[1]
+    return {}
+
+# Hill climbing over aria2's concurrency settings. Throughput is averaged
+# over a window of poller samples; a step is kept while it buys at least 5%
+# more, undone when it costs 5%, and otherwise the tuner steps back down, so
+# it settles on the fewest connections that reach the link's throughput
+# instead of piling on connections that only crowd out other traffic. After
+# a revert it stays put for hold_windows windows before probing again.
+#
+# split is a per-download option, so besides the global value (which new
+# downloads follow while tuning) it is changed on every active download.
+# While holding at the best settings found, the fastest downloads are given
+# per-download limits that leave HEADROOM of that throughput for other
+# traffic; on_limits(limits) receives them, and {} once they are lifted
+# before the next probe.
+class AutoTuner:
+    def __init__(self, rpc, audit_log_path, settings, on_change=None, window=15, hold_windows=8, on_limits=None):
+        self.rpc = rpc
+        self.audit_log_path = audit_log_path
+        self.settings = dict(settings)
+        self.on_change = on_change
+        self.on_limits = on_limits
+        self.window = window
+        self.hold_windows = hold_windows
+        self.hold = 0
+        self.enabled = False
+        self.samples = []
+        # Per-download speeds summed over the window's samples.
+        self.speeds = {}
+        self.settle = 0
+        self.best = 0
+        self.limits = {}
+        self.previous = None
+        self.direction = 1
+        self.lock = threading.Lock()
+
+    def set_enabled(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+        self.reset(self.settings)
+
+    # Starts the search over from the given settings, e.g. after the user
+    # changed them by hand.
+    def reset(self, settings):
+        with self.lock:
+            self.settings = dict(settings)
+            self.samples = []
+            self.speeds = {}
+            self.previous = None
+            self.direction = 1
+            self.hold = 0
+        self.set_limits({}, "settings changed")
+
+    # statuses are the poller's, gid to status; only active downloads have
+    # a speed worth counting.
+    def sample(self, global_stat, statuses=None):
+        with self.lock:
+            if not (self.enabled and global_stat):
+                return
+            if self.settle:
+                self.settle -= 1
+                return
+            self.samples.append((int(global_stat.get("downloadSpeed", 0)), int(global_stat.get("numActive", 0)), int(global_stat.get("numWaiting", 0))))
+            for gid, status in (statuses or {}).items():
+                if (status.get("status", "active") == "active") and ("downloadSpeed" in status):
+                    self.speeds[gid] = self.speeds.get(gid, 0) + int(status["downloadSpeed"])
+
+    # Run from the status poller's thread after each tick. reset() changes
+    # the same state from the main thread, so the whole decision is made
+    # under the lock; the RPCs, callbacks and audit log it leads to come
+    # after, outside of it.
+    def tune(self):
+        with self.lock:
+            if not self.enabled or (len(self.samples) < self.window):
+                return
+            samples, self.samples = self.samples, []
+            speeds, self.speeds = self.speeds, {}
+            effects = self.step(samples, speeds)
+        for effect, arguments in effects:
+            effect(*arguments)
+
+    # Called with the lock held. Returns [(method, arguments)] to call once
+    # it is released.
+    def step(self, samples, speeds):
+        throughput = sum(sample[0] for sample in samples) / len(samples)
+        speeds = {gid: speed / len(samples) for gid, speed in speeds.items()}
+        active = max(sample[1] for sample in samples)
+        waiting = max(sample[2] for sample in samples)
+        if (active + waiting == 0):
+            self.previous = None
+            return []
+        if self.hold:
+            effects = []
+            # The first window back at the best settings shows how the
+            # downloads share it out.
+            if (self.hold == self.hold_windows):
+                effects.append((self.set_limits, (fair_limits(speeds, self.best * (1 - HEADROOM)), "holding at the best settings, leaving headroom")))
+            self.hold -= 1
+            if not self.hold:
+                effects.append((self.set_limits, ({}, "probing again")))
+            return effects
+        # With downloads queued, more of them at once is the lever; with
+        # everything already running, more segments per download is.
+        setting = "max-concurrent-downloads" if waiting else "split"
+        value = self.settings[setting]
+        reason = "initial step"
+        if self.previous and (self.previous[0] == setting) and self.previous[2]:
+            gain = throughput / self.previous[2]
+            if (gain >= 1.05):
+                reason = "throughput improved"
+            elif (gain <= 0.95):
+                reason = "throughput dropped, reverting"
+                self.direction = -self.direction
+                value = self.previous[1]
+                self.best = self.previous[2]
+                self.previous = None
+                self.hold = self.hold_windows
+                return [(self.apply, (setting, value, throughput, reason))]
+            else:
+                reason = "no measurable gain, backing off"
+                self.direction = -1
+        minimum, maximum = SETTING_BOUNDS[setting]
+        new_value = min(max(value + self.direction, minimum), maximum)
+        if (new_value == value):
+            self.direction = -self.direction
+            new_value = min(max(value + self.direction, minimum), maximum)
+        self.previous = (setting, value, throughput)
+        return [(self.apply, (setting, new_value, throughput, reason))]
+
+    def apply(self, setting, value, throughput, reason):
+        with self.lock:
+            previous_value = self.settings[setting]
+        if (value == previous_value):
+            return
+        self.rpc.change_global_option({setting: str(value)})
+        if (setting == "split"):
+            # aria2 restarts active downloads to apply it, keeping what
+            # they have downloaded.
+            active = self.rpc.call("aria2.tellActive", [["gid"]])
+            self.rpc.multicall([("aria2.changeOption", [struct["gid"], {"split": str(value)}]) for struct in active])
+        with self.lock:
+            self.settle = SETTLE_SAMPLES
+            self.settings[setting] = value
+        self.audit(setting, previous_value, value, throughput, reason)
+        if self.on_change:
+            self.on_change(setting, value)
+
+    def set_limits(self, limits, reason):
+        with self.lock:
+            if (limits == self.limits):
+                return
+            previous_limits, self.limits = self.limits, limits
+            best = self.best
+        self.audit("max-download-limit", previous_limits, limits, best, reason)
+        if self.on_limits:
+            self.on_limits(limits)
+
+    def audit(self, setting, previous_value, value, throughput, reason):
+        try:
+            if os.path.exists(self.audit_log_path) and (os.path.getsize(self.audit_log_path) > AUDIT_LOG_MAX_SIZE):
+                os.replace(self.audit_log_path, self.audit_log_path + ".1")
+            with open(self.audit_log_path, "a") as f:
+                f.write(json.dumps({
+                    "time": time.time(),
+                    "setting": setting,
+                    "from": previous_value,
+                    "to": value,
+                    "throughput": round(throughput),
+                    "reason": reason,
+                }) + "\n")
+        except OSError:
+            pass
@@ -0,0 +1,117 @@
+import json
+import os
+from datetime import datetime
+
+LIMIT_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# aria2 limits are either plain bytes per second or a number with a K/M/G
+# suffix, which is how Varia has always saved its global limit.
+def parse_limit(limit):
+    limit = str(limit or "0").strip().upper()
+    multiplier = LIMIT_UNITS.get(limit[-1:], 1)
+    try:
+        return int(float(limit.rstrip("KMG") or 0) * multiplier)
+    except ValueError:
+        return 0
+
+def minutes(time_text):
+    hour, minute = time_text.split(":")
+    return int(hour) * 60 + int(minute)
+
+# days are weekday numbers, Monday being 0. A window whose end is not after
+# its start runs past midnight into the next day. Limits are bytes per
+# second, 0 meaning unlimited.
+def window(days, start, end, download_limit=0, upload_limit=0):
+    return {"days": days, "start": start, "end": end, "download_limit": download_limit, "upload_limit": upload_limit}
+
+class BandwidthSchedule:
+    def __init__(self, path):
+        self.path = path
+        self.windows = []
+        # What was last sent to aria2, so each tick only sends changes.
+        self.applied_global = None
+        self.applied = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.windows = json.load(f).get("windows", [])
+            except (OSError, ValueError):
+                self.windows = []
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump({"windows": self.windows}, f)
+
+    def active_window(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        day = now.weekday()
+        for window in self.windows:
+            start, end = minutes(window["start"]), minutes(window["end"])
+            if (start < end):
+                if (day in window["days"]) and (start <= minute < end):
+                    return window
+            elif ((day in window["days"]) and (minute >= start)) or ((((day - 1) % 7) in window["days"]) and (minute < end)):
+                return window
+        return None
+
+    def invalidate(self, gid=None):
+        if gid:
+            self.applied.pop(gid, None)
+        else:
+            self.applied_global = None
+            self.applied = {}
+
+    # downloads are (gid, active, bypass, download_limit, upload_limit)
+    # tuples, the limits being the download's own. Returns the RPC calls
+    # that bring aria2 in line with the schedule.
+    #
+    # aria2's overall limit can't exempt anything, so while a download that
+    # bypasses the schedule is running the cap is instead split evenly
+    # between the other active downloads as per-download limits.
+    #
+    # tuned are per-download download limits from the auto-tuner, gid to
+    # bytes per second, applied on top of everything else.
+    def plan(self, default_download_limit, downloads, now=None, tuned=None):
+        window = self.active_window(now)
+        if window:
+            caps = [window["download_limit"], window["upload_limit"]]
+        else:
+            caps = [default_download_limit, 0]
+        bypassing = any(active and bypass for gid, active, bypass, download_limit, upload_limit in downloads)
+        throttled = {gid for gid, active, bypass, download_limit, upload_limit in downloads if active and not bypass}
+        shares = [0, 0]
+        if bypassing:
+            shares = [cap // len(throttled) if cap and throttled else 0 for cap in caps]
+            caps = [0, 0]
+
+        calls = []
+        global_options = {"max-overall-download-limit": str(caps[0]), "max-overall-upload-limit": str(caps[1])}
+        if (global_options != self.applied_global):
+            calls.append(("aria2.changeGlobalOption", [global_options]))
+            self.applied_global = global_options
+        applied = {}
+        for gid, active, bypass, download_limit, upload_limit in downloads:
+            own = [parse_limit(download_limit), parse_limit(upload_limit)]
+            limits = own
+            if gid in throttled:
+                limits = [min(limit, share) if limit and share else limit or share for limit, share in zip(own, shares)]
+            if tuned and (gid in tuned):
+                limits = [min(limits[0], tuned[gid]) if limits[0] else tuned[gid], limits[1]]
+            applied[gid] = limits
+            # Active downloads are always checked once, in case aria2 restored
+            # one from its session with a share from a previous run.
+            if (limits != self.applied.get(gid, None if active else own)):
+                calls.append(("aria2.changeOption", [gid, {"max-download-limit": str(limits[0]), "max-upload-limit": str(limits[1])}]))
+        self.applied = applied
+        return calls
+
+    # plan, sent in a single multicall. If that fails, everything is sent
+    # again next time.
+    def apply(self, rpc, default_download_limit, downloads, tuned=None):
+        calls = self.plan(default_download_limit, downloads, tuned=tuned)
+        if calls:
+            try:
+                rpc.multicall(calls)
+            except:
+                self.invalidate()
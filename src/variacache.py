@@ -0,0 +1,238 @@
+import fcntl
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+import requests
+
+from variaverify import HASH_TYPES, hash_file
+
+# Entries younger than this are trusted without asking the server again.
+FRESH_FOR = 60 * 60
+HEAD_TIMEOUT = 10
+# ioctl that makes dst share src's extents on btrfs, XFS and the like.
+FICLONE = 0x40049409
+
+# The name aria2 would give the file, which is where a cached copy goes.
+def file_name(url, options=None):
+    if options and options.get("out"):
+        return options["out"]
+    return unquote(os.path.basename(urlparse(url).path)) or "index.html"
+
+# Like aria2's auto-file-renaming: name.ext, then name.1.ext and so on.
+def free_path(directory, name):
+    path = os.path.join(directory, name)
+    stem, extension = os.path.splitext(name)
+    number = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{stem}.{number}{extension}")
+        number += 1
+    return path
+
+def reflink(source, destination):
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            os.remove(destination)
+            raise
+
+# Copies of cached files are made as cheaply as the filesystem allows. A
+# reflinked file shares blocks but not the inode, so changing one copy
+# never changes the other; hard links would, which is why there are none.
+def place(source, destination):
+    try:
+        reflink(source, destination)
+        return
+    except OSError:
+        pass
+    shutil.copyfile(source, destination)
+
+# Files that have been downloaded before, kept in <directory>/objects under
+# their SHA-256 and found by the URL they came from (with the ETag and
+# Last-Modified the server gave) or by a sha-256 checksum the download was
+# added with. A download with a checksum only ever gets a file that matches
+# it. The least recently used files go once max_size is exceeded;
+# a max_size of 0 turns the cache off.
+class DownloadCache:
+    def __init__(self, rpc, directory, max_size=0):
+        self.rpc = rpc
+        self.directory = directory
+        self.objects = os.path.join(directory, "objects")
+        self.max_size = max_size
+        self.path = os.path.join(directory, "cache.db")
+        self.connection = None
+        self.lock = threading.Lock()
+
+    # The directory and cache.db are only made once something is cached, so
+    # a cache that is never turned on leaves nothing behind. Returns None
+    # until then. Called with the lock held.
+    def database(self, create=False):
+        if (self.connection is None) and (create or os.path.exists(self.path)):
+            os.makedirs(self.objects, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.create_tables()
+        return self.connection
+
+    def create_tables(self):
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                digest TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                validated REAL
+            )""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS objects (
+                digest TEXT PRIMARY KEY,
+                size INTEGER,
+                used REAL
+            )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS objects_used ON objects (used)")
+
+    def enabled(self):
+        return self.max_size > 0
+
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+        self.evict()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    # A conditional HEAD; the entry is still good if the server says 304,
+    # or if it ignores the condition but sends back the same validators.
+    def revalidate(self, url, etag, last_modified):
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        if not headers:
+            return False
+        try:
+            response = requests.head(url, headers=headers, allow_redirects=True, timeout=HEAD_TIMEOUT)
+        except requests.RequestException:
+            return False
+        if (response.status_code == 304):
+            return True
+        return (response.status_code == 200) and ((response.headers.get("ETag") or None, response.headers.get("Last-Modified") or None) == (etag, last_modified))
+
+    def find(self, url, checksum=""):
+        kind, expected = checksum.split("=", 1) if checksum else (None, None)
+        with self.lock:
+            if not self.database():
+                return None
+            # The objects are named by their SHA-256, so whatever is found
+            # for a sha-256 checksum matches it and nothing else can.
+            if (kind == "sha-256"):
+                row = self.connection.execute("SELECT digest FROM objects WHERE digest = ?", (expected,)).fetchone()
+                return row[0] if row else None
+            entry = self.connection.execute("SELECT digest, etag, last_modified, validated FROM entries WHERE url = ?", (url,)).fetchone()
+        if not entry:
+            return None
+        digest, etag, last_modified, validated = entry
+        if (time.time() - validated > FRESH_FOR):
+            if not self.revalidate(url, etag, last_modified):
+                with self.lock, self.connection:
+                    self.connection.execute("DELETE FROM entries WHERE url = ?", (url,))
+                return None
+            with self.lock, self.connection:
+                self.connection.execute("UPDATE entries SET validated = ? WHERE url = ?", (time.time(), url))
+        # Other checksums can only be checked by hashing the file.
+        if kind:
+            try:
+                if (hash_file(self.object_path(digest), HASH_TYPES[kind]) != expected):
+                    return None
+            except (OSError, KeyError):
+                return None
+        return digest
+
+    # Called before a download is handed to aria2, off the main loop since
+    # it may ask the server. Returns the path of the copy, or None on a miss.
+    def fetch(self, url, checksum, directory, name):
+        if not self.enabled():
+            return None
+        digest = self.find(url, checksum)
+        if not digest or not os.path.exists(self.object_path(digest)):
+            return None
+        destination = free_path(directory, name)
+        try:
+            place(self.object_path(digest), destination)
+        except OSError:
+            return None
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE objects SET used = ? WHERE digest = ?", (time.time(), digest))
+        return destination
+
+    def insert(self, url, path):
+        try:
+            response = requests.head(url, allow_redirects=True, timeout=HEAD_TIMEOUT)
+            etag, last_modified = response.headers.get("ETag") or None, response.headers.get("Last-Modified") or None
+        except requests.RequestException:
+            etag, last_modified = None, None
+        digest = hash_file(path, "sha256")
+        size = os.path.getsize(path)
+        if (size > self.max_size):
+            return
+        with self.lock:
+            self.database(create=True)
+        if not os.path.exists(self.object_path(digest)):
+            partial = self.object_path(digest) + ".part"
+            place(path, partial)
+            os.chmod(partial, 0o444)
+            os.replace(partial, self.object_path(digest))
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("""INSERT INTO objects (digest, size, used) VALUES (?, ?, ?)
+                ON CONFLICT (digest) DO UPDATE SET used = excluded.used""", (digest, size, now))
+            # Without validators a URL can't be checked later, so only the
+            # content hash can find it again.
+            if etag or last_modified:
+                self.connection.execute("""INSERT OR REPLACE INTO entries (url, digest, etag, last_modified, validated)
+                    VALUES (?, ?, ?, ?, ?)""", (url, digest, etag, last_modified, now))
+        self.evict()
+
+    # Takes a finished download in, on a thread of its own: it is hashed
+    # and copied, and the server is asked for its validators.
+    def populate(self, gid, url):
+        if self.enabled() and self.rpc.is_local(gid):
+            threading.Thread(target=self.run, args=(gid, url), daemon=True).start()
+
+    def run(self, gid, url):
+        try:
+            path = [file["path"] for file in self.rpc.get_files(gid) if file["path"]][0]
+            self.insert(url, path)
+        except:
+            pass
+
+    def evict(self):
+        with self.lock:
+            if not self.database():
+                return
+            with self.connection:
+                total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+                if (total <= self.max_size):
+                    return
+                evicted = []
+                for digest, size in self.connection.execute("SELECT digest, size FROM objects ORDER BY used").fetchall():
+                    if (total <= self.max_size):
+                        break
+                    evicted.append(digest)
+                    total -= size
+                self.connection.executemany("DELETE FROM objects WHERE digest = ?", [(digest,) for digest in evicted])
+                self.connection.executemany("DELETE FROM entries WHERE digest = ?", [(digest,) for digest in evicted])
+        for digest in evicted:
+            try:
+                os.remove(self.object_path(digest))
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            if self.connection:
+                self.connection.close()
@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import sys
+import time
+from gettext import gettext as _
+
+from variaconfig import APP_DIR, load_appconf
+from variadaemon import daemon_running, start_daemons
+from variaformat import format_size, format_speed
+from variahistory import HistoryStore, PAGE_SIZE
+from variapoller import MAX_LISTED
+from variapool import connect
+from variastate import StateStore
+
+# Everything here runs without GTK, against the same aria2 daemon and state
+# store as the window, so downloads can be scripted or run on a server.
+LIST_KEYS = ["gid", "status", "totalLength", "completedLength", "downloadSpeed", "files"]
+
+def parser():
+    parser = argparse.ArgumentParser(prog="varia", description=_("aria2 based download manager."))
+    parser.add_argument("--headless", action="store_true", help=_("run downloads in the background without a window"))
+    parser.add_argument("--startup-time", action="store_true", help=_("print how long Varia took to start"))
+    commands = parser.add_subparsers(dest="command")
+
+    add = commands.add_parser("add", help=_("add downloads"))
+    add.add_argument("urls", nargs="+", metavar="URL")
+    add.add_argument("--mirrors", action="store_true", help=_("the URLs are mirrors of one file"))
+    add.add_argument("--checksum", help=_("expected hash of the file, like sha-256=<hex>; checked by --headless once it has downloaded"))
+
+    list_parser = commands.add_parser("list", help=_("list downloads"))
+    list_parser.add_argument("--json", action="store_true", help=_("print JSON instead of a table"))
+
+    for command, help_text in (("pause", _("pause downloads")), ("resume", _("resume downloads"))):
+        command_parser = commands.add_parser(command, help=help_text)
+        command_parser.add_argument("gids", nargs="*", metavar="GID")
+        command_parser.add_argument("--all", action="store_true", help=_("all downloads"))
+
+    status = commands.add_parser("status", help=_("show overall download status"))
+    status.add_argument("--json", action="store_true", help=_("print JSON instead of text"))
+
+    history = commands.add_parser("history", help=_("search finished and failed downloads"))
+    history.add_argument("query", nargs="*", metavar="WORD", help=_("words in the file name, URL or server name"))
+    history.add_argument("--host", help=_("only downloads from this server"))
+    history.add_argument("--limit", type=int, default=PAGE_SIZE, help=_("newest this many downloads"))
+    history.add_argument("--json", action="store_true", help=_("print JSON instead of a table"))
+    return parser
+
+def download_name(struct):
+    files = struct.get("files") or []
+    if files and files[0]["path"]:
+        return os.path.basename(files[0]["path"])
+    if files and files[0]["uris"]:
+        return files[0]["uris"][0]["uri"].split("/")[-1].split("?")[0]
+    return struct["gid"]
+
+def add(rpc, store, appconf, arguments):
+    from variaimport import is_valid_url
+    from variamirrors import rank_mirrors, MAX_ACTIVE_MIRRORS
+    from variaverify import parse_checksum
+    checksum = ""
+    if arguments.checksum:
+        checksum = parse_checksum(arguments.checksum)
+        if not checksum:
+            print(_("This is not a valid checksum.") + f" {arguments.checksum}", file=sys.stderr)
+            return 1
+        if (len(arguments.urls) > 1) and not arguments.mirrors:
+            print(_("A checksum can only be given for one file."), file=sys.stderr)
+            return 1
+    urls = [url for url in arguments.urls if is_valid_url(url)]
+    for url in arguments.urls:
+        if url not in urls:
+            print(_("This is not a valid URL.") + f" {url}", file=sys.stderr)
+    if not urls:
+        return 1
+    failed = len(arguments.urls) - len(urls)
+    options = dict(appconf['download_options'])
+    # Auto-tuning sets split globally for downloads that don't have their own.
+    if appconf['autotune']:
+        options.pop('split', None)
+    if arguments.mirrors and (len(urls) > 1):
+        options["uri-selector"] = "adaptive"
+        entries = [rank_mirrors(urls)]
+    else:
+        entries = [[url] for url in urls]
+    if appconf['cache_size']:
+        from variacache import DownloadCache, file_name
+        from variadaemon import download_dir
+        cache = DownloadCache(rpc, os.path.join(arguments.appdir, 'cache'), appconf['cache_size'] * 1024 * 1024)
+        try:
+            missed = []
+            for entry in entries:
+                # Files in the cache are copied into place and never reach aria2.
+                path = cache.fetch(entry[0], checksum, download_dir(), file_name(entry[0], options))
+                if path:
+                    print(path)
+                else:
+                    missed.append(entry)
+            entries = missed
+        finally:
+            cache.close()
+        if not entries:
+            return 1 if failed else 0
+    results = rpc.multicall([("aria2.addUri", [entry[:MAX_ACTIVE_MIRRORS], options]) for entry in entries])
+    for entry, gid in zip(entries, results):
+        if isinstance(gid, Exception):
+            print(f"{entry[0]}: {gid.message}", file=sys.stderr)
+            failed += 1
+            continue
+        store.update(gid, url=entry[0], options=options, completed_length=0, total_length=0, status="waiting", priority=0, bypass=False, checksum=checksum, mirrors=entry)
+        print(gid)
+    return 1 if failed else 0
+
+def list_downloads(rpc, store, appconf, arguments):
+    results = rpc.multicall([
+        ("aria2.tellActive", [LIST_KEYS]),
+        ("aria2.tellWaiting", [0, MAX_LISTED, LIST_KEYS]),
+        ("aria2.tellStopped", [0, MAX_LISTED, LIST_KEYS]),
+    ])
+    downloads = [struct for result in results if not isinstance(result, Exception) for struct in result]
+    if arguments.json:
+        print(json.dumps([{
+            "gid": struct["gid"],
+            "name": download_name(struct),
+            "status": struct["status"],
+            "total_length": int(struct["totalLength"]),
+            "completed_length": int(struct["completedLength"]),
+            "download_speed": int(struct["downloadSpeed"]),
+        } for struct in downloads]))
+        return 0
+    for struct in downloads:
+        total_length = int(struct["totalLength"])
+        progress = int(struct["completedLength"]) / total_length * 100 if total_length else 0
+        print(f"{struct['gid']}  {struct['status']:<8}  {round(progress):>3}%  {format_size(total_length):>10}  {format_speed(int(struct['downloadSpeed'])):>12}  {download_name(struct)}")
+    return 0
+
+def set_paused(rpc, store, appconf, arguments):
+    paused = (arguments.command == "pause")
+    if arguments.all:
+        if paused:
+            rpc.pause_all()
+        else:
+            rpc.unpause_all()
+        gids = [state['gid'] for state in store.load() if state['status'] in (("active", "waiting") if paused else ("paused",))]
+    else:
+        results = rpc.multicall([("aria2.pause" if paused else "aria2.unpause", [gid]) for gid in arguments.gids])
+        gids = []
+        for gid, result in zip(arguments.gids, results):
+            if isinstance(result, Exception):
+                print(f"{gid}: {result.message}", file=sys.stderr)
+            else:
+                gids.append(gid)
+    for gid in gids:
+        store.update(gid, status="paused" if paused else "waiting")
+    return 0 if arguments.all or (len(gids) == len(arguments.gids)) else 1
+
+def status(rpc, store, appconf, arguments):
+    global_stat, version = rpc.multicall([("aria2.getGlobalStat", []), ("aria2.getVersion", [])])
+    if arguments.json:
+        print(json.dumps({key: int(value) for key, value in global_stat.items()}))
+        return 0
+    backends = getattr(rpc, "backends", [rpc])
+    if (len(backends) > 1):
+        print(_("aria2 {version} on {count} daemons").format(version=version["version"], count=len(backends)))
+    else:
+        print(_("aria2 {version} on port {port}").format(version=version["version"], port=rpc.port))
+    print(_("{active} active, {waiting} waiting, {stopped} stopped").format(
+        active=global_stat["numActive"], waiting=global_stat["numWaiting"], stopped=global_stat["numStopped"]))
+    print(_("Download: {download}, Upload: {upload}").format(
+        download=format_speed(int(global_stat["downloadSpeed"])), upload=format_speed(int(global_stat["uploadSpeed"]))))
+    return 0
+
+def show_history(history, arguments):
+    keys = {"host": arguments.host} if arguments.host else {}
+    entries = history.page(" ".join(arguments.query), limit=arguments.limit, **keys)
+    if arguments.json:
+        print(json.dumps(entries))
+        return 0
+    for entry in entries:
+        completed = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["completed"]))
+        print(f"{completed}  {entry['status']:<8}  {format_size(entry['total_length']):>10}  {entry['filename']}")
+    return 0
+
+COMMANDS = {"add": add, "list": list_downloads, "pause": set_paused, "resume": set_paused, "status": status}
+# Arguments the launcher hands to main() instead of opening the window;
+# history is answered from its database without aria2.
+ARGUMENTS = ("--headless", "--help", "-h", "history") + tuple(COMMANDS)
+
+# started is time.perf_counter() from the very start of the launcher.
+def main(argv, aria2c, started, appdir=APP_DIR):
+    # Accepted anywhere on the command line, like the window accepts it.
+    startup_time = "--startup-time" in argv
+    arguments = parser().parse_args([argument for argument in argv if argument != "--startup-time"])
+    arguments.appdir = appdir
+    elapsed = lambda: round((time.perf_counter() - started) * 1000)
+    appconf = load_appconf(appdir)
+
+    if arguments.headless:
+        from variaheadless import HeadlessDaemon
+        from variametrics import Metrics
+        daemons = start_daemons(aria2c, appdir=appdir)
+        on_ready = lambda: print(_("Started in {milliseconds} ms").format(milliseconds=elapsed()), file=sys.stderr)
+        metrics = Metrics()
+        HeadlessDaemon(connect(appconf, metrics), appdir, metrics=metrics, daemons=daemons).run(on_ready if startup_time else None)
+        return 0
+
+    if not arguments.command:
+        parser().print_help()
+        return 1
+    # The history is only a database, so aria2 needn't be running for it.
+    if (arguments.command == "history"):
+        history = HistoryStore(os.path.join(appdir, 'history.db'))
+        try:
+            return show_history(history, arguments)
+        finally:
+            history.close()
+            if startup_time:
+                print(_("Done in {milliseconds} ms").format(milliseconds=elapsed()), file=sys.stderr)
+    # Only adding a download is worth starting aria2 for.
+    rpc = connect(appconf)
+    if (arguments.command == "add"):
+        start_daemons(aria2c, appdir=appdir)
+        rpc.wait_until_ready()
+    elif not daemon_running():
+        print(_("aria2 is not running. Start Varia, or run it with --headless."), file=sys.stderr)
+        return 1
+
+    store = StateStore(os.path.join(appdir, 'varia.db'))
+    try:
+        return COMMANDS[arguments.command](rpc, store, appconf, arguments)
+    finally:
+        store.close()
+        if startup_time:
+            print(_("Done in {milliseconds} ms").format(milliseconds=elapsed()), file=sys.stderr)
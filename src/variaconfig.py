@@ -0,0 +1,44 @@
+import json
+import os
+
+# Shared by the window and the command line, so neither needs the other's
+# imports to read the user's settings.
+APP_DIR = os.path.join('/var', 'data')
+
+def default_appconf():
+    return {'download_speed_limit': "0", 'max_active_downloads': 3, 'max_downloads_per_host': 0, 'autotune': False,
+        # Port for the Prometheus metrics endpoint on localhost, 0 for off.
+        'metrics_port': 0,
+        # Megabytes kept in the download cache, 0 for off.
+        'cache_size': 0,
+        # Disk settings changed from the ones detected for the download
+        # folder's filesystem; see variadaemon.storage_options.
+        'storage_options': {},
+        # aria2 daemons to share downloads between: this many local ones on
+        # ports from 6801 up, and remote ones as {"host", "port", "secret"}.
+        'local_daemons': 1,
+        'remote_daemons': [],
+        # Passed to aria2 as they are, for every new download.
+        'download_options': {
+            'split': "8",
+            'max-connection-per-server': "8",
+            'min-split-size': "10M",
+            'stream-piece-selector': "default",
+            'lowest-speed-limit': "0",
+        }}
+
+def load_appconf(appdir=APP_DIR):
+    appconf = default_appconf()
+    path = os.path.join(appdir, 'varia.conf')
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        appconf['download_options'].update(saved.pop('download_options', {}))
+        appconf.update(saved)
+    else:
+        save_appconf(appconf, appdir)
+    return appconf
+
+def save_appconf(appconf, appdir=APP_DIR):
+    with open(os.path.join(appdir, 'varia.conf'), 'w') as f:
+        json.dump(appconf, f)
@@ -0,0 +1,129 @@
+import os
+import socket
+import subprocess
+
+from variaconfig import APP_DIR, load_appconf
+
+RPC_PORT = 6801
+# Filesystems where fallocate() reserves space without writing it, and
+# ones (in memory or over the network) where preallocating only costs time.
+FALLOCATE_FILESYSTEMS = ("ext4", "xfs", "btrfs", "f2fs", "bcachefs", "ocfs2")
+NO_ALLOCATION_FILESYSTEMS = ("tmpfs", "ramfs", "nfs", "nfs4", "cifs", "smb3", "9p", "fuse.sshfs", "fuse.rclone", "zfs")
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "9p", "fuse.sshfs", "fuse.rclone")
+STORAGE_KEYS = ("file-allocation", "disk-cache", "enable-mmap", "async-dns")
+# aria2 only takes these two through changeGlobalOption, for downloads added
+# afterwards; the others apply the next time the daemon starts.
+RUNTIME_STORAGE_KEYS = ("file-allocation", "enable-mmap")
+
+def download_dir():
+    try:
+        path = subprocess.run(["xdg-user-dir", "DOWNLOAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        path = ""
+    return path or os.path.join(os.path.expanduser("~"), "Downloads")
+
+# The type of the filesystem path is on, from the longest mount point in
+# /proc/mounts that contains it.
+def filesystem_type(path):
+    path = os.path.realpath(path)
+    found, found_type = "", ""
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if (len(fields) < 3):
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if ((path == mount_point) or path.startswith(mount_point.rstrip("/") + "/")) and (len(mount_point) >= len(found)):
+                    found, found_type = mount_point, fields[2]
+    except OSError:
+        pass
+    return found_type
+
+# Whether the block device path is on reports itself as a spinning disk.
+def is_rotational(path):
+    try:
+        device = os.stat(path).st_dev
+        block = os.path.realpath(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}")
+    except OSError:
+        return False
+    # Partitions keep their queue settings in the parent disk's directory.
+    for directory in (block, os.path.dirname(block)):
+        try:
+            with open(os.path.join(directory, "queue", "rotational"), "r") as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+def storage_defaults(downloaddir):
+    filesystem = filesystem_type(downloaddir)
+    rotational = is_rotational(downloaddir)
+    if filesystem in FALLOCATE_FILESYSTEMS:
+        file_allocation = "falloc"
+    elif filesystem in NO_ALLOCATION_FILESYSTEMS:
+        file_allocation = "none"
+    else:
+        file_allocation = "prealloc"
+    # A bigger write cache turns many small segment writes into fewer long
+    # ones, which is what spinning disks and network mounts need; files in
+    # memory gain nothing from it.
+    if filesystem in ("tmpfs", "ramfs"):
+        disk_cache = "0"
+    elif rotational or (filesystem in NETWORK_FILESYSTEMS):
+        disk_cache = "64M"
+    else:
+        disk_cache = "32M"
+    return {
+        "file-allocation": file_allocation,
+        "disk-cache": disk_cache,
+        # aria2 can only map files it has allocated.
+        "enable-mmap": "true" if (file_allocation in ("falloc", "prealloc")) and (filesystem not in NETWORK_FILESYSTEMS) else "false",
+        "async-dns": "true",
+    }
+
+# Detected defaults, with whatever the user changed in varia.conf on top.
+def storage_options(appconf, downloaddir):
+    options = storage_defaults(downloaddir)
+    options.update({key: value for key, value in appconf['storage_options'].items() if key in STORAGE_KEYS})
+    return options
+
+def local_ports(appconf):
+    return range(RPC_PORT, RPC_PORT + max(1, appconf['local_daemons']))
+
+def aria2c_command(aria2c, downloaddir, session_file, options=None, port=RPC_PORT):
+    # aria2c restores the session file on start and keeps it up to date,
+    # which is what resuming across restarts relies on.
+    return [aria2c, "-d", downloaddir, "--enable-rpc", f"--rpc-listen-port={port}",
+        f"--input-file={session_file}", f"--save-session={session_file}", "--save-session-interval=30"] + \
+        [f"--{key}={value}" for key, value in (options or {}).items()]
+
+# A plain socket check, so finding an already running daemon costs neither
+# an HTTP client import nor a request.
+def daemon_running(port=RPC_PORT):
+    try:
+        with socket.create_connection(("localhost", port), timeout=0.2):
+            return True
+    except OSError:
+        return False
+
+# The window, the headless mode and the command line all share one daemon;
+# whichever runs first starts it. Returns the new process, or None if one was
+# already listening. Callers wait for it with Aria2RPC.wait_until_ready.
+def start_daemon(aria2c, downloaddir=None, appdir=APP_DIR, port=RPC_PORT, appconf=None):
+    if daemon_running(port):
+        return None
+    # Each daemon keeps its own session; the first one's keeps its old name.
+    session_file = os.path.join(appdir, "aria2.session" if (port == RPC_PORT) else f"aria2-{port}.session")
+    open(session_file, "a").close()
+    downloaddir = downloaddir or download_dir()
+    options = storage_options(appconf or load_appconf(appdir), downloaddir)
+    return subprocess.Popen(aria2c_command(aria2c, downloaddir, session_file, options, port),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+# Every local daemon varia.conf asks for, one aria2c (and so one core's
+# worth of event loop) each.
+def start_daemons(aria2c, downloaddir=None, appdir=APP_DIR):
+    appconf = load_appconf(appdir)
+    downloaddir = downloaddir or download_dir()
+    return [start_daemon(aria2c, downloaddir, appdir, port, appconf) for port in local_ports(appconf)]
@@ -0,0 +1,55 @@
+import threading
+
+NOTIFICATION_STATUSES = {
+    "start": "active",
+    "pause": "paused",
+    "stop": "removed",
+    "complete": "complete",
+    "error": "error",
+    "bt_complete": "complete",
+}
+
+class NotificationListener(threading.Thread):
+    def __init__(self, rpc, callback, on_connect=None, retry_interval=1):
+        threading.Thread.__init__(self, daemon=True)
+        self.callback = callback
+        self.on_connect = on_connect
+        self.retry_interval = retry_interval
+        self.stop_event = threading.Event()
+        self.rpc = rpc
+        self.client = None
+
+    def handler(self, event):
+        return lambda gid: self.callback(gid, NOTIFICATION_STATUSES[event])
+
+    def run(self):
+        # Regular calls go through Aria2RPC; aria2p is only used for its
+        # WebSocket notification loop. It takes longer to import than the
+        # rest of Varia, so that happens here, off the startup path.
+        import aria2p
+        self.client = aria2p.Client(host=self.rpc.host, port=self.rpc.port, secret=self.rpc.secret)
+        # aria2p returns from listen_to_notifications whenever the socket drops,
+        # so reconnect until stopped and let the owner resynchronise the state
+        # it may have missed in between.
+        while not self.stop_event.is_set():
+            if self.on_connect:
+                self.on_connect()
+            try:
+                self.client.listen_to_notifications(
+                    on_download_start=self.handler("start"),
+                    on_download_pause=self.handler("pause"),
+                    on_download_stop=self.handler("stop"),
+                    on_download_complete=self.handler("complete"),
+                    on_download_error=self.handler("error"),
+                    on_bt_download_complete=self.handler("bt_complete"),
+                    timeout=1,
+                    handle_signals=False,
+                )
+            except:
+                pass
+            self.stop_event.wait(self.retry_interval)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.client:
+            self.client.stop_listening()
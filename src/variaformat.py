@@ -0,0 +1,25 @@
+from gettext import gettext as _
+
+def format_size(size):
+    for unit in (_("B"), _("KB"), _("MB"), _("GB")):
+        if (size < 1024):
+            return f"{round(size, 2)} {unit}"
+        size = size / 1024
+    return f"{round(size, 2)} {_('TB')}"
+
+def format_speed(speed):
+    for unit in (_("B/s"), _("KB/s"), _("MB/s")):
+        if (speed < 1024):
+            return f"{round(speed, 2)} {unit}"
+        speed = speed / 1024
+    return f"{round(speed, 2)} {_('GB/s')}"
+
+def format_eta(seconds):
+    seconds = round(seconds)
+    if (seconds < 60):
+        return _("{seconds}s left").format(seconds=seconds)
+    if (seconds < 3600):
+        return _("{minutes}m {seconds}s left").format(minutes=seconds // 60, seconds=seconds % 60)
+    if (seconds < 86400):
+        return _("{hours}h {minutes}m left").format(hours=seconds // 3600, minutes=seconds % 3600 // 60)
+    return _("{days}d {hours}h left").format(days=seconds // 86400, hours=seconds % 86400 // 3600)
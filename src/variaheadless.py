@@ -0,0 +1,207 @@
+import os
+import signal
+import sys
+import threading
+from gettext import gettext as _
+
+from variabandwidth import BandwidthSchedule, parse_limit
+from variacache import DownloadCache, file_name
+from variaconfig import APP_DIR, load_appconf
+from variadaemon import RUNTIME_STORAGE_KEYS, download_dir, storage_options
+from variahistory import HistoryStore, archive
+from variametrics import MetricsServer, download_metrics
+from variamirrors import MAX_ACTIVE_MIRRORS
+from variapoller import StatusPoller
+from variapool import stop_daemons
+from variascheduler import DownloadScheduler
+from variasession import fetch_session, match_session, unpause_calls
+from variastate import StateStore
+from variaverify import ChecksumVerifier, MAX_REFETCHES, VERIFY_STATUSES
+
+# What the window does in the background, without the window: it keeps the
+# state store in step with aria2, enforces the queue limits and the
+# bandwidth schedule, and shuts down the daemons it started (which saves
+# their session) when stopped. Downloads added with `varia add` are picked
+# up from the store. daemons is what start_daemons returned.
+class HeadlessDaemon:
+    def __init__(self, rpc, appdir=APP_DIR, refresh_interval=5, metrics=None, daemons=None):
+        self.rpc = rpc
+        self.daemons = daemons
+        self.metrics = metrics
+        self.appconf = load_appconf(appdir)
+        self.store = StateStore(os.path.join(appdir, 'varia.db'))
+        self.history = HistoryStore(os.path.join(appdir, 'history.db'))
+        self.scheduler = DownloadScheduler(rpc, self.appconf['max_active_downloads'], self.appconf['max_downloads_per_host'])
+        self.bandwidth = BandwidthSchedule(os.path.join(appdir, 'bandwidth.json'))
+        self.verifier = ChecksumVerifier(rpc)
+        self.cache = DownloadCache(rpc, os.path.join(appdir, 'cache'), self.appconf['cache_size'] * 1024 * 1024)
+        # Until the next refresh, so a complete download is checked once.
+        self.verifying = set()
+        self.refetches = {}
+        self.poller = StatusPoller(rpc, self.on_status_update, metrics=metrics)
+        self.poller.tasks.append(self.scheduler.schedule)
+        self.refresh_interval = refresh_interval
+        self.states = {}
+        self.statuses = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.metrics_server = None
+        if metrics:
+            metrics.add_collector(self.collect_metrics)
+
+    # Saved downloads are matched up with aria2's session the same way as in
+    # the window. Ones that finished while nothing was watching are left to
+    # the first full poll, which sends them through on_complete; downloads
+    # Varia has no record of are left alone.
+    def restore(self):
+        self.rpc.wait_until_ready()
+        self.scheduler.apply_limits()
+        self.rpc.change_global_option(self.appconf['download_options'])
+        # In case the daemon was started before the settings last changed.
+        options = storage_options(self.appconf, download_dir())
+        self.rpc.change_global_option({key: options[key] for key in RUNTIME_STORAGE_KEYS})
+        matched = list(match_session(self.store.load(), fetch_session(self.rpc)))
+        for state, struct in matched:
+            if not struct:
+                self.add_again(state)
+        unpause = unpause_calls(matched)
+        if unpause:
+            try:
+                self.rpc.multicall(unpause)
+            except:
+                pass
+        self.store.flush()
+        self.refresh()
+
+    def add_again(self, state):
+        gid = self.rpc.add_uri(state['mirrors'][:MAX_ACTIVE_MIRRORS], state['options'])
+        self.store.remove(state['gid'])
+        self.store.update(gid, url=state['url'], options=state['options'], completed_length=0, total_length=0,
+            status="waiting", priority=state['priority'], bypass=state['bypass'], checksum=state['checksum'], mirrors=state['mirrors'])
+        return gid
+
+    def refresh(self):
+        states = {state['gid']: state for state in self.store.load()}
+        with self.lock:
+            previous, self.states = self.states, states
+            self.statuses = {gid: status for gid, status in self.statuses.items() if gid in states}
+            self.verifying &= states.keys()
+        for gid in states.keys() - previous.keys():
+            self.scheduler.add(gid, states[gid]['url'], states[gid]['priority'])
+        for gid in previous.keys() - states.keys():
+            self.scheduler.discard(gid)
+        # There is no notification listener here, so state changes are
+        # caught by a full poll on every refresh instead.
+        self.poller.request_full_poll()
+
+    def on_status_update(self, statuses, global_stat):
+        with self.lock:
+            statuses = {gid: status for gid, status in statuses.items() if gid in self.states}
+            for gid, status in statuses.items():
+                self.statuses.setdefault(gid, {}).update(status)
+        for gid, status in statuses.items():
+            if (status.get("status") == "complete"):
+                self.on_complete(gid)
+            elif status.get("status") in ("error", "removed"):
+                self.archive(gid, status["status"], status.get("errorMessage", ""))
+            else:
+                self.store.update(gid,
+                    completed_length=int(status.get("completedLength", 0)),
+                    total_length=int(status.get("totalLength", 0)),
+                    status=status.get("status"))
+
+    def on_complete(self, gid):
+        with self.lock:
+            state = self.states.get(gid)
+            if (gid in self.verifying) or not state:
+                return
+            if state['checksum']:
+                self.verifying.add(gid)
+        if state['checksum']:
+            self.verifier.verify(gid, state['checksum'], self.on_verified)
+        else:
+            self.archive(gid, "complete")
+            self.cache.populate(gid, state['url'])
+
+    # Runs on a verifier thread; a damaged file is deleted and fetched again.
+    def on_verified(self, gid, path, matched):
+        with self.lock:
+            state = self.states.get(gid)
+            refetches = self.refetches.pop(gid, 0)
+        if (matched == False) and state and (refetches < MAX_REFETCHES):
+            try:
+                os.remove(path)
+            except:
+                pass
+            try:
+                new_gid = self.add_again(state)
+                with self.lock:
+                    self.refetches[new_gid] = refetches + 1
+            except:
+                self.store.remove(gid)
+        else:
+            if matched and state:
+                self.cache.populate(gid, state['url'])
+            elif (matched == False):
+                print(_("Checksum mismatch: {path}").format(path=path), file=sys.stderr)
+            elif not matched:
+                print(_("Could not verify the checksum of {gid}").format(gid=gid), file=sys.stderr)
+            self.archive(gid, VERIFY_STATUSES[matched])
+
+    # The history is the same one the window shows. Archived downloads are
+    # dropped from states right away so the polls before the next refresh
+    # don't record them again.
+    def archive(self, gid, status, error=""):
+        with self.lock:
+            state = self.states.pop(gid, None)
+            total_length = int(self.statuses.pop(gid, {}).get("totalLength", 0))
+        if not state:
+            self.store.remove(gid)
+            return
+        self.scheduler.discard(gid)
+        archive(self.store, self.history, gid, state['url'], file_name(state['url'], state['options']), status,
+            total_length, error, state['checksum'], state['options'], state['mirrors'])
+
+    def apply_bandwidth(self):
+        with self.lock:
+            downloads = [(gid, self.statuses.get(gid, {}).get("status") == "active", state['bypass'],
+                state['options'].get('max-download-limit'), state['options'].get('max-upload-limit'))
+                for gid, state in self.states.items()]
+        self.bandwidth.apply(self.rpc, parse_limit(self.appconf['download_speed_limit']), downloads)
+
+    def collect_metrics(self):
+        with self.lock:
+            statuses = [(gid, dict(status)) for gid, status in self.statuses.items()]
+        return download_metrics(statuses)
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def run(self, on_ready=None):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        self.restore()
+        self.poller.start()
+        if self.metrics and self.appconf['metrics_port']:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, self.appconf['metrics_port'])
+                self.metrics_server.start()
+            except OSError:
+                self.metrics_server = None
+        if on_ready:
+            on_ready()
+        while not self.stop_event.wait(self.refresh_interval):
+            try:
+                self.store.flush()
+                self.refresh()
+                self.apply_bandwidth()
+            except:
+                pass
+        self.poller.stop()
+        self.verifier.shutdown()
+        self.cache.close()
+        self.history.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.store.close()
+        stop_daemons(self.rpc, self.daemons)
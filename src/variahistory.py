@@ -0,0 +1,139 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+# Entries loaded at a time as the history list is scrolled.
+PAGE_SIZE = 100
+HISTORY_COLUMNS = ["gid", "url", "filename", "host", "status", "total_length", "error", "checksum", "options", "mirrors", "completed"]
+# Each of these has an index that also covers the completion order, so
+# looking entries up by one of them is a single index range either way.
+LOOKUP_COLUMNS = ("gid", "url", "filename", "host")
+
+# Every word typed is matched as the start of a word in the file name, URL
+# or host; FTS5 splits URLs on punctuation the same way.
+def search_terms(text):
+    return re.findall(r"\w+", text)
+
+# Finished and failed downloads, kept out of the window's list and the state
+# store so neither grows with everything ever downloaded. Pages are read
+# newest first with a (completed, id) cursor rather than an OFFSET, so the
+# last page costs the same as the first.
+class HistoryStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY,
+                gid TEXT,
+                url TEXT,
+                filename TEXT,
+                host TEXT,
+                status TEXT,
+                total_length INTEGER,
+                error TEXT,
+                checksum TEXT,
+                options TEXT,
+                mirrors TEXT,
+                completed REAL
+            )""")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(history)")]
+            if "mirrors" not in columns:
+                self.connection.execute("ALTER TABLE history ADD COLUMN mirrors TEXT")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS history_completed ON history (completed, id)")
+            for column in LOOKUP_COLUMNS:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS history_{column} ON history ({column}, completed, id)")
+            # Not every SQLite is built with FTS5; without it searching falls
+            # back to scanning with LIKE.
+            try:
+                self.connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS history_search
+                    USING fts5 (filename, url, host, content='history', content_rowid='id')""")
+                self.connection.execute("""CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history BEGIN
+                    INSERT INTO history_search (rowid, filename, url, host) VALUES (new.id, new.filename, new.url, new.host);
+                END""")
+                self.connection.execute("""CREATE TRIGGER IF NOT EXISTS history_delete AFTER DELETE ON history BEGIN
+                    INSERT INTO history_search (history_search, rowid, filename, url, host) VALUES ('delete', old.id, old.filename, old.url, old.host);
+                END""")
+                self.searchable = True
+            except sqlite3.OperationalError:
+                self.searchable = False
+
+    def add(self, gid, url, filename, status, total_length=0, error="", checksum="", options=None, mirrors=None):
+        entry = {
+            "gid": gid,
+            "url": url,
+            "filename": filename,
+            "host": urlparse(url).hostname or "",
+            "status": status,
+            "total_length": total_length,
+            "error": error,
+            "checksum": checksum,
+            "options": json.dumps(options or {}),
+            "mirrors": json.dumps(mirrors or [url]),
+            "completed": time.time(),
+        }
+        columns = ", ".join(HISTORY_COLUMNS)
+        placeholders = ", ".join("?" for column in HISTORY_COLUMNS)
+        with self.lock, self.connection:
+            cursor = self.connection.execute(f"INSERT INTO history ({columns}) VALUES ({placeholders})", [entry[column] for column in HISTORY_COLUMNS])
+        entry["id"] = cursor.lastrowid
+        entry["options"] = options or {}
+        entry["mirrors"] = mirrors or [url]
+        return entry
+
+    # Newest first. after is the last entry of the previous page; keys
+    # narrow it down to entries with those values, such as host="example.com".
+    def page(self, query="", after=None, limit=PAGE_SIZE, **keys):
+        conditions = []
+        parameters = []
+        source = "history"
+        terms = search_terms(query)
+        if terms and self.searchable:
+            source = "history JOIN history_search ON history_search.rowid = history.id"
+            conditions.append("history_search MATCH ?")
+            parameters.append(" ".join(f'"{term}"*' for term in terms))
+        for term in (terms if not self.searchable else []):
+            conditions.append("(history.filename LIKE ? OR history.url LIKE ? OR history.host LIKE ?)")
+            parameters += [f"%{term}%"] * 3
+        for column, value in keys.items():
+            if column not in LOOKUP_COLUMNS:
+                raise ValueError(column)
+            conditions.append(f"history.{column} = ?")
+            parameters.append(value)
+        if after:
+            conditions.append("(history.completed, history.id) < (?, ?)")
+            parameters += [after["completed"], after["id"]]
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        with self.lock:
+            rows = self.connection.execute(f"""SELECT history.id, {", ".join(f"history.{column}" for column in HISTORY_COLUMNS)}
+                FROM {source} {where} ORDER BY history.completed DESC, history.id DESC LIMIT ?""", parameters + [limit]).fetchall()
+        return [dict(row, options=json.loads(row["options"] or "{}"), mirrors=json.loads(row["mirrors"]) if row["mirrors"] else [row["url"]]) for row in rows]
+
+    def remove(self, entry_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM history WHERE id = ?", (entry_id,))
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM history")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# Moves a finished or failed download from the state store to the history,
+# for the window and the headless daemon alike. Returns the history entry,
+# or None if it couldn't be written.
+def archive(store, history, gid, url, filename, status, total_length=0, error="", checksum="", options=None, mirrors=None):
+    if gid:
+        store.remove(gid)
+    try:
+        return history.add(gid, url, filename, status, total_length, error, checksum, options, mirrors)
+    except:
+        return None
@@ -0,0 +1,132 @@
+import os
+import threading
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urlparse
+
+from variamirrors import MAX_ACTIVE_MIRRORS
+
+IMPORT_BATCH_SIZE = 200
+METALINK_EXTENSIONS = (".metalink", ".meta4")
+
+def is_valid_url(url):
+    try:
+        result = urlparse(url)
+        return all([result.scheme, result.netloc])
+    except ValueError:
+        return False
+
+def entry(urls, name=None, hashes=None):
+    return {"urls": urls, "name": name, "hashes": hashes or {}}
+
+# Everything below is a generator so a list of any size is parsed, validated
+# and submitted a batch at a time instead of being loaded whole.
+def iter_lines(lines):
+    for line in lines:
+        # Indented lines carry per-download options in aria2 input files.
+        if line[:1].isspace():
+            continue
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        # Tab-separated URIs on one line are mirrors of a single file in
+        # aria2 input files; otherwise every word is a download of its own.
+        if "\t" in line:
+            yield entry([url.strip() for url in line.split("\t") if url.strip()])
+        else:
+            for url in line.split():
+                yield entry([url])
+
+def iter_text(text):
+    return iter_lines(text.splitlines())
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+# Metalink 4 ranks mirrors by ascending priority, Metalink 3 by descending
+# preference; both become an ascending sort key here.
+def metalink_rank(url):
+    try:
+        if url.get("priority"):
+            return int(url.get("priority"))
+        if url.get("preference"):
+            return 1000000 - int(url.get("preference"))
+    except ValueError:
+        pass
+    return 1000000
+
+def iter_metalink(path):
+    # Handles both Metalink 4 (RFC 5854, .meta4) and Metalink 3 (.metalink),
+    # where urls sit under <resources> and hashes under <verification>.
+    for event, element in ElementTree.iterparse(path, events=("end",)):
+        if local_name(element.tag) != "file":
+            continue
+        urls = []
+        hashes = {}
+        for child in element.iter():
+            tag = local_name(child.tag)
+            if (tag == "url") and child.text and child.text.strip() and (child.get("type") not in ("bittorrent", "torrent")):
+                urls.append((metalink_rank(child), child.text.strip()))
+            elif (tag == "hash") and child.get("type") and child.text:
+                hashes[child.get("type").lower()] = child.text.strip().lower()
+        urls.sort(key=lambda url: url[0])
+        if urls:
+            yield entry([url for rank, url in urls], os.path.basename(element.get("name", "")) or None, hashes)
+        element.clear()
+
+def iter_file(path):
+    if path.lower().endswith(METALINK_EXTENSIONS):
+        yield from iter_metalink(path)
+    else:
+        with open(path, "r", errors="replace") as f:
+            yield from iter_lines(f)
+
+class BulkImporter(threading.Thread):
+    def __init__(self, rpc, entries, queued_urls, options, on_batch, on_done, batch_size=IMPORT_BATCH_SIZE):
+        threading.Thread.__init__(self, daemon=True)
+        self.rpc = rpc
+        self.entries = entries
+        self.queued_urls = queued_urls
+        self.options = options
+        self.on_batch = on_batch
+        self.on_done = on_done
+        self.batch_size = batch_size
+        self.added = 0
+        self.skipped = 0
+
+    def submit(self, batch):
+        calls = []
+        for item in batch:
+            item["options"] = dict(self.options)
+            if item["name"]:
+                item["options"]["out"] = item["name"]
+            # Metalink mirrors are already ranked by the file itself.
+            if (len(item["urls"]) > 1):
+                item["options"]["uri-selector"] = "adaptive"
+            calls.append(("aria2.addUri", [item["urls"][:MAX_ACTIVE_MIRRORS], item["options"]]))
+        results = self.rpc.multicall(calls)
+        added = [(item, gid) for item, gid in zip(batch, results) if not isinstance(gid, Exception)]
+        self.skipped += len(batch) - len(added)
+        self.added += len(added)
+        if added:
+            self.on_batch(added)
+
+    def run(self):
+        # queued_urls is the caller's own copy of every URL already queued,
+        # so duplicates are dropped with a hash lookup rather than a list scan.
+        seen = self.queued_urls
+        batch = []
+        try:
+            for item in self.entries:
+                item["urls"] = [url for url in item["urls"] if is_valid_url(url)]
+                if not item["urls"] or (item["urls"][0] in seen):
+                    self.skipped += 1
+                    continue
+                seen.update(item["urls"])
+                batch.append(item)
+                if (len(batch) >= self.batch_size):
+                    self.submit(batch)
+                    batch = []
+            if batch:
+                self.submit(batch)
+        finally:
+            self.on_done(self.added, self.skipped)
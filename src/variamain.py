@@ -3,159 +3,344 @@ variaVersion = "v2023.11.22"
 import gi
 import sys
 from gettext import gettext as _
-import time
-from io import BytesIO
-from urllib.parse import unquote, urlparse
 import json
 import os
 import time
-import aria2p
 import subprocess
 import threading
-from pathlib import Path
-from urllib.parse import urlparse
+import requests
 gi.require_version('Gtk', '4.0')
 gi.require_version('Adw', '1')
-from gi.repository import Gtk, Adw, GLib, Gio
-import multiprocessing
-import requests
+from gi.repository import Gtk, Adw, GLib, Gio, GObject
+from variaconfig import APP_DIR, load_appconf, save_appconf
+from variadaemon import RUNTIME_STORAGE_KEYS, filesystem_type, is_rotational, storage_defaults, storage_options
+from variametrics import Metrics, MetricsServer, download_metrics
+from variapoller import StatusPoller
+from variapool import connect, notification_listeners, stop_daemons
+from variarows import RowIndex
+from variarpc import Aria2RPCError
+from variaformat import format_eta, format_size, format_speed
+from variahistory import HistoryStore, PAGE_SIZE, archive
+from variastate import StateStore
+from variascheduler import DownloadScheduler
+from variasession import fetch_session, match_session, unknown_downloads, unpause_calls
+from variaimport import BulkImporter, is_valid_url, iter_text, iter_file
+from variamirrors import MirrorWatchdog, rank_mirrors, MAX_ACTIVE_MIRRORS
+from variaautotune import AutoTuner
+from variabandwidth import BandwidthSchedule, minutes, parse_limit, window
+from variaspeed import SpeedTracker
+from variacache import DownloadCache, file_name
+from variaverify import ChecksumVerifier, MAX_REFETCHES, VERIFY_STATUSES, best_checksum, parse_checksum
+
+# Seconds a finished download's row stays in the list, with its final
+# status, after the download has gone to the history.
+ARCHIVE_DELAY = 5
+# Seconds a status for a gid without a row is kept, in case the row turns
+# up: aria2 can report on a download before add_uri has returned its gid.
+UNATTACHED_FOR = 30
+
+class DownloadItem(GObject.Object):
+    __gtype_name__ = "VariaDownloadItem"
+
+    filename = GObject.Property(type=str, default="")
+    fraction = GObject.Property(type=float, default=0)
+    speed_text = GObject.Property(type=str, default="")
+    paused = GObject.Property(type=bool, default=False)
+    finished = GObject.Property(type=bool, default=False)
+    # Bumped whenever the speed history gets a sample, to redraw the sparkline.
+    samples = GObject.Property(type=int, default=0)
+
+    def __init__(self, filename):
+        super().__init__()
+        self.filename = filename
+        self.download_thread = None
+        # Set by the window's RowIndex while the row is in the list.
+        self.row_key = None
+
+    def update(self, **properties):
+        # Setting a property always emits notify, so only touch the ones that
+        # changed to keep bound rows from relayouting every tick.
+        for name, value in properties.items():
+            if self.get_property(name) != value:
+                self.set_property(name, value)
+
+class HistoryItem(GObject.Object):
+    __gtype_name__ = "VariaHistoryItem"
+
+    filename = GObject.Property(type=str, default="")
+    details = GObject.Property(type=str, default="")
+
+    def __init__(self, entry, details):
+        super().__init__()
+        self.entry = entry
+        self.filename = entry["filename"]
+        self.details = details
 
 class DownloadThread(threading.Thread):
-    def __init__(self, api, url, progress_bar, speed_label, downloaddir):
+    def __init__(self, rpc, url, item, downloaddir, store, options=None, mirrors=None):
         threading.Thread.__init__(self)
-        self.api = api
+        self.rpc = rpc
         self.downloaddir = downloaddir
-        self.download = None
+        self.store = store
+        self.gid = None
+        self.previous_gid = None
         self.url = url
-        self.progress_bar = progress_bar
-        self.speed_label = speed_label
+        self.options = options or {}
+        self.mirrors = mirrors or [url]
+        self.priority = 0
+        # Exempt from the bandwidth schedule's caps.
+        self.bypass = False
+        # Expected hash in aria2's checksum syntax, checked once complete.
+        self.checksum = ""
+        self.verify_state = None
+        self.refetches = 0
+        # Set by the window when the download is started.
+        self.cache = None
+        self.from_cache = False
+        # Where the copy from the cache was put.
+        self.cache_path = None
+        self.item = item
+        self.item.download_thread = self
+        self.status = {}
+        # Set by the window once aria2 has given the download a gid.
+        self.speed_history = None
+        self.on_added = None
+        self.on_complete = None
+        self.on_failed = None
         self.stop_event = threading.Event()
 
     def is_valid_url(self, url):
-        result = urlparse(url)
-        try:
-            return all([result.scheme, result.netloc])
-        except ValueError:
-            return False
+        return is_valid_url(url)
 
     def run(self):
         if not (self.is_valid_url(self.url)):
             try:
-                GLib.idle_add(self.show_message(_("This is not a valid URL.")))
+                GLib.idle_add(self.show_message, _("This is not a valid URL."))
             except:
                 return
         else:
-            self.download = self.api.add_uris([self.url])
-            downloadname = self.download.name
-            while (True):
-                try:
-                    self.download.update()
+            # A file downloaded before is copied from the cache and never
+            # reaches aria2. One fetched again after its checksum didn't
+            # match goes to the server instead.
+            if self.cache and not self.refetches:
+                path = self.cache.fetch(self.url, self.checksum, self.downloaddir, file_name(self.url, self.options))
+                if path:
+                    if self.previous_gid:
+                        self.store.remove(self.previous_gid)
+                    size = str(os.path.getsize(path))
+                    self.from_cache = True
+                    self.cache_path = path
+                    self.status = {"status": "complete", "totalLength": size, "completedLength": size}
                     GLib.idle_add(self.update_labels_and_things)
-                    if (self.download.is_complete):
-                        if os.path.exists(os.path.join(self.downloaddir,(self.download.gid + ".varia.json"))):
-                            os.remove(os.path.join(self.downloaddir,(self.download.gid + ".varia.json")))
-                        break
-                    elif (self.download.status == "error"):
-                        self.speed_label.set_text(_("An error occurred:") + " " + self.download.error_message.split("status=")[1])
-                        return
-                except:
+                    if self.on_complete:
+                        GLib.idle_add(self.on_complete, self)
                     return
-                time.sleep(1)
+            # Progress is fanned out by the window's StatusPoller, so the
+            # thread only lives long enough to hand the URL to aria2.
+            if (len(self.mirrors) > 1):
+                self.mirrors = rank_mirrors([mirror for mirror in self.mirrors if self.is_valid_url(mirror)])
+                self.options["uri-selector"] = "adaptive"
+            try:
+                self.gid = self.rpc.add_uri(self.mirrors[:MAX_ACTIVE_MIRRORS], self.options)
+            except (Aria2RPCError, requests.RequestException) as error:
+                # aria2 refused the download or couldn't be reached; the row
+                # says why and goes to the history like any failed download.
+                if self.previous_gid:
+                    self.store.remove(self.previous_gid)
+                self.status = {"status": "error", "errorMessage": getattr(error, "message", str(error))}
+                if self.on_failed:
+                    GLib.idle_add(self.on_failed, self)
+                return
+            if self.previous_gid:
+                self.store.remove(self.previous_gid)
+            self.save_state()
+            if self.on_added:
+                self.on_added(self)
+
+    def apply_status(self, status):
+        was_complete = self.is_complete()
+        self.status.update(status)
+        if self.status.get("status") != "active":
+            self.status["downloadSpeed"] = "0"
+        if self.is_complete():
+            if not was_complete:
+                self.status["completedLength"] = self.status.get("totalLength", "0")
+                self.store.remove(self.gid)
+                if self.on_complete:
+                    self.on_complete(self)
+        else:
+            self.save_state()
+
+    def progress(self):
+        total_length = int(self.status.get("totalLength", 0))
+        if (total_length == 0):
+            return 0
+        return int(self.status.get("completedLength", 0)) / total_length * 100
+
+    def download_speed(self):
+        return int(self.status.get("downloadSpeed", 0))
+
+    def is_complete(self):
+        return self.status.get("status") == "complete"
+
+    def is_paused(self):
+        return self.status.get("status") == "paused"
+
+    def error_message(self):
+        return self.status.get("errorMessage", "")
+
+    def completion_text(self):
+        match self.verify_state:
+            case "verifying":
+                return _("Download complete, verifying checksum…")
+            case "verified":
+                return _("Download complete, checksum verified.")
+            case "mismatch":
+                return _("Checksum mismatch, the file is damaged.")
+            case "failed":
+                return _("Download complete, but the checksum could not be checked.")
+        if self.from_cache:
+            return _("Download complete, copied from the cache.")
+        return _("Download complete.")
 
     def show_message(self, message):
-        self.speed_label.set_text(message)
+        self.item.speed_text = message
 
     def update_labels_and_things(self):
-        self.progress_bar.set_fraction(self.download.progress / 100)
-        download_speed_mb = (self.download.download_speed / 1024 / 1024)
-        if int(str(download_speed_mb)[0]) == 0:
-            download_speed_kb = (self.download.download_speed / 1024)
-            if int(str(download_speed_kb)[0]) == 0:
-                self.speed_label.set_text(f"{round(self.download.progress)}%  |  {round(self.download.download_speed, 2)} B/s")
-            else:
-                self.speed_label.set_text(f"{round(self.download.progress)}%  |  {round(self.download.download_speed / 1024, 2)} KB/s")
+        if not self.status:
+            return
+        if self.is_complete():
+            self.item.update(fraction=1, speed_text=self.completion_text(), finished=True)
+            return
+        elif (self.status.get("status") == "error") or (self.status.get("status") == "removed"):
+            self.item.update(speed_text=_("An error occurred:") + " " + self.error_message().split("status=")[-1], finished=True)
+            return
+        progress = self.progress()
+        download_speed = self.download_speed()
+        speed_text = f"{round(progress)}%"
+        if self.speed_history and (self.status.get("status") == "active"):
+            # The smoothed speed, so the number and the ETA don't jump
+            # around with every tick.
+            speed_text += f"  |  {format_speed(round(self.speed_history.speed()))}"
+            eta = self.speed_history.eta(int(self.status.get("totalLength", 0)) - int(self.status.get("completedLength", 0)))
+            if eta is not None:
+                speed_text += f"  |  {format_eta(eta)}"
         else:
-            self.speed_label.set_text(f"{round(self.download.progress)}%  |  {round(self.download.download_speed / 1024 / 1024, 2)} MB/s")
+            speed_text += f"  |  {format_speed(download_speed)}"
+        samples = self.speed_history.received if self.speed_history else 0
+        self.item.update(fraction=round(progress / 100, 3), speed_text=speed_text, paused=self.is_paused(), samples=samples)
 
     def pause(self):
-        if self.download:
-            if self.download.is_paused == False:
+        if self.gid:
+            if self.is_paused() == False:
                 try:
-                    self.download.pause()
+                    self.rpc.pause(self.gid)
                 except:
                     try:
-                        self.download.pause([self.download.gid])
+                        self.rpc.pause(self.gid, force=True)
                     except:
                         self.stop(False)
+                        return
+                self.status["status"] = "paused"
 
     def resume(self):
-        if self.download:
-            if self.download.is_paused == True:
+        if self.gid:
+            if self.is_paused() == True:
                 try:
-                    self.download.resume()
+                    self.rpc.unpause(self.gid)
+                    self.status["status"] = "waiting"
                 except:
-                    self.speed_label.set_text(_("An error occurred:") + " " + self.download.error_message.split("status=")[1])
+                    self.item.speed_text = _("An error occurred:") + " " + self.error_message().split("status=")[-1]
+
+    # aria2 restarts an active download internally to apply new
+    # segmentation options, keeping what has been downloaded so far.
+    def set_options(self, options):
+        if self.gid:
+            self.rpc.change_option(self.gid, options)
+        self.options.update(options)
+        self.save_state()
+
+    def files(self):
+        if not self.rpc.is_local(self.gid):
+            return []
+        try:
+            return [file["path"] for file in self.rpc.get_files(self.gid) if file["path"]]
+        except:
+            return []
 
     def stop(self, deletefiles):
-        if self.download:
-            downloadgid = self.download.gid
-            downloadname = self.download.name
-            self.download.remove(force=True)
-            if not self.download.is_complete:
-                if (deletefiles == True):
-                    if os.path.exists(os.path.join(self.downloaddir,(downloadgid + ".varia.json"))):
-                        os.remove(os.path.join(self.downloaddir,(downloadgid + ".varia.json")))
-                    if os.path.exists(os.path.join(self.downloaddir, downloadname)):
-                        os.remove(os.path.join(self.downloaddir, downloadname))
+        if self.gid:
+            files = self.files() if (deletefiles == True) and not self.is_complete() else []
+            self.rpc.remove([self.gid])
+            self.delete_files(files)
+
+    def delete_files(self, files):
+        self.store.remove(self.gid)
+        for path in files:
+            if os.path.exists(path):
+                os.remove(path)
 
     def save_state(self):
-        if self.download:
-            try:
-                self.download.update()
-            except:
-                return
-            state = {
-                'url': self.url,
-                'downloaded': self.download.completed_length,
-            }
-            with open(os.path.join(self.downloaddir, f'{self.download.gid}.varia.json'), 'w') as f:
-                json.dump(state, f)
+        if self.gid:
+            self.store.update(self.gid,
+                url=self.url,
+                options=self.options,
+                completed_length=int(self.status.get("completedLength", 0)),
+                total_length=int(self.status.get("totalLength", 0)),
+                status=self.status.get("status", "waiting"),
+                priority=self.priority,
+                bypass=self.bypass,
+                checksum=self.checksum,
+                mirrors=self.mirrors)
 
     @classmethod
-    def load_state(cls, api, downloaddir, filename, progress_bar, pause_button, speed_label):
-        with open(os.path.join(downloaddir, filename), 'r') as f:
-            state = json.load(f)
-            os.remove(os.path.join(downloaddir, filename))
-        instance = cls(api, state['url'], progress_bar, speed_label, pause_button, downloaddir)
+    def load_state(cls, rpc, downloaddir, store, state, item):
+        instance = cls(rpc, state['url'], item, downloaddir, store, state['options'], state['mirrors'])
+        instance.previous_gid = state['gid']
+        instance.priority = state['priority']
+        instance.bypass = state['bypass']
+        instance.checksum = state['checksum']
         return instance
 
 class MainWindow(Gtk.Window):
-    def __init__(self, *args, **kwargs):
+    # daemons is what start_daemons returned; only those are shut down on exit.
+    def __init__(self, *args, daemons=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.daemons = daemons
 
         self.downloaddir = GLib.get_user_special_dir(GLib.USER_DIRECTORY_DOWNLOAD)
-        self.appdir = os.path.join('/var', 'data')
-        self.appconf = {'download_speed_limit': "0"}
-
-        if os.path.exists(os.path.join(self.appdir, 'varia.conf')):
-            with open(os.path.join(self.appdir, 'varia.conf'), 'r') as f:
-                self.appconf = json.load(f)
-        else:
-            with open(os.path.join(self.appdir, 'varia.conf'), 'w') as f:
-                json.dump(self.appconf, f)
-
-        self.api = aria2p.API(
-            aria2p.Client(
-                host="http://localhost",
-                port=6801
-            )
-        )
+        self.appdir = APP_DIR
+        self.appconf = load_appconf(self.appdir)
+
+        self.store = StateStore(os.path.join(self.appdir, 'varia.db'))
+        self.history = HistoryStore(os.path.join(self.appdir, 'history.db'))
+
+        # Always collected; served on localhost only when metrics_port is set.
+        self.metrics = Metrics()
+        self.metrics.add_collector(self.collect_metrics)
+        self.metrics_server = None
+        self.last_global_stat = {}
+        self.speed_tracker = SpeedTracker()
+        # One daemon, or a pool of them set up in varia.conf.
+        self.rpc = connect(self.appconf, metrics=self.metrics)
+        self.mirror_watchdog = MirrorWatchdog(self.rpc)
+        self.scheduler = DownloadScheduler(self.rpc, self.appconf['max_active_downloads'], self.appconf['max_downloads_per_host'])
+        # Decisions are appended to autotune.log as JSON lines.
+        self.tuned_limits = {}
+        self.autotuner = AutoTuner(self.rpc, os.path.join(self.appdir, 'autotune.log'), self.configured_limits(), self.on_autotune_changed,
+            on_limits=lambda limits: GLib.idle_add(self.apply_tuned_limits, limits))
+        self.autotuner.set_enabled(self.appconf['autotune'])
+        # Kept next to varia.conf; the manual speed limit applies outside
+        # the schedule's windows.
+        self.bandwidth = BandwidthSchedule(os.path.join(self.appdir, 'bandwidth.json'))
+        self.verifier = ChecksumVerifier(self.rpc)
+        self.cache = DownloadCache(self.rpc, os.path.join(self.appdir, 'cache'), self.appconf['cache_size'] * 1024 * 1024)
 
         self.set_default_size(800, 600)
         self.set_size_request(650, 450)
         self.set_titlebar(Gtk.Box())
 
-        self.total_download_speed = ""
+        self.total_download_speed = format_speed(0)
         self.terminating = False
 
         self.set_title("Varia")
@@ -164,9 +349,21 @@ class MainWindow(Gtk.Window):
         self.overlay_split_view = Adw.OverlaySplitView.new()
         self.set_child(child=self.overlay_split_view)
 
-        self.downloads = []
-        self.pause_buttons = []
+        # Only downloads that haven't finished; the rest are in the history.
+        self.downloads = set()
+        self.downloads_by_gid = {}
+        self.queued_urls = set()
+        self.pending_statuses = {}
+        # gid to (first seen, status) for statuses that came before the row.
+        self.unattached_statuses = {}
+        self.pending_global_stat = None
+        self.pending_lock = threading.Lock()
+        self.bound_items = set()
+        self.dirty_items = set()
         self.all_paused = False
+        # The history is read a page at a time, the first time it's shown.
+        self.history_loaded = False
+        self.history_complete = False
 
         # Sidebar
         sidebar_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
@@ -181,6 +378,11 @@ class MainWindow(Gtk.Window):
         about_button.connect("clicked", self.show_about)
         about_button.set_icon_name("help-about-symbolic")
 
+        diagnostics_button = Gtk.Button(tooltip_text=_("Diagnostics"))
+        header_bar.pack_start(diagnostics_button)
+        diagnostics_button.connect("clicked", self.show_diagnostics)
+        diagnostics_button.set_icon_name("utilities-system-monitor-symbolic")
+
         open_downloads_folder_button = Gtk.Button(tooltip_text=_("Open Downloads Folder"))
         header_bar.pack_end(open_downloads_folder_button)
         open_downloads_folder_button.connect("clicked", self.open_downloads_folder)
@@ -190,11 +392,28 @@ class MainWindow(Gtk.Window):
         download_entry.set_placeholder_text(_("URL"))
         download_entry.set_placeholder_text("URL")
 
+        self.checksum_entry = Gtk.Entry()
+        self.checksum_entry.set_placeholder_text(_("Checksum (optional)"))
+        self.checksum_entry.set_tooltip_text(_("SHA-256, SHA-1 or MD5 hash, like sha-256=…; the file is checked once it has downloaded and fetched again if it doesn't match"))
+
         download_button = Gtk.Button(label=_("Download"))
         download_button.get_style_context().add_class("pill")
         download_button.get_style_context().add_class("suggested-action")
         download_button.connect("clicked", self.on_download_clicked, download_entry)
 
+        self.mirrors_check = Gtk.CheckButton(label=_("Several URLs are mirrors of one file"))
+        self.mirrors_check.set_tooltip_text(_("Download one file from all of the given URLs at once, fastest first"))
+
+        import_button = Gtk.Button(label=_("Import URLs"))
+        import_button.get_style_context().add_class("pill")
+        import_button.set_tooltip_text(_("Add every URL from a text file or a Metalink file"))
+        import_button.connect("clicked", self.on_import_clicked)
+
+        self.import_status_label = Gtk.Label()
+        self.import_status_label.set_wrap(True)
+        self.import_status_label.get_style_context().add_class("dim-label")
+        self.import_status_label.hide()
+
         sidebar_expanding_box = Gtk.Box()
         Gtk.Widget.set_vexpand(sidebar_expanding_box, True)
 
@@ -226,14 +445,159 @@ class MainWindow(Gtk.Window):
         speed_limit_box.append(speed_limit_unit_names_dropdown)
         speed_limit_box.append(speed_limit_apply_button)
 
+        queue_label = Gtk.Label(label = _("Simultaneous Downloads"))
+
+        queue_box = Gtk.Box(spacing=2)
+
+        max_active_downloads_spin = Gtk.SpinButton.new_with_range(1, 64, 1)
+        max_active_downloads_spin.set_value(self.appconf['max_active_downloads'])
+        max_active_downloads_spin.set_tooltip_text(_("Downloads running at the same time"))
+        max_active_downloads_spin.set_hexpand(True)
+
+        max_downloads_per_host_spin = Gtk.SpinButton.new_with_range(0, 64, 1)
+        max_downloads_per_host_spin.set_value(self.appconf['max_downloads_per_host'])
+        max_downloads_per_host_spin.set_tooltip_text(_("Downloads running at the same time from a single server (0 for no limit)"))
+        max_downloads_per_host_spin.set_hexpand(True)
+
+        max_active_downloads_spin.connect("value-changed", lambda spin: self.on_queue_limits_changed(max_active_downloads_spin, max_downloads_per_host_spin))
+        max_downloads_per_host_spin.connect("value-changed", lambda spin: self.on_queue_limits_changed(max_active_downloads_spin, max_downloads_per_host_spin))
+
+        queue_box.append(max_active_downloads_spin)
+        queue_box.append(Gtk.Label(label = _("Per Server")))
+        queue_box.append(max_downloads_per_host_spin)
+
+        autotune_box = Gtk.Box(spacing=6)
+        autotune_switch = Gtk.Switch(active=self.appconf['autotune'])
+        autotune_switch.set_tooltip_text(_("Adjust simultaneous downloads and segments to get the most out of the connection"))
+        autotune_switch.connect("notify::active", self.on_autotune_toggled)
+        autotune_box.append(Gtk.Label(label=_("Automatic Tuning"), hexpand=True, halign=Gtk.Align.START))
+        autotune_box.append(autotune_switch)
+
+        download_options = self.appconf['download_options']
+        download_options_grid = Gtk.Grid(row_spacing=4, column_spacing=6)
+        download_options_grid.set_margin_top(6)
+
+        self.split_spin = Gtk.SpinButton.new_with_range(1, 64, 1)
+        self.split_spin.set_value(int(download_options['split']))
+        self.split_spin.set_hexpand(True)
+        download_options_grid.attach(Gtk.Label(label=_("Segments"), halign=Gtk.Align.START), 0, 0, 1, 1)
+        download_options_grid.attach(self.split_spin, 1, 0, 1, 1)
+
+        self.connections_spin = Gtk.SpinButton.new_with_range(1, 16, 1)
+        self.connections_spin.set_value(int(download_options['max-connection-per-server']))
+        download_options_grid.attach(Gtk.Label(label=_("Connections per Server"), halign=Gtk.Align.START), 0, 1, 1, 1)
+        download_options_grid.attach(self.connections_spin, 1, 1, 1, 1)
+
+        self.min_split_size_spin = Gtk.SpinButton.new_with_range(1, 1024, 1)
+        self.min_split_size_spin.set_value(int(download_options['min-split-size'].rstrip("M")))
+        self.min_split_size_spin.set_tooltip_text(_("Files are only split into segments of at least this many megabytes"))
+        download_options_grid.attach(Gtk.Label(label=_("Minimum Segment Size (MB)"), halign=Gtk.Align.START), 0, 2, 1, 1)
+        download_options_grid.attach(self.min_split_size_spin, 1, 2, 1, 1)
+
+        self.piece_selectors = ["default", "inorder", "random", "geom"]
+        self.piece_selector_dropdown = Gtk.DropDown.new_from_strings([_("Default"), _("In Order"), _("Random"), _("Geometric")])
+        self.piece_selector_dropdown.set_selected(self.piece_selectors.index(download_options['stream-piece-selector']))
+        self.piece_selector_dropdown.set_tooltip_text(_("Which parts of the file segments are fetched from first"))
+        download_options_grid.attach(Gtk.Label(label=_("Piece Selection"), halign=Gtk.Align.START), 0, 3, 1, 1)
+        download_options_grid.attach(self.piece_selector_dropdown, 1, 3, 1, 1)
+
+        download_options_save_button = Gtk.Button(label=_("Save as Default"))
+        download_options_save_button.connect("clicked", self.on_download_options_saved)
+        download_options_grid.attach(download_options_save_button, 0, 4, 2, 1)
+
+        cache_size_spin = Gtk.SpinButton.new_with_range(0, 10000000, 1024)
+        cache_size_spin.set_value(self.appconf['cache_size'])
+        cache_size_spin.set_tooltip_text(_("Keep downloaded files to copy them instead of downloading the same URL again; 0 turns the cache off and empties it"))
+        cache_size_spin.connect("value-changed", self.on_cache_size_changed)
+        download_options_grid.attach(Gtk.Label(label=_("Download Cache (MB)"), halign=Gtk.Align.START), 0, 5, 1, 1)
+        download_options_grid.attach(cache_size_spin, 1, 5, 1, 1)
+
+        download_options_expander = Gtk.Expander(label=_("Download Options"))
+        download_options_expander.set_child(download_options_grid)
+
+        self.schedule_days = [
+            (_("Every Day"), [0, 1, 2, 3, 4, 5, 6]),
+            (_("Weekdays"), [0, 1, 2, 3, 4]),
+            (_("Weekends"), [5, 6]),
+            (_("Mondays"), [0]),
+            (_("Tuesdays"), [1]),
+            (_("Wednesdays"), [2]),
+            (_("Thursdays"), [3]),
+            (_("Fridays"), [4]),
+            (_("Saturdays"), [5]),
+            (_("Sundays"), [6]),
+        ]
+        bandwidth_schedule_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        bandwidth_schedule_box.set_margin_top(6)
+        self.bandwidth_windows_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        for bandwidth_window in self.bandwidth.windows:
+            self.bandwidth_windows_box.append(self.create_bandwidth_window_row(bandwidth_window))
+        add_bandwidth_window_button = Gtk.Button(label=_("Add Time Window"))
+        add_bandwidth_window_button.connect("clicked", self.on_add_bandwidth_window_clicked)
+        bandwidth_schedule_box.append(self.bandwidth_windows_box)
+        bandwidth_schedule_box.append(add_bandwidth_window_button)
+
+        bandwidth_schedule_expander = Gtk.Expander(label=_("Bandwidth Schedule"))
+        bandwidth_schedule_expander.set_tooltip_text(_("Speed limits for set hours of the week; the speed limit below applies the rest of the time"))
+        bandwidth_schedule_expander.set_child(bandwidth_schedule_box)
+
+        storage_grid = Gtk.Grid(row_spacing=4, column_spacing=6)
+        storage_grid.set_margin_top(6)
+
+        self.file_allocations = ["none", "trunc", "prealloc", "falloc"]
+        self.file_allocation_dropdown = Gtk.DropDown.new_from_strings([_("None"), _("Truncate"), _("Preallocate"), _("Fallocate")])
+        self.file_allocation_dropdown.set_tooltip_text(_("How space for a file is reserved before it downloads; reserving it up front avoids fragmentation"))
+        self.file_allocation_dropdown.set_hexpand(True)
+        storage_grid.attach(Gtk.Label(label=_("File Allocation"), halign=Gtk.Align.START), 0, 0, 1, 1)
+        storage_grid.attach(self.file_allocation_dropdown, 1, 0, 1, 1)
+
+        self.disk_cache_spin = Gtk.SpinButton.new_with_range(0, 1024, 8)
+        self.disk_cache_spin.set_tooltip_text(_("Memory used to gather writes before they go to disk"))
+        storage_grid.attach(Gtk.Label(label=_("Disk Cache (MB)"), halign=Gtk.Align.START), 0, 1, 1, 1)
+        storage_grid.attach(self.disk_cache_spin, 1, 1, 1, 1)
+
+        self.enable_mmap_check = Gtk.CheckButton(label=_("Memory-Mapped Writes"))
+        self.enable_mmap_check.set_tooltip_text(_("Only used for files whose space is reserved up front"))
+        storage_grid.attach(self.enable_mmap_check, 0, 2, 2, 1)
+
+        self.async_dns_check = Gtk.CheckButton(label=_("Asynchronous DNS"))
+        storage_grid.attach(self.async_dns_check, 0, 3, 2, 1)
+
+        self.storage_label = Gtk.Label(wrap=True, xalign=0)
+        self.storage_label.get_style_context().add_class("dim-label")
+        storage_grid.attach(self.storage_label, 0, 4, 2, 1)
+
+        storage_reset_button = Gtk.Button(label=_("Use Detected Settings"))
+        storage_reset_button.connect("clicked", self.on_storage_reset_clicked)
+        storage_grid.attach(storage_reset_button, 0, 5, 2, 1)
+
+        self.show_storage_options()
+        self.file_allocation_dropdown.connect("notify::selected", self.on_storage_options_changed)
+        self.disk_cache_spin.connect("value-changed", self.on_storage_options_changed)
+        self.enable_mmap_check.connect("toggled", self.on_storage_options_changed)
+        self.async_dns_check.connect("toggled", self.on_storage_options_changed)
+
+        storage_expander = Gtk.Expander(label=_("Storage"))
+        storage_expander.set_child(storage_grid)
+
         sidebar_content_box.set_margin_start(6)
         sidebar_content_box.set_margin_end(6)
         sidebar_content_box.set_margin_top(6)
         sidebar_content_box.set_margin_bottom(6)
 
         sidebar_content_box.append(download_entry)
+        sidebar_content_box.append(self.checksum_entry)
+        sidebar_content_box.append(self.mirrors_check)
         sidebar_content_box.append(download_button)
+        sidebar_content_box.append(import_button)
+        sidebar_content_box.append(self.import_status_label)
+        sidebar_content_box.append(download_options_expander)
+        sidebar_content_box.append(bandwidth_schedule_expander)
+        sidebar_content_box.append(storage_expander)
         sidebar_content_box.append(sidebar_expanding_box)
+        sidebar_content_box.append(queue_label)
+        sidebar_content_box.append(queue_box)
+        sidebar_content_box.append(autotune_box)
         sidebar_content_box.append(speed_limit_label)
         sidebar_content_box.append(speed_limit_box)
         sidebar_box.append(sidebar_content_box)
@@ -245,9 +609,19 @@ class MainWindow(Gtk.Window):
         header_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
 
         self.total_download_speed_label = Gtk.Label(label=self.total_download_speed)
+        self.total_download_speed_label.set_margin_start(6)
+
+        self.total_speed_graph = Gtk.DrawingArea()
+        self.total_speed_graph.set_size_request(120, 24)
+        self.total_speed_graph.set_valign(Gtk.Align.CENTER)
+        self.total_speed_graph.set_draw_func(self.draw_speed_graph, self.speed_tracker.total)
 
         header_button_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
 
+        self.history_button = Gtk.ToggleButton(icon_name="document-open-recent-symbolic", tooltip_text=_("History"))
+        self.history_button.connect("toggled", self.on_history_toggled)
+        header_button_box.append(self.history_button)
+
         header_pause_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=5)
         header_pause_label = Gtk.Label(label =_("Pause All"))
         header_pause_image = Gtk.Image.new()
@@ -278,6 +652,7 @@ class MainWindow(Gtk.Window):
         Gtk.Widget.set_hexpand(header_expanding_box_1, True)
 
         header_box.append(header_expanding_box)
+        header_box.append(self.total_speed_graph)
         header_box.append(self.total_download_speed_label)
         header_box.append(header_expanding_box_1)
         header_box.append(header_button_box)
@@ -287,25 +662,74 @@ class MainWindow(Gtk.Window):
         header_bar.set_title_widget(header_box)
         content_box.append(header_bar)
 
-        self.download_list = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=5)
-        self.download_list.set_margin_start(10)
-        self.download_list.set_margin_end(10)
-        self.download_list.set_margin_bottom(10)
+        # Only the rows in view get widgets; they are recycled while scrolling
+        # and bound to whichever DownloadItem they currently show.
+        self.download_store = Gio.ListStore.new(DownloadItem)
+        self.rows = RowIndex()
+
+        download_list_factory = Gtk.SignalListItemFactory()
+        download_list_factory.connect("setup", self.on_download_row_setup)
+        download_list_factory.connect("bind", self.on_download_row_bind)
+        download_list_factory.connect("unbind", self.on_download_row_unbind)
+
+        self.download_list = Gtk.ListView.new(Gtk.NoSelection.new(self.download_store), download_list_factory)
 
         scrolled_window = Gtk.ScrolledWindow()
         scrolled_window.set_child(self.download_list)
         scrolled_window.set_hexpand(True)
         scrolled_window.set_vexpand(True)
 
-        content_box.append(scrolled_window)
+        self.history_store = Gio.ListStore.new(HistoryItem)
+
+        history_list_factory = Gtk.SignalListItemFactory()
+        history_list_factory.connect("setup", self.on_history_row_setup)
+        history_list_factory.connect("bind", self.on_history_row_bind)
+        history_list_factory.connect("unbind", self.on_history_row_unbind)
+
+        history_list = Gtk.ListView.new(Gtk.NoSelection.new(self.history_store), history_list_factory)
+
+        history_scrolled_window = Gtk.ScrolledWindow()
+        history_scrolled_window.set_child(history_list)
+        history_scrolled_window.set_hexpand(True)
+        history_scrolled_window.set_vexpand(True)
+        # The next page is read once the end of the list is scrolled to.
+        history_scrolled_window.connect("edge-reached", self.on_history_edge_reached)
+
+        history_toolbar = Gtk.Box(spacing=6)
+        history_toolbar.set_margin_start(10)
+        history_toolbar.set_margin_end(10)
+        history_toolbar.set_margin_bottom(5)
+        self.history_search_entry = Gtk.SearchEntry(placeholder_text=_("Search by file name, URL or server"))
+        self.history_search_entry.set_hexpand(True)
+        self.history_search_entry.connect("search-changed", lambda entry: self.load_history())
+        clear_history_button = Gtk.Button(label=_("Clear History"))
+        clear_history_button.connect("clicked", self.on_clear_history_clicked)
+        history_toolbar.append(self.history_search_entry)
+        history_toolbar.append(clear_history_button)
+
+        history_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        history_box.append(history_toolbar)
+        history_box.append(history_scrolled_window)
+
+        self.content_stack = Gtk.Stack()
+        self.content_stack.add_named(scrolled_window, "downloads")
+        self.content_stack.add_named(history_box, "history")
+
+        content_box.append(self.content_stack)
 
         self.overlay_split_view.set_content(content_box)
 
-        self.total_download_speed_calculator_thread = threading.Thread(target=self.total_download_speed_get, args=(self.downloads, self.total_download_speed_label))
-        self.total_download_speed_calculator_thread.start()
+        self.status_poller = StatusPoller(self.rpc, self.on_status_update, metrics=self.metrics)
+        self.status_poller.tasks.append(self.scheduler.schedule)
+        self.status_poller.tasks.append(self.mirror_watchdog.check)
+        self.status_poller.tasks.append(self.autotuner.tune)
+        self.status_poller.start()
 
-        self.check_download_status_thread = threading.Thread(target=self.check_download_status)
-        self.check_download_status_thread.start()
+        GLib.timeout_add(250, self.update_download_rows)
+
+        self.notification_listeners = notification_listeners(self.rpc, self.on_download_notification, self.status_poller.request_full_poll)
+        for notification_listener in self.notification_listeners:
+            notification_listener.start()
 
         # Set download speed limit from appconf:
         if (self.appconf["download_speed_limit"][0] != "0"):
@@ -319,65 +743,300 @@ class MainWindow(Gtk.Window):
             speed_limit_entry.set_text(self.appconf["download_speed_limit"][:-1])
             self.on_speed_limit_changed(speed_limit_entry, speed_limit_unit_names_dropdown)
 
-        for filename in os.listdir(self.downloaddir):
-            if filename.endswith('.varia.json'):
-                with open(os.path.join(self.downloaddir, filename), 'r') as f:
-                    state = json.load(f)
-                objectlist = self.create_actionrow(state['url'])
-                download_thread = DownloadThread.load_state(self.api, self.downloaddir, filename, objectlist[0], objectlist[1])
-                self.downloads.append(download_thread)
-                download_thread.start()
-
-    def check_download_status(self):
-        while (self.terminating == False):
-            i = 0
-            for download_thread in self.downloads:
-                if (download_thread.download.is_complete == 1):
-                    download_thread.speed_label.set_text(_("Download complete."))
-                    self.pause_buttons[i].hide()
-                elif (download_thread.download.status == "error") or (download_thread.download.status == "removed"):
-                    download_thread.speed_label.set_text(_("An error occurred:") + " " + download_thread.download.error_message.split("status=")[1])
-                    self.pause_buttons[i].hide()
-                i += 1
-            time.sleep(1)
-
-    def total_download_speed_get(self, downloads, total_download_speed_label):
-        while (self.terminating == False):
-            total_download_speed = 0
-            download_speed_mb = False
-            download_speed_kb = False
-            for download_thread in downloads:
-                try:
-                    download_thread.download.update()
-                except:
-                    continue
-                try:
-                    speed_label_text_first_digit = download_thread.speed_label.get_text()[0]
-                except:
-                    speed_label_text_first_digit = "0"
-                if (speed_label_text_first_digit.isdigit()):
-                    download_speed = (float(download_thread.speed_label.get_text().split(" ")[4]))
-                    if (download_thread.speed_label.get_text().split(" ")[5] == _("MB/s")):
-                        download_speed_mb = True
-                    elif (download_thread.speed_label.get_text().split(" ")[5] == _("KB/s")):
-                        download_speed_kb = True
-                    total_download_speed = total_download_speed + download_speed
-            if (total_download_speed == 0):
-                total_download_speed_label.set_text(_("0 B/s"))
-            elif (download_speed_mb == True):
-                total_download_speed_label.set_text(str(round(total_download_speed, 2)) + _(" MB/s"))
-            elif (download_speed_kb == True):
-                total_download_speed_label.set_text(str(round(total_download_speed, 2)) + _(" KB/s"))
+        if not self.appconf.get("legacy_state_migrated"):
+            self.migrate_legacy_state()
+
+        threading.Thread(target=self.fetch_session, daemon=True).start()
+
+        GLib.timeout_add_seconds(5, self.flush_state)
+        GLib.timeout_add_seconds(10, self.apply_bandwidth)
+
+        self.set_metrics_port(self.appconf['metrics_port'])
+
+    # Saved downloads are attached to what the daemon restored of its session
+    # instead of being added and probed again.
+    def fetch_session(self):
+        states = self.store.load()
+        try:
+            self.rpc.wait_until_ready()
+            self.scheduler.apply_limits()
+            self.rpc.change_global_option(self.appconf['download_options'])
+            self.apply_storage_options()
+            session = fetch_session(self.rpc)
+        except:
+            session = {}
+        GLib.idle_add(self.restore_session, states, session)
+
+    def restore_session(self, states, session):
+        matched = list(match_session(states, session))
+        for state, struct in matched:
+            item = self.create_actionrow(state['url'])
+            download_thread = DownloadThread.load_state(self.rpc, self.downloaddir, self.store, state, item)
+            if struct:
+                self.attach_download(download_thread, struct)
             else:
-                total_download_speed_label.set_text(str(round(total_download_speed, 2)) + _(" B/s"))
-            time.sleep(1)
+                self.start_download(download_thread)
+        unpause = unpause_calls(matched)
+        # Downloads in aria2's session that Varia has no record of.
+        for struct, url in unknown_downloads(session):
+            item = self.create_actionrow(url)
+            download_thread = DownloadThread(self.rpc, url, item, self.downloaddir, self.store)
+            self.attach_download(download_thread, struct)
+        if unpause:
+            try:
+                self.rpc.multicall(unpause)
+            except:
+                pass
+        self.bandwidth.invalidate()
+        self.apply_bandwidth()
 
-    def create_actionrow(self, url):
-        filename = url.split("/")[-1].split("?")[0]
+    # Older versions kept one <gid>.varia.json per download in the Downloads
+    # folder; import them into the state store once and delete them.
+    def migrate_legacy_state(self):
+        try:
+            for filename in os.listdir(self.downloaddir):
+                if filename.endswith('.varia.json'):
+                    with open(os.path.join(self.downloaddir, filename), 'r') as f:
+                        state = json.load(f)
+                    self.store.update(filename[:-len('.varia.json')], url=state['url'], completed_length=state.get('downloaded', 0), status="paused")
+                    os.remove(os.path.join(self.downloaddir, filename))
+            self.store.flush()
+        except:
+            return
+        self.appconf['legacy_state_migrated'] = True
+        self.save_appconf()
 
+    def flush_state(self):
+        try:
+            self.store.flush()
+        except:
+            pass
+        return (self.terminating == False)
+
+    def start_download(self, download_thread):
+        download_thread.on_added = self.index_download
+        download_thread.cache = self.cache
+        download_thread.on_complete = self.on_download_complete
+        download_thread.on_failed = self.archive_download
+        self.downloads.add(download_thread)
+        download_thread.start()
+
+    # Indexed before the status is applied, so one that is already complete
+    # goes through on_download_complete like any other.
+    def attach_download(self, download_thread, struct):
+        download_thread.gid = struct["gid"]
+        self.downloads.add(download_thread)
+        self.index_download(download_thread)
+        download_thread.apply_status({key: struct[key] for key in ("status", "totalLength", "completedLength")})
+        self.dirty_items.add(download_thread.item)
+        if download_thread.status["status"] in ("error", "removed"):
+            self.archive_download(download_thread)
+
+    def index_download(self, download_thread):
+        with self.pending_lock:
+            self.downloads_by_gid[download_thread.gid] = download_thread
+            self.queued_urls.add(download_thread.url)
+            # Replayed on the next tick, before anything that came since.
+            held = self.unattached_statuses.pop(download_thread.gid, None)
+            if held:
+                self.pending_statuses[download_thread.gid] = dict(held[1], **self.pending_statuses.get(download_thread.gid, {}))
+        download_thread.speed_history = self.speed_tracker.track(download_thread.gid)
+        download_thread.on_complete = self.on_download_complete
+        self.scheduler.add(download_thread.gid, download_thread.url, download_thread.priority)
+        self.mirror_watchdog.track(download_thread.gid, download_thread.mirrors)
+
+    def unindex_download(self, download_thread):
+        with self.pending_lock:
+            if download_thread.gid:
+                self.downloads_by_gid.pop(download_thread.gid, None)
+            self.queued_urls.discard(download_thread.url)
+        if download_thread.gid:
+            self.speed_tracker.discard(download_thread.gid)
+            self.scheduler.discard(download_thread.gid)
+            self.mirror_watchdog.discard(download_thread.gid)
+
+    # Copies from the cache are checked too; they have no gid, so the
+    # verifier is given their path instead.
+    def on_download_complete(self, download_thread):
+        if download_thread.checksum:
+            download_thread.verify_state = "verifying"
+            self.verifier.verify(download_thread.gid, download_thread.checksum,
+                lambda gid, path, matched: GLib.idle_add(self.on_download_verified, download_thread, path, matched), download_thread.cache_path)
+        elif download_thread.from_cache:
+            self.archive_download(download_thread)
+        else:
+            self.cache.populate(download_thread.gid, download_thread.url)
+            self.archive_download(download_thread)
+
+    def on_download_verified(self, download_thread, path, matched):
+        if download_thread not in self.downloads:
+            return
+        if (matched == False) and (download_thread.refetches < MAX_REFETCHES):
+            self.refetch_download(download_thread, path)
+            return
+        download_thread.verify_state = VERIFY_STATUSES[matched]
+        self.dirty_items.add(download_thread.item)
+        if matched and not download_thread.from_cache:
+            self.cache.populate(download_thread.gid, download_thread.url)
+        self.archive_download(download_thread)
+
+    # The damaged file is deleted and the download added again under a new
+    # gid, in the same row and with the same options and checksum.
+    def refetch_download(self, download_thread, path):
+        self.unindex_download(download_thread)
+        self.downloads.discard(download_thread)
+        try:
+            os.remove(path)
+        except:
+            pass
+        refetch = DownloadThread(self.rpc, download_thread.url, download_thread.item, self.downloaddir, self.store, download_thread.options, download_thread.mirrors)
+        refetch.priority = download_thread.priority
+        refetch.bypass = download_thread.bypass
+        refetch.checksum = download_thread.checksum
+        refetch.refetches = download_thread.refetches + 1
+        refetch.item.update(fraction=0, speed_text=_("Checksum mismatch, downloading again…"), finished=False)
+        self.start_download(refetch)
+
+    # Finished and failed downloads go to the history, and their rows leave
+    # the list a little later, so the list only holds what is still going.
+    def archive_download(self, download_thread):
+        if download_thread not in self.downloads:
+            return
+        self.downloads.discard(download_thread)
+        self.unindex_download(download_thread)
+        status = download_thread.status.get("status", "error")
+        if download_thread.is_complete():
+            status = download_thread.verify_state or ("cached" if download_thread.from_cache else "complete")
+        entry = archive(self.store, self.history, download_thread.gid, download_thread.url, download_thread.item.filename, status,
+            int(download_thread.status.get("totalLength", 0)), download_thread.error_message(), download_thread.checksum, download_thread.options, download_thread.mirrors)
+        # Search results are left alone; the new entry turns up the next
+        # time the search changes.
+        if entry and self.history_loaded and not self.history_search_entry.get_text():
+            self.history_store.insert(0, HistoryItem(entry, self.history_details(entry)))
+        self.dirty_items.add(download_thread.item)
+        GLib.timeout_add_seconds(ARCHIVE_DELAY, self.remove_download_row, download_thread.item)
+
+    def remove_download_row(self, item):
+        # Gone already if it was cancelled in the meantime.
+        position = self.rows.remove(item)
+        if position is not None:
+            self.download_store.remove(position)
+        self.dirty_items.discard(item)
+        return False
+
+    # Worker threads never touch widgets: the poller and the notification
+    # listener only merge what they learned into pending_statuses, which the
+    # main loop drains in update_download_rows.
+    def queue_status(self, gid, status):
+        with self.pending_lock:
+            if gid in self.pending_statuses:
+                self.pending_statuses[gid].update(status)
+            else:
+                self.pending_statuses[gid] = dict(status)
+
+    def on_status_update(self, statuses, global_stat):
+        for gid, status in statuses.items():
+            self.queue_status(gid, status)
+        with self.pending_lock:
+            self.pending_global_stat = global_stat
+        self.last_global_stat = global_stat
+        self.speed_tracker.record(statuses, global_stat)
+        self.autotuner.sample(global_stat, statuses)
+
+    def on_download_notification(self, gid, status):
+        update = {"status": status}
+        if (status == "error"):
+            try:
+                update = self.rpc.tell_status(gid, ["status", "errorCode", "errorMessage"])
+            except:
+                pass
+        self.queue_status(gid, update)
+        self.scheduler.mark_dirty()
+
+    def update_download_rows(self):
+        started = time.perf_counter()
+        with self.pending_lock:
+            snapshot = self.pending_statuses
+            self.pending_statuses = {}
+            global_stat = self.pending_global_stat
+            self.pending_global_stat = None
+            downloads_by_gid = self.downloads_by_gid.copy() if snapshot else {}
+        unattached = {}
+        for gid, status in snapshot.items():
+            download_thread = downloads_by_gid.get(gid)
+            if not download_thread:
+                unattached[gid] = status
+            else:
+                # Downloads held back by the scheduler's per-server limit are
+                # paused in aria2 but still queued as far as the user is concerned.
+                if (status.get("status") == "paused") and self.scheduler.is_held(gid):
+                    status["status"] = "waiting"
+                download_thread.apply_status(status)
+                self.dirty_items.add(download_thread.item)
+                if download_thread.status.get("status") in ("error", "removed"):
+                    self.archive_download(download_thread)
+        if unattached or self.unattached_statuses:
+            self.hold_statuses(unattached)
+        if global_stat:
+            self.update_total_download_speed(global_stat)
+        # Rows that are scrolled out of view have no widgets, and nothing is
+        # visible while the window is hidden; those items stay dirty until
+        # they get bound again.
+        if self.get_mapped():
+            for item in (self.dirty_items & self.bound_items):
+                item.download_thread.update_labels_and_things()
+                self.dirty_items.discard(item)
+        self.metrics.observe_tick("MainWindow.update_download_rows", time.perf_counter() - started)
+        return (self.terminating == False)
+
+    # Statuses for gids without a row wait in unattached_statuses until
+    # index_download replays them, so a download that starts or finishes
+    # before its row is indexed doesn't stay "waiting" forever.
+    def hold_statuses(self, unattached):
+        now = time.monotonic()
+        with self.pending_lock:
+            for gid, status in unattached.items():
+                if gid in self.downloads_by_gid:
+                    # Indexed since the snapshot was taken.
+                    self.pending_statuses[gid] = dict(status, **self.pending_statuses.get(gid, {}))
+                elif gid in self.unattached_statuses:
+                    self.unattached_statuses[gid][1].update(status)
+                else:
+                    self.unattached_statuses[gid] = (now, dict(status))
+            # Downloads Varia doesn't know about, or has archived, report in
+            # too; they are forgotten again after a while.
+            self.unattached_statuses = {gid: held for gid, held in self.unattached_statuses.items() if now - held[0] < UNATTACHED_FOR}
+
+    def update_total_download_speed(self, global_stat):
+        total_download_speed = format_speed(round(self.speed_tracker.total.speed()))
+        if (total_download_speed != self.total_download_speed):
+            self.total_download_speed = total_download_speed
+            self.total_download_speed_label.set_text(total_download_speed)
+        self.total_speed_graph.queue_draw()
+        self.total_download_speed_label.set_tooltip_text(_("Active: {active}, Waiting: {waiting}, Stopped: {stopped}").format(
+            active=global_stat.get("numActive", "0"),
+            waiting=global_stat.get("numWaiting", "0"),
+            stopped=global_stat.get("numStopped", "0")))
+
+    def create_actionrow(self, url):
+        return self.create_actionrows([url])[0]
+
+    def create_actionrows(self, urls, names=None):
+        items = []
+        for url, name in zip(urls, names or [None] * len(urls)):
+            items.append(DownloadItem(name or url.split("/")[-1].split("?")[0]))
+        self.rows.append(items)
+        # One splice notifies the list view once for the whole batch.
+        self.download_store.splice(self.download_store.get_n_items(), 0, items)
+        return items
+
+    def on_download_row_setup(self, factory, list_item):
         download_item = Adw.Bin()
         style_context = download_item.get_style_context()
         style_context.add_class('card')
+        download_item.set_margin_start(10)
+        download_item.set_margin_end(10)
+        download_item.set_margin_bottom(5)
 
         box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         box_1 = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
@@ -391,117 +1050,656 @@ class MainWindow(Gtk.Window):
 
         download_item.set_child(box_2)
 
-        filename_label = Gtk.Label(label=filename)
-        filename_label.set_halign(Gtk.Align.START)
-        box.append(filename_label)
+        download_item.filename_label = Gtk.Label()
+        download_item.filename_label.set_halign(Gtk.Align.START)
+        box.append(download_item.filename_label)
+
+        download_item.progress_bar = Gtk.ProgressBar()
 
-        progress_bar = Gtk.ProgressBar()
+        download_item.speed_label = Gtk.Label()
+        download_item.speed_label.set_halign(Gtk.Align.START)
+        box.append(download_item.speed_label)
 
-        speed_label = Gtk.Label()
-        speed_label.set_halign(Gtk.Align.START)
-        box.append(speed_label)
+        download_item.sparkline = Gtk.DrawingArea()
+        download_item.sparkline.set_size_request(90, 24)
+        download_item.sparkline.set_valign(Gtk.Align.CENTER)
+        download_item.sparkline.set_margin_end(10)
+        download_item.sparkline.set_draw_func(self.draw_sparkline, list_item)
 
         button_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=5)
 
-        self.pause_buttons.append(Gtk.Button.new_from_icon_name("media-playback-pause-symbolic"))
-        self.pause_buttons[len(self.pause_buttons)-1].connect("clicked", self.on_pause_clicked, self.pause_buttons[len(self.pause_buttons)-1], download_item)
-        button_box.append(self.pause_buttons[len(self.pause_buttons)-1])
+        download_item.pause_button = Gtk.Button.new_from_icon_name("media-playback-pause-symbolic")
+        download_item.pause_button.connect("clicked", self.on_pause_clicked, list_item)
+        button_box.append(download_item.pause_button)
 
         stop_button = Gtk.Button.new_from_icon_name("process-stop-symbolic")
-        stop_button.connect("clicked", self.on_stop_clicked, download_item)
+        stop_button.connect("clicked", self.on_stop_clicked, list_item)
         button_box.append(stop_button)
 
+        queue_menu_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        queue_menu = Gtk.Popover()
+        queue_menu.set_child(queue_menu_box)
+
+        move_to_top_button = Gtk.Button(label=_("Move to Top"))
+        move_to_top_button.get_style_context().add_class('flat')
+        move_to_top_button.connect("clicked", self.on_move_clicked, list_item, queue_menu, True)
+        queue_menu_box.append(move_to_top_button)
+
+        move_to_bottom_button = Gtk.Button(label=_("Move to Bottom"))
+        move_to_bottom_button.get_style_context().add_class('flat')
+        move_to_bottom_button.connect("clicked", self.on_move_clicked, list_item, queue_menu, False)
+        queue_menu_box.append(move_to_bottom_button)
+
+        apply_options_button = Gtk.Button(label=_("Apply Download Options"))
+        apply_options_button.get_style_context().add_class('flat')
+        apply_options_button.set_tooltip_text(_("Use the segment and connection settings from the sidebar for this download"))
+        apply_options_button.connect("clicked", self.on_apply_options_clicked, list_item, queue_menu)
+        queue_menu_box.append(apply_options_button)
+
+        speed_limit_grid = Gtk.Grid(row_spacing=4, column_spacing=6)
+        speed_limit_grid.set_margin_top(6)
+        speed_limit_grid.set_margin_start(6)
+        speed_limit_grid.set_margin_end(6)
+        queue_menu.download_limit_spin = Gtk.SpinButton.new_with_range(0, 1000000, 64)
+        queue_menu.download_limit_spin.set_tooltip_text(_("0 for no limit"))
+        speed_limit_grid.attach(Gtk.Label(label=_("Download Limit (KB/s)"), halign=Gtk.Align.START), 0, 0, 1, 1)
+        speed_limit_grid.attach(queue_menu.download_limit_spin, 1, 0, 1, 1)
+        queue_menu.upload_limit_spin = Gtk.SpinButton.new_with_range(0, 1000000, 64)
+        queue_menu.upload_limit_spin.set_tooltip_text(_("0 for no limit"))
+        speed_limit_grid.attach(Gtk.Label(label=_("Upload Limit (KB/s)"), halign=Gtk.Align.START), 0, 1, 1, 1)
+        speed_limit_grid.attach(queue_menu.upload_limit_spin, 1, 1, 1, 1)
+        queue_menu.bypass_check = Gtk.CheckButton(label=_("Ignore Bandwidth Schedule"))
+        queue_menu.bypass_check.set_tooltip_text(_("Let this download run at full speed while the others stay limited"))
+        speed_limit_grid.attach(queue_menu.bypass_check, 0, 2, 2, 1)
+        apply_limits_button = Gtk.Button(label=_("Apply Speed Limits"))
+        apply_limits_button.connect("clicked", self.on_apply_limits_clicked, list_item, queue_menu)
+        speed_limit_grid.attach(apply_limits_button, 0, 3, 2, 1)
+        queue_menu_box.append(Gtk.Separator())
+        queue_menu_box.append(speed_limit_grid)
+        queue_menu.connect("show", self.on_queue_menu_shown, list_item)
+
+        download_item.queue_button = Gtk.MenuButton(icon_name="view-more-symbolic", popover=queue_menu)
+        button_box.append(download_item.queue_button)
+
         box_1.append(box)
 
         box_1_expanding_box = Gtk.Box()
         Gtk.Widget.set_hexpand(box_1_expanding_box, True)
         box_1.append(box_1_expanding_box)
 
+        box_1.append(download_item.sparkline)
         box_1.append(button_box)
         box_2.append(box_1)
-        box_2.append(progress_bar)
+        box_2.append(download_item.progress_bar)
+
+        download_item.bindings = []
+        list_item.set_child(download_item)
+
+    def on_download_row_bind(self, factory, list_item):
+        download_item = list_item.get_child()
+        item = list_item.get_item()
+        self.bound_items.add(item)
+        if (item in self.dirty_items):
+            item.download_thread.update_labels_and_things()
+            self.dirty_items.discard(item)
+        flags = GObject.BindingFlags.SYNC_CREATE
+        download_item.bindings = [
+            item.bind_property("filename", download_item.filename_label, "label", flags),
+            item.bind_property("speed_text", download_item.speed_label, "label", flags),
+            item.bind_property("fraction", download_item.progress_bar, "fraction", flags),
+            item.bind_property("paused", download_item.pause_button, "icon-name", flags,
+                lambda binding, paused: "media-playback-start-symbolic" if paused else "media-playback-pause-symbolic"),
+            item.bind_property("finished", download_item.pause_button, "visible", flags | GObject.BindingFlags.INVERT_BOOLEAN),
+            item.bind_property("finished", download_item.queue_button, "visible", flags | GObject.BindingFlags.INVERT_BOOLEAN),
+            item.bind_property("finished", download_item.sparkline, "visible", flags | GObject.BindingFlags.INVERT_BOOLEAN),
+        ]
+        download_item.samples_handler = item.connect("notify::samples", lambda item, pspec: download_item.sparkline.queue_draw())
+        download_item.sparkline.queue_draw()
+
+    def on_download_row_unbind(self, factory, list_item):
+        download_item = list_item.get_child()
+        self.bound_items.discard(list_item.get_item())
+        for binding in download_item.bindings:
+            binding.unbind()
+        download_item.bindings = []
+        list_item.get_item().disconnect(download_item.samples_handler)
+
+    def draw_sparkline(self, area, cr, width, height, list_item):
+        item = list_item.get_item()
+        if item and item.download_thread and item.download_thread.speed_history:
+            self.draw_speed_graph(area, cr, width, height, item.download_thread.speed_history)
+
+    # Newest sample on the right edge, scaled to the fastest one shown.
+    def draw_speed_graph(self, area, cr, width, height, history):
+        values = history.values()
+        if not values:
+            return
+        peak = max(values) or 1
+        step = width / max(history.capacity - 1, 1)
+        x = width - (len(values) - 1) * step
+        color = area.get_style_context().get_color()
+        for index, value in enumerate(values):
+            cr.line_to(x + index * step, height - 1 - (height - 2) * value / peak)
+        cr.set_source_rgba(color.red, color.green, color.blue, 0.7)
+        cr.set_line_width(1)
+        cr.stroke_preserve()
+        cr.line_to(width, height)
+        cr.line_to(x, height)
+        cr.close_path()
+        cr.set_source_rgba(color.red, color.green, color.blue, 0.2)
+        cr.fill()
+
+    def on_history_toggled(self, button):
+        if button.get_active():
+            if not self.history_loaded:
+                self.history_loaded = True
+                self.load_history()
+            self.content_stack.set_visible_child_name("history")
+        else:
+            self.content_stack.set_visible_child_name("downloads")
+
+    def load_history(self):
+        self.history_store.remove_all()
+        self.history_complete = False
+        self.load_history_page()
+
+    def load_history_page(self):
+        if self.history_complete:
+            return
+        count = self.history_store.get_n_items()
+        last = self.history_store.get_item(count - 1).entry if count else None
+        try:
+            entries = self.history.page(self.history_search_entry.get_text(), last)
+        except:
+            entries = []
+        self.history_complete = len(entries) < PAGE_SIZE
+        self.history_store.splice(count, 0, [HistoryItem(entry, self.history_details(entry)) for entry in entries])
+
+    def on_history_edge_reached(self, scrolled_window, position):
+        if (position == Gtk.PositionType.BOTTOM):
+            self.load_history_page()
+
+    def history_details(self, entry):
+        match entry["status"]:
+            case "complete":
+                outcome = _("Download complete.")
+            case "verified":
+                outcome = _("Download complete, checksum verified.")
+            case "mismatch":
+                outcome = _("Checksum mismatch, the file is damaged.")
+            case "failed":
+                outcome = _("Download complete, but the checksum could not be checked.")
+            case "cached":
+                outcome = _("Download complete, copied from the cache.")
+            case "removed":
+                outcome = _("Cancelled.")
+            case _:
+                outcome = _("An error occurred:") + " " + entry["error"].split("status=")[-1]
+        details = [outcome, time.strftime("%x %X", time.localtime(entry["completed"]))]
+        if entry["host"]:
+            details.append(entry["host"])
+        if entry["total_length"]:
+            details.append(format_size(entry["total_length"]))
+        return "  |  ".join(details)
+
+    def on_history_row_setup(self, factory, list_item):
+        history_item = Adw.Bin()
+        history_item.get_style_context().add_class('card')
+        history_item.set_margin_start(10)
+        history_item.set_margin_end(10)
+        history_item.set_margin_bottom(5)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        box.set_margin_start(10)
+        box.set_margin_end(10)
+        box.set_margin_top(10)
+        box.set_margin_bottom(10)
+        history_item.set_child(box)
+
+        label_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        label_box.set_hexpand(True)
+        history_item.filename_label = Gtk.Label()
+        history_item.filename_label.set_halign(Gtk.Align.START)
+        label_box.append(history_item.filename_label)
+        history_item.details_label = Gtk.Label()
+        history_item.details_label.set_halign(Gtk.Align.START)
+        history_item.details_label.get_style_context().add_class("dim-label")
+        label_box.append(history_item.details_label)
+        box.append(label_box)
 
-        self.download_list.append(download_item)
-        download_item.index = len(self.downloads)-1
+        button_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=5)
+        button_box.set_valign(Gtk.Align.CENTER)
+        download_again_button = Gtk.Button.new_from_icon_name("view-refresh-symbolic")
+        download_again_button.set_tooltip_text(_("Download Again"))
+        download_again_button.connect("clicked", self.on_download_again_clicked, list_item)
+        button_box.append(download_again_button)
+        remove_button = Gtk.Button.new_from_icon_name("user-trash-symbolic")
+        remove_button.set_tooltip_text(_("Remove from History"))
+        remove_button.connect("clicked", self.on_history_remove_clicked, list_item)
+        button_box.append(remove_button)
+        box.append(button_box)
+
+        history_item.bindings = []
+        list_item.set_child(history_item)
+
+    def on_history_row_bind(self, factory, list_item):
+        history_item = list_item.get_child()
+        item = list_item.get_item()
+        flags = GObject.BindingFlags.SYNC_CREATE
+        history_item.bindings = [
+            item.bind_property("filename", history_item.filename_label, "label", flags),
+            item.bind_property("details", history_item.details_label, "label", flags),
+        ]
+
+    def on_history_row_unbind(self, factory, list_item):
+        history_item = list_item.get_child()
+        for binding in history_item.bindings:
+            binding.unbind()
+        history_item.bindings = []
+
+    def on_download_again_clicked(self, button, list_item):
+        entry = list_item.get_item().entry
+        item = self.create_actionrow(entry["url"])
+        download_thread = DownloadThread(self.rpc, entry["url"], item, self.downloaddir, self.store, dict(entry["options"]), list(entry["mirrors"]))
+        download_thread.checksum = entry["checksum"]
+        self.start_download(download_thread)
+        self.history_button.set_active(False)
+
+    def on_history_remove_clicked(self, button, list_item):
+        position = list_item.get_position()
+        try:
+            self.history.remove(list_item.get_item().entry["id"])
+        except:
+            return
+        self.history_store.remove(position)
 
-        return [progress_bar, speed_label, self.pause_buttons[len(self.pause_buttons)-1], stop_button]
+    def on_clear_history_clicked(self, button):
+        try:
+            self.history.clear()
+        except:
+            return
+        self.history_store.remove_all()
+        self.history_complete = True
 
     def on_download_clicked(self, button, entry):
-        url = entry.get_text()
+        url = entry.get_text().strip()
+        checksum = self.checksum_entry.get_text().strip()
+        if checksum:
+            checksum = parse_checksum(checksum)
+            if not checksum:
+                self.checksum_entry.get_style_context().add_class("error")
+                return
+        self.checksum_entry.get_style_context().remove_class("error")
+        self.checksum_entry.set_text("")
         entry.set_text("")
-        if url:
-            objectlist = self.create_actionrow(url)
-            download_thread = DownloadThread(self.api, url, objectlist[0], objectlist[1], self.downloaddir)
-            self.downloads.append(download_thread)
-            download_thread.start()
+        download_thread = None
+        if (len(url.split()) > 1) and self.mirrors_check.get_active():
+            mirrors = url.split()
+            item = self.create_actionrow(mirrors[0])
+            download_thread = DownloadThread(self.rpc, mirrors[0], item, self.downloaddir, self.store, self.new_download_options(), mirrors)
+        elif (len(url.split()) > 1):
+            self.start_import(iter_text(url))
+        elif url:
+            item = self.create_actionrow(url)
+            download_thread = DownloadThread(self.rpc, url, item, self.downloaddir, self.store, self.new_download_options())
+        if download_thread:
+            download_thread.checksum = checksum
+            self.start_download(download_thread)
+
+    def download_options(self):
+        return {
+            'split': str(self.split_spin.get_value_as_int()),
+            'max-connection-per-server': str(self.connections_spin.get_value_as_int()),
+            'min-split-size': f"{self.min_split_size_spin.get_value_as_int()}M",
+            'stream-piece-selector': self.piece_selectors[self.piece_selector_dropdown.get_selected()],
+            'lowest-speed-limit': self.appconf['download_options']['lowest-speed-limit'],
+        }
+
+    # While auto-tuning, new downloads follow the tuned global split instead
+    # of carrying their own.
+    def new_download_options(self):
+        options = self.download_options()
+        if self.appconf['autotune']:
+            options.pop('split')
+        return options
 
-    def on_pause_clicked(self, button, pause_button, download_item):
+    def on_download_options_saved(self, button):
+        self.appconf['download_options'] = self.download_options()
+        self.save_appconf()
+        try:
+            self.rpc.change_global_option(self.appconf['download_options'])
+        except:
+            pass
+        self.autotuner.reset(self.configured_limits())
+
+    def on_apply_options_clicked(self, button, list_item, queue_menu):
+        queue_menu.popdown()
+        download_thread = list_item.get_item().download_thread
+        try:
+            download_thread.set_options(self.download_options())
+        except:
+            pass
+
+    # Rows are recycled, so the menu shows the limits of whichever download
+    # it is opened for.
+    def on_queue_menu_shown(self, queue_menu, list_item):
+        download_thread = list_item.get_item().download_thread
+        queue_menu.download_limit_spin.set_value(parse_limit(download_thread.options.get('max-download-limit')) // 1024)
+        queue_menu.upload_limit_spin.set_value(parse_limit(download_thread.options.get('max-upload-limit')) // 1024)
+        queue_menu.bypass_check.set_active(download_thread.bypass)
+
+    def on_apply_limits_clicked(self, button, list_item, queue_menu):
+        queue_menu.popdown()
+        download_thread = list_item.get_item().download_thread
+        download_thread.bypass = queue_menu.bypass_check.get_active()
+        try:
+            download_thread.set_options({
+                'max-download-limit': f"{queue_menu.download_limit_spin.get_value_as_int()}K",
+                'max-upload-limit': f"{queue_menu.upload_limit_spin.get_value_as_int()}K",
+            })
+        except:
+            pass
+        if download_thread.gid:
+            self.bandwidth.invalidate(download_thread.gid)
+        self.apply_bandwidth()
+
+    def create_bandwidth_window_row(self, bandwidth_window):
+        row = Gtk.Grid(row_spacing=4, column_spacing=6)
+
+        days_dropdown = Gtk.DropDown.new_from_strings([name for name, days in self.schedule_days])
+        days_dropdown.set_selected(next((index for index, (name, days) in enumerate(self.schedule_days) if days == bandwidth_window['days']), 0))
+        days_dropdown.set_hexpand(True)
+        remove_button = Gtk.Button.new_from_icon_name("user-trash-symbolic")
+        remove_button.set_tooltip_text(_("Remove Time Window"))
+        remove_button.connect("clicked", lambda button: self.on_remove_bandwidth_window_clicked(row, bandwidth_window))
+        row.attach(days_dropdown, 0, 0, 3, 1)
+        row.attach(remove_button, 3, 0, 1, 1)
+
+        start_spin = Gtk.SpinButton.new_with_range(0, 23, 1)
+        start_spin.set_value(minutes(bandwidth_window['start']) // 60)
+        end_spin = Gtk.SpinButton.new_with_range(0, 24, 1)
+        end_spin.set_value(minutes(bandwidth_window['end']) // 60)
+        end_spin.set_tooltip_text(_("Hours earlier than the start run into the next day"))
+        row.attach(Gtk.Label(label=_("From"), halign=Gtk.Align.START), 0, 1, 1, 1)
+        row.attach(start_spin, 1, 1, 1, 1)
+        row.attach(Gtk.Label(label=_("To")), 2, 1, 1, 1)
+        row.attach(end_spin, 3, 1, 1, 1)
+
+        download_limit_spin = Gtk.SpinButton.new_with_range(0, 1000000, 64)
+        download_limit_spin.set_value(bandwidth_window['download_limit'] // 1024)
+        upload_limit_spin = Gtk.SpinButton.new_with_range(0, 1000000, 64)
+        upload_limit_spin.set_value(bandwidth_window['upload_limit'] // 1024)
+        row.attach(Gtk.Label(label=_("Download (KB/s)"), halign=Gtk.Align.START), 0, 2, 2, 1)
+        row.attach(download_limit_spin, 2, 2, 2, 1)
+        row.attach(Gtk.Label(label=_("Upload (KB/s)"), halign=Gtk.Align.START), 0, 3, 2, 1)
+        row.attach(upload_limit_spin, 2, 3, 2, 1)
+
+        widgets = (days_dropdown, start_spin, end_spin, download_limit_spin, upload_limit_spin)
+        days_dropdown.connect("notify::selected", lambda dropdown, param: self.on_bandwidth_window_changed(bandwidth_window, *widgets))
+        for spin in widgets[1:]:
+            spin.connect("value-changed", lambda spin: self.on_bandwidth_window_changed(bandwidth_window, *widgets))
+        return row
+
+    def on_add_bandwidth_window_clicked(self, button):
+        bandwidth_window = window(self.schedule_days[1][1], "09:00", "17:00")
+        self.bandwidth.windows.append(bandwidth_window)
+        self.bandwidth_windows_box.append(self.create_bandwidth_window_row(bandwidth_window))
+        self.on_bandwidth_schedule_changed()
+
+    def on_remove_bandwidth_window_clicked(self, row, bandwidth_window):
+        self.bandwidth.windows.remove(bandwidth_window)
+        self.bandwidth_windows_box.remove(row)
+        self.on_bandwidth_schedule_changed()
+
+    def on_bandwidth_window_changed(self, bandwidth_window, days_dropdown, start_spin, end_spin, download_limit_spin, upload_limit_spin):
+        bandwidth_window['days'] = self.schedule_days[days_dropdown.get_selected()][1]
+        bandwidth_window['start'] = f"{start_spin.get_value_as_int():02}:00"
+        bandwidth_window['end'] = f"{end_spin.get_value_as_int():02}:00"
+        bandwidth_window['download_limit'] = download_limit_spin.get_value_as_int() * 1024
+        bandwidth_window['upload_limit'] = upload_limit_spin.get_value_as_int() * 1024
+        self.on_bandwidth_schedule_changed()
+
+    def on_bandwidth_schedule_changed(self):
+        try:
+            self.bandwidth.save()
+        except OSError:
+            pass
+        self.apply_bandwidth()
+
+    # The one timer behind the bandwidth schedule: it works out the limits
+    # for the current time and sends whatever changed in a single multicall.
+    def apply_bandwidth(self):
+        downloads = [(download_thread.gid, download_thread.status.get("status") == "active", download_thread.bypass,
+            download_thread.options.get('max-download-limit'), download_thread.options.get('max-upload-limit'))
+            for download_thread in self.downloads if download_thread.gid and not download_thread.is_complete()]
+        self.bandwidth.apply(self.rpc, parse_limit(self.appconf['download_speed_limit']), downloads, tuned=self.tuned_limits)
+        return (self.terminating == False)
+
+    def on_import_clicked(self, button):
+        file_filter = Gtk.FileFilter()
+        file_filter.set_name(_("URL lists and Metalink files"))
+        for pattern in ("*.txt", "*.metalink", "*.meta4"):
+            file_filter.add_pattern(pattern)
+        filters = Gio.ListStore.new(Gtk.FileFilter)
+        filters.append(file_filter)
+        dialog = Gtk.FileDialog(title=_("Import URLs"), filters=filters)
+        dialog.open(self, None, self.on_import_file_chosen)
+
+    def on_import_file_chosen(self, dialog, result):
+        try:
+            file = dialog.open_finish(result)
+        except GLib.Error:
+            return
+        self.start_import(iter_file(file.get_path()))
+
+    def start_import(self, entries):
+        self.import_status_label.set_text(_("Importing…"))
+        self.import_status_label.show()
+        importer = BulkImporter(self.rpc, entries, set(self.queued_urls), self.new_download_options(),
+            lambda added: GLib.idle_add(self.add_imported_downloads, added),
+            lambda added, skipped: GLib.idle_add(self.on_import_done, added, skipped))
+        importer.start()
+
+    def add_imported_downloads(self, added):
+        items = self.create_actionrows([entry["urls"][0] for entry, gid in added], [entry["name"] for entry, gid in added])
+        for item, (entry, gid) in zip(items, added):
+            download_thread = DownloadThread(self.rpc, entry["urls"][0], item, self.downloaddir, self.store, entry["options"], entry["urls"])
+            download_thread.checksum = best_checksum(entry["hashes"]) or ""
+            self.attach_download(download_thread, {"gid": gid, "status": "waiting", "totalLength": "0", "completedLength": "0"})
+        # The rows start out as "waiting" whatever aria2 has done with them
+        # since; a full poll puts them right.
+        self.status_poller.request_full_poll()
+
+    def on_import_done(self, added, skipped):
+        self.import_status_label.set_text(_("Added {added} downloads, skipped {skipped} invalid or duplicate URLs.").format(added=added, skipped=skipped))
+
+    def on_pause_clicked(self, button, list_item):
         self.all_paused = False
-        download_thread = self.downloads[download_item.index+1]
-        if download_thread.download.is_paused:
+        download_thread = list_item.get_item().download_thread
+        if download_thread.gid and self.scheduler.is_held(download_thread.gid):
+            # Already paused in aria2 by the scheduler; now it's the user's pause.
+            self.scheduler.release(download_thread.gid)
+            download_thread.status["status"] = "paused"
+        elif download_thread.is_paused():
             download_thread.resume()
-            image = Gtk.Image.new()
-            image.set_from_icon_name("media-playback-pause-symbolic")
-            pause_button.set_child(image)
         else:
             download_thread.pause()
-            image = Gtk.Image.new()
-            image.set_from_icon_name("media-playback-start-symbolic")
-            pause_button.set_child(image)
+        download_thread.item.paused = download_thread.is_paused()
         download_thread.save_state()
 
-    def on_stop_clicked(self, button, download_item):
-        index = download_item.index
-        download_thread = self.downloads[index+1]
+    def on_move_clicked(self, button, list_item, queue_menu, to_top):
+        queue_menu.popdown()
+        download_thread = list_item.get_item().download_thread
+        if download_thread.gid:
+            if to_top:
+                download_thread.priority = self.scheduler.move_to_top(download_thread.gid)
+            else:
+                download_thread.priority = self.scheduler.move_to_bottom(download_thread.gid)
+            download_thread.save_state()
+            # Keep the list in queue order too.
+            item = download_thread.item
+            self.download_store.remove(self.rows.remove(item))
+            if to_top:
+                self.rows.prepend(item)
+                self.download_store.insert(0, item)
+            else:
+                self.rows.append([item])
+                self.download_store.append(item)
+
+    def on_queue_limits_changed(self, max_active_downloads_spin, max_downloads_per_host_spin):
+        self.appconf['max_active_downloads'] = max_active_downloads_spin.get_value_as_int()
+        self.appconf['max_downloads_per_host'] = max_downloads_per_host_spin.get_value_as_int()
+        try:
+            self.scheduler.set_limits(self.appconf['max_active_downloads'], self.appconf['max_downloads_per_host'])
+        except:
+            pass
+        self.autotuner.reset(self.configured_limits())
+        self.save_appconf()
+
+    def show_storage_options(self):
+        self.showing_storage_options = True
+        options = storage_options(self.appconf, self.downloaddir)
+        if options['file-allocation'] in self.file_allocations:
+            self.file_allocation_dropdown.set_selected(self.file_allocations.index(options['file-allocation']))
+        self.disk_cache_spin.set_value(parse_limit(options['disk-cache']) // (1024 * 1024))
+        self.enable_mmap_check.set_active(options['enable-mmap'] == "true")
+        self.async_dns_check.set_active(options['async-dns'] == "true")
+        filesystem = filesystem_type(self.downloaddir) or _("unknown")
+        if is_rotational(self.downloaddir):
+            self.storage_label.set_text(_("Downloads folder: {filesystem} on a spinning disk. Disk cache and DNS changes apply the next time Varia starts.").format(filesystem=filesystem))
+        else:
+            self.storage_label.set_text(_("Downloads folder: {filesystem}. Disk cache and DNS changes apply the next time Varia starts.").format(filesystem=filesystem))
+        self.showing_storage_options = False
+
+    # Only what differs from the detected settings is saved, so the rest
+    # follows the downloads folder if it moves to another disk.
+    def on_storage_options_changed(self, *args):
+        if self.showing_storage_options:
+            return
+        options = {
+            'file-allocation': self.file_allocations[self.file_allocation_dropdown.get_selected()],
+            'disk-cache': f"{self.disk_cache_spin.get_value_as_int()}M",
+            'enable-mmap': "true" if self.enable_mmap_check.get_active() else "false",
+            'async-dns': "true" if self.async_dns_check.get_active() else "false",
+        }
+        defaults = storage_defaults(self.downloaddir)
+        self.appconf['storage_options'] = {key: value for key, value in options.items()
+            if (value != defaults[key]) and not ((key == 'disk-cache') and (parse_limit(value) == parse_limit(defaults[key])))}
+        self.save_appconf()
+        self.apply_storage_options()
+
+    def on_storage_reset_clicked(self, button):
+        self.appconf['storage_options'] = {}
+        self.save_appconf()
+        self.show_storage_options()
+        self.apply_storage_options()
+
+    def apply_storage_options(self):
+        options = storage_options(self.appconf, self.downloaddir)
+        try:
+            self.rpc.change_global_option({key: options[key] for key in RUNTIME_STORAGE_KEYS})
+        except:
+            pass
+
+    def on_cache_size_changed(self, spin):
+        self.appconf['cache_size'] = spin.get_value_as_int()
+        self.save_appconf()
+        threading.Thread(target=self.cache.set_max_size, args=(self.appconf['cache_size'] * 1024 * 1024,), daemon=True).start()
+
+    def configured_limits(self):
+        return {
+            "max-concurrent-downloads": self.appconf['max_active_downloads'],
+            "split": int(self.appconf['download_options']['split']),
+        }
+
+    def on_autotune_toggled(self, switch, param):
+        self.appconf['autotune'] = switch.get_active()
+        self.save_appconf()
+        self.autotuner.set_enabled(self.appconf['autotune'])
+        if not self.appconf['autotune']:
+            # Put back what the user configured.
+            self.scheduler.max_active = self.appconf['max_active_downloads']
+            try:
+                self.scheduler.apply_limits()
+                self.rpc.change_global_option({"split": self.appconf['download_options']['split']})
+            except:
+                pass
+        self.autotuner.reset(self.configured_limits())
+
+    def apply_tuned_limits(self, limits):
+        self.tuned_limits = limits
+        self.apply_bandwidth()
+        return False
+
+    # Called from the status poller's thread.
+    def on_autotune_changed(self, setting, value):
+        if (setting == "max-concurrent-downloads"):
+            self.scheduler.max_active = value
+
+    def on_stop_clicked(self, button, list_item):
+        item = list_item.get_item()
+        # The row knows where it is, so nothing has to be searched for.
+        position = list_item.get_position()
+        download_thread = item.download_thread
         try:
             download_thread.stop(True)
         except:
             pass
-        self.download_list.remove(download_item)
-        if (download_item in self.downloads):
-            self.downloads.remove(download_item)
+        self.rows.remove(item)
+        self.download_store.remove(position)
+        self.unindex_download(download_thread)
+        self.dirty_items.discard(item)
+        self.downloads.discard(download_thread)
 
     def pause_all(self, header_pause_label, header_pause_image):
-        i = 0
-        pause_button_images = []
         if (self.all_paused == False):
+            try:
+                self.rpc.pause_all()
+            except:
+                pass
+            self.scheduler.release()
             for download_thread in self.downloads:
-                download_thread.pause()
-                download_thread.save_state()
-
-                pause_button_images.append(Gtk.Image.new())
-                pause_button_images[i].set_from_icon_name("media-playback-start-symbolic")
-                self.pause_buttons[i].set_child(pause_button_images[i])
-
-                i += 1
+                if download_thread.gid and not download_thread.is_complete():
+                    download_thread.status["status"] = "paused"
+                    download_thread.save_state()
+                    download_thread.item.paused = True
             if (header_pause_label != "no"):
                 header_pause_image.set_from_icon_name("media-playback-start-symbolic")
                 header_pause_label.set_text(_("Resume All"))
             self.all_paused = True
         else:
+            try:
+                self.rpc.unpause_all()
+            except:
+                pass
             for download_thread in self.downloads:
-                download_thread.resume()
-
-                pause_button_images.append(Gtk.Image.new())
-                pause_button_images[i].set_from_icon_name("media-playback-pause-symbolic")
-                self.pause_buttons[i].set_child(pause_button_images[i])
-
-                i += 1
+                if download_thread.is_paused():
+                    download_thread.status["status"] = "waiting"
+                    download_thread.item.paused = False
             if (header_pause_label != "no"):
                 header_pause_image.set_from_icon_name("media-playback-pause-symbolic")
                 header_pause_label.set_text(_("Pause All"))
             self.all_paused = False
 
     def stop_all(self):
-        while (self.downloads != []):
-            child = self.download_list.get_first_child()
-            while child is not None:
-                next_child = child.get_next_sibling()
-                self.download_list.remove(child)
-                child = next_child
-            for download_thread in self.downloads:
-                download_thread.stop(True)
-                self.downloads.remove(download_thread)
+        self.download_store.remove_all()
+        self.rows.clear()
+        downloads = [download_thread for download_thread in self.downloads if download_thread.gid]
+        local = [download_thread for download_thread in downloads if self.rpc.is_local(download_thread.gid)]
+        files = {}
+        try:
+            for download_thread, result in zip(local, self.rpc.multicall([("aria2.getFiles", [download_thread.gid]) for download_thread in local])):
+                if not isinstance(result, Exception) and not download_thread.is_complete():
+                    files[download_thread] = [file["path"] for file in result if file["path"]]
+            self.rpc.remove([download_thread.gid for download_thread in downloads])
+        except:
+            pass
+        for download_thread in downloads:
+            download_thread.delete_files(files.get(download_thread, []))
+        for download_thread in self.downloads:
+            self.unindex_download(download_thread)
+        self.downloads.clear()
+        self.dirty_items.clear()
 
     def on_speed_limit_changed(self, speed, speed_type):
         speed = speed.get_text()
@@ -516,22 +1714,88 @@ class MainWindow(Gtk.Window):
             case 2:
                 download_limit = speed + "G"
 
-        json_request = {
-            "jsonrpc": "2.0",
-            "id": "1",
-            "method": "aria2.changeGlobalOption",
-            "params": [
-                {"max-overall-download-limit": download_limit}
-            ]
-        }
-
-        response = requests.post('http://localhost:6801/jsonrpc', headers={'Content-Type': 'application/json'}, data=json.dumps(json_request))
-        self.appconf = {'download_speed_limit': download_limit}
+        self.appconf['download_speed_limit'] = download_limit
         self.save_appconf()
+        self.apply_bandwidth()
+
+    # Called by the metrics server's thread when /metrics is requested.
+    def collect_metrics(self):
+        with self.pending_lock:
+            downloads = list(self.downloads_by_gid.values())
+        global_stat = self.last_global_stat
+        return download_metrics((download_thread.gid, download_thread.status) for download_thread in downloads) + [
+            ("varia_total_download_speed_bytes", "Overall download speed reported by aria2.", "gauge", [("", int(global_stat.get("downloadSpeed", 0)))]),
+            ("varia_total_upload_speed_bytes", "Overall upload speed reported by aria2.", "gauge", [("", int(global_stat.get("uploadSpeed", 0)))]),
+        ]
+
+    def set_metrics_port(self, port):
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if port:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, port)
+                self.metrics_server.start()
+            except OSError:
+                self.metrics_server = None
+        return self.metrics_server is not None
+
+    def show_diagnostics(self, button):
+        diagnostics_window = Gtk.Window(title=_("Diagnostics"), transient_for=self)
+        diagnostics_window.set_default_size(640, 480)
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        box.set_margin_start(10)
+        box.set_margin_end(10)
+        box.set_margin_top(10)
+        box.set_margin_bottom(10)
+
+        port_box = Gtk.Box(spacing=6)
+        port_spin = Gtk.SpinButton.new_with_range(0, 65535, 1)
+        port_spin.set_value(self.appconf['metrics_port'])
+        port_spin.set_tooltip_text(_("Serve metrics for Prometheus at http://127.0.0.1:<port>/metrics; 0 to turn off"))
+        port_status_label = Gtk.Label()
+        port_status_label.get_style_context().add_class("dim-label")
+        port_box.append(Gtk.Label(label=_("Metrics Port")))
+        port_box.append(port_spin)
+        port_box.append(port_status_label)
+
+        def show_port_status():
+            if self.metrics_server:
+                port_status_label.set_text(f"http://127.0.0.1:{self.appconf['metrics_port']}/metrics")
+            elif self.appconf['metrics_port']:
+                port_status_label.set_text(_("This port is not available."))
+            else:
+                port_status_label.set_text("")
+
+        def on_port_changed(spin):
+            self.appconf['metrics_port'] = spin.get_value_as_int()
+            self.save_appconf()
+            self.set_metrics_port(self.appconf['metrics_port'])
+            show_port_status()
+
+        port_spin.connect("value-changed", on_port_changed)
+        show_port_status()
+
+        summary_label = Gtk.Label(xalign=0, yalign=0, selectable=True)
+        summary_label.get_style_context().add_class("monospace")
+        scrolled_window = Gtk.ScrolledWindow(vexpand=True)
+        scrolled_window.set_child(summary_label)
+        box.append(port_box)
+        box.append(scrolled_window)
+        diagnostics_window.set_child(box)
+
+        def refresh():
+            if not diagnostics_window.get_visible():
+                return False
+            summary_label.set_text(self.metrics.summary())
+            return True
+
+        refresh()
+        GLib.timeout_add_seconds(1, refresh)
+        diagnostics_window.present()
 
     def save_appconf(self):
-        with open(os.path.join(self.appdir, 'varia.conf'), 'w') as f:
-            json.dump(self.appconf, f)
+        save_appconf(self.appconf, self.appdir)
 
     def open_downloads_folder(self, app):
         subprocess.Popen(["xdg-open", self.downloaddir])
@@ -553,25 +1817,42 @@ class MainWindow(Gtk.Window):
 
     def exitProgram(self, app):
         self.terminating = True
-        self.all_paused = False
-        self.pause_all("no","no")
-        self.api.client.shutdown()
+        self.status_poller.stop()
+        for notification_listener in self.notification_listeners:
+            notification_listener.stop()
+        self.set_metrics_port(0)
+        self.verifier.shutdown()
+        self.cache.close()
+        self.history.close()
+        self.store.close()
+        stop_daemons(self.rpc, self.daemons)
         self.destroy()
 
 class MyApp(Adw.Application):
-    def __init__(self, **kwargs):
+    def __init__(self, started=None, daemons=None, **kwargs):
         super().__init__(**kwargs)
+        self.started = started
+        self.daemons = daemons
         self.connect('activate', self.on_activate)
 
     def on_activate(self, app):
-        self.win = MainWindow(application=app)
+        self.win = MainWindow(application=app, daemons=self.daemons)
+        if self.started is not None:
+            self.win.connect('map', self.on_first_map)
         self.win.present()
 
-def main(version):
-   
-    app = MyApp(application_id="io.github.giantpinkrobots.varia")
+    def on_first_map(self, window):
+        window.disconnect_by_func(self.on_first_map)
+        print(_("Started in {milliseconds} ms").format(milliseconds=round((time.perf_counter() - self.started) * 1000)), file=sys.stderr)
+
+# started is time.perf_counter() from the start of the launcher when
+# --startup-time was given; daemons is what start_daemons returned.
+def main(version, started=None, daemons=None):
+    # GApplication would reject the option as unknown.
+    argv = [argument for argument in sys.argv if argument != '--startup-time']
+    app = MyApp(started, daemons, application_id="io.github.giantpinkrobots.varia")
     try:
-        app.run(sys.argv)
+        app.run(argv)
     finally:
         app.win.exitProgram(app)
 
@@ -0,0 +1,186 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds; the last bucket catches everything above.
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, seconds):
+        index = 0
+        while (index < len(LATENCY_BUCKETS)) and (seconds > LATENCY_BUCKETS[index]):
+            index += 1
+        self.counts[index] += 1
+        self.sum += seconds
+        self.count += 1
+
+    # The upper bound of the bucket the quantile falls in, which is as
+    # precise as a fixed-bucket histogram gets.
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + [float("inf")], self.counts):
+            cumulative += count
+            if (cumulative >= q * self.count):
+                return bound
+        return float("inf")
+
+def labels(**values):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in values.items()) + "}"
+
+# The collector families the window and the headless daemon have in common.
+# statuses are (gid, status) pairs, status being what aria2 last reported.
+def download_metrics(statuses):
+    counts = {}
+    speeds = []
+    for gid, status in statuses:
+        name = status.get("status", "waiting")
+        counts[name] = counts.get(name, 0) + 1
+        if (name == "active"):
+            speeds.append((labels(gid=gid), int(status.get("downloadSpeed", 0))))
+    return [
+        ("varia_downloads", "Downloads Varia knows about, by status.", "gauge", [(labels(status=name), count) for name, count in sorted(counts.items())]),
+        ("varia_download_speed_bytes", "Download speed of each active download in bytes per second.", "gauge", speeds),
+    ]
+
+# Counters and histograms are plain integers and lists behind one lock, so
+# recording is a few additions per RPC or tick and can stay on all the time.
+# Values that are cheaper to read when asked for (thread counts, speeds)
+# come from collectors, called only when the metrics are rendered.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.request_errors = {}
+        self.latencies = {}
+        self.calls = {}
+        self.call_errors = {}
+        self.ticks = {}
+        self.collectors = []
+        self.started = time.time()
+
+    # One HTTP request to aria2; multicalls are recorded once here and once
+    # per method they carry in observe_call.
+    def observe_request(self, method, seconds, error=False):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            if error:
+                self.request_errors[method] = self.request_errors.get(method, 0) + 1
+            if method not in self.latencies:
+                self.latencies[method] = Histogram()
+            self.latencies[method].observe(seconds)
+
+    def observe_call(self, method, error=False):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if error:
+                self.call_errors[method] = self.call_errors.get(method, 0) + 1
+
+    def observe_tick(self, loop, seconds):
+        with self.lock:
+            if loop not in self.ticks:
+                self.ticks[loop] = Histogram()
+            self.ticks[loop].observe(seconds)
+
+    # collector() returns (name, help, type, [(labels, value), ...]) tuples.
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        families = [("varia_threads", "Python threads alive.", "gauge", [("", threading.active_count())]),
+            ("varia_uptime_seconds", "Seconds since Varia started.", "gauge", [("", round(time.time() - self.started, 3))])]
+        for collector in self.collectors:
+            try:
+                families.extend(collector())
+            except:
+                pass
+        return families
+
+    def render(self):
+        lines = []
+        def family(name, help_text, kind, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_labels, value in samples:
+                lines.append(f"{name}{sample_labels} {value}")
+
+        def histograms(name, help_text, label, histograms):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{labels(**{label: key, 'le': bound})} {cumulative}")
+                lines.append(f"{name}_sum{labels(**{label: key})} {round(histogram.sum, 6)}")
+                lines.append(f"{name}_count{labels(**{label: key})} {histogram.count}")
+
+        with self.lock:
+            family("varia_rpc_requests_total", "HTTP requests sent to aria2.", "counter",
+                [(labels(method=method), count) for method, count in sorted(self.requests.items())])
+            family("varia_rpc_request_errors_total", "HTTP requests to aria2 that failed or returned an error.", "counter",
+                [(labels(method=method), count) for method, count in sorted(self.request_errors.items())])
+            histograms("varia_rpc_request_seconds", "Round trip time of requests to aria2.", "method", self.latencies)
+            family("varia_rpc_calls_total", "aria2 methods called, counting each one inside a multicall.", "counter",
+                [(labels(method=method), count) for method, count in sorted(self.calls.items())])
+            family("varia_rpc_call_errors_total", "aria2 methods that returned an error.", "counter",
+                [(labels(method=method), count) for method, count in sorted(self.call_errors.items())])
+            histograms("varia_tick_seconds", "Time spent in each pass of Varia's periodic loops.", "loop", self.ticks)
+        for name, help_text, kind, samples in self.collect():
+            family(name, help_text, kind, samples)
+        return "\n".join(lines) + "\n"
+
+    # A plain text overview for the diagnostics panel.
+    def summary(self):
+        lines = []
+        with self.lock:
+            lines.append(f"{'aria2 method':<32}{'requests':>10}{'errors':>8}{'avg ms':>9}{'p95 ms':>9}")
+            for method, histogram in sorted(self.latencies.items()):
+                lines.append(f"{method:<32}{self.requests.get(method, 0):>10}{self.request_errors.get(method, 0):>8}"
+                    f"{histogram.sum / histogram.count * 1000:>9.1f}{histogram.quantile(0.95) * 1000:>9.0f}")
+            lines.append("")
+            lines.append(f"{'loop':<32}{'passes':>10}{'':>8}{'avg ms':>9}{'p95 ms':>9}")
+            for loop, histogram in sorted(self.ticks.items()):
+                lines.append(f"{loop:<32}{histogram.count:>10}{'':>8}{histogram.sum / histogram.count * 1000:>9.1f}{histogram.quantile(0.95) * 1000:>9.0f}")
+        lines.append("")
+        for name, help_text, kind, samples in self.collect():
+            if (len(samples) == 1):
+                lines.append(f"{name:<32}{samples[0][1]:>10}")
+            elif samples:
+                lines.append(f"{name:<32}{len(samples):>10} series")
+        return "\n".join(lines)
+
+# Serves /metrics in the Prometheus text format, on localhost only.
+class MetricsServer(threading.Thread):
+    def __init__(self, metrics, port):
+        threading.Thread.__init__(self, daemon=True)
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if (self.path.split("?")[0] != "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
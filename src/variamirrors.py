@@ -0,0 +1,94 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# aria2 spreads a download's connections over the URIs it is given, so only
+# the best few are handed over and the rest are kept back as replacements.
+MAX_ACTIVE_MIRRORS = 5
+PROBE_BYTES = 256 * 1024
+PROBE_TIMEOUT = 5
+
+def probe_mirror(url):
+    # Times a small ranged GET, which covers both connection latency and
+    # throughput; None means the mirror couldn't be probed (not HTTP), 0 that
+    # it failed.
+    if not url.lower().startswith(("http://", "https://")):
+        return None
+    start = time.monotonic()
+    received = 0
+    try:
+        with requests.get(url, headers={"Range": f"bytes=0-{PROBE_BYTES - 1}"}, stream=True, timeout=PROBE_TIMEOUT) as response:
+            if (response.status_code >= 400):
+                return 0
+            for chunk in response.iter_content(64 * 1024):
+                received += len(chunk)
+                if (received >= PROBE_BYTES) or (time.monotonic() - start > PROBE_TIMEOUT):
+                    break
+    except requests.RequestException:
+        return 0
+    return received / max(time.monotonic() - start, 0.001)
+
+def rank_mirrors(urls):
+    with ThreadPoolExecutor(max_workers=min(len(urls), 8)) as executor:
+        speeds = list(executor.map(probe_mirror, urls))
+    # Fastest measured first, then the ones that couldn't be measured, then
+    # the ones that failed.
+    ranked = sorted(zip(urls, speeds), key=lambda mirror: (0, -mirror[1]) if mirror[1] else (1 if mirror[1] is None else 2, 0))
+    return [url for url, speed in ranked]
+
+class MirrorWatchdog:
+    def __init__(self, rpc, interval=10, stall_checks=3):
+        self.rpc = rpc
+        self.interval = interval
+        self.stall_checks = stall_checks
+        self.downloads = {}
+        self.lock = threading.Lock()
+        self.last_check = 0
+
+    def track(self, gid, mirrors):
+        if (len(mirrors) > 1):
+            with self.lock:
+                self.downloads[gid] = {"reserve": list(mirrors[MAX_ACTIVE_MIRRORS:]), "stalls": {}}
+
+    def discard(self, gid):
+        with self.lock:
+            self.downloads.pop(gid, None)
+
+    # Run from the status poller's thread. A mirror that has been connected
+    # without sending anything for stall_checks checks in a row is removed
+    # from the download and replaced by the next reserve mirror, if any.
+    def check(self):
+        if (time.monotonic() - self.last_check < self.interval):
+            return
+        self.last_check = time.monotonic()
+        with self.lock:
+            gids = list(self.downloads)
+        if not gids:
+            return
+        calls = []
+        for gid, result in zip(gids, self.rpc.multicall([("aria2.getServers", [gid]) for gid in gids])):
+            # Downloads that aren't active have no servers to look at.
+            if isinstance(result, Exception):
+                continue
+            with self.lock:
+                download = self.downloads.get(gid)
+                if not download:
+                    continue
+                speeds = {}
+                for file in result:
+                    for server in file["servers"]:
+                        speeds[server["uri"]] = speeds.get(server["uri"], 0) + int(server["downloadSpeed"])
+                stalls = {uri: download["stalls"].get(uri, 0) + 1 for uri, speed in speeds.items() if speed == 0}
+                download["stalls"] = stalls
+                stalled = [uri for uri, count in stalls.items() if count >= self.stall_checks]
+                # Never drop the last mirror that is still connected.
+                if stalled and (len(stalled) < len(speeds) or download["reserve"]):
+                    replacements = download["reserve"][:len(stalled)]
+                    download["reserve"] = download["reserve"][len(stalled):]
+                    for uri in stalled:
+                        stalls.pop(uri)
+                    calls.append(("aria2.changeUri", [gid, 1, stalled, replacements]))
+        if calls:
+            self.rpc.multicall(calls)
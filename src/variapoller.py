@@ -0,0 +1,73 @@
+import threading
+import time
+
+# Only the fields the rows actually show are requested, so a tick costs the
+# same single round trip no matter how many downloads are queued. State
+# transitions arrive as WebSocket notifications, so regular ticks only ask
+# for the byte counters of active downloads; the full listing is fetched on
+# (re)connection to catch up on anything that was missed.
+PROGRESS_KEYS = ["gid", "totalLength", "completedLength", "downloadSpeed"]
+STATUS_KEYS = PROGRESS_KEYS + ["status", "errorCode", "errorMessage"]
+RESTORE_KEYS = ["gid", "status", "totalLength", "completedLength", "files"]
+MAX_LISTED = 100000
+
+class StatusPoller(threading.Thread):
+    def __init__(self, rpc, callback, interval=1, metrics=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.rpc = rpc
+        self.metrics = metrics
+        self.callback = callback
+        self.interval = interval
+        self.full_poll = threading.Event()
+        self.full_poll.set()
+        self.stop_event = threading.Event()
+        # Extra periodic work (queue scheduling and the like) runs on this
+        # thread after every tick rather than on threads of its own.
+        self.tasks = []
+
+    def request_full_poll(self):
+        self.full_poll.set()
+
+    def poll(self, full=False):
+        if full:
+            calls = [
+                ("aria2.getGlobalStat", []),
+                ("aria2.tellActive", [STATUS_KEYS]),
+                ("aria2.tellWaiting", [0, MAX_LISTED, STATUS_KEYS]),
+                ("aria2.tellStopped", [0, MAX_LISTED, STATUS_KEYS]),
+            ]
+        else:
+            calls = [("aria2.getGlobalStat", []), ("aria2.tellActive", [PROGRESS_KEYS])]
+        results = self.rpc.multicall(calls)
+        global_stat = results[0] if not isinstance(results[0], Exception) else {}
+        statuses = {}
+        for result in results[1:]:
+            if not isinstance(result, Exception):
+                for struct in result:
+                    statuses[struct["gid"]] = struct
+        return statuses, global_stat
+
+    def run(self):
+        while not self.stop_event.is_set():
+            full = self.full_poll.is_set()
+            self.full_poll.clear()
+            started = time.perf_counter()
+            try:
+                self.callback(*self.poll(full))
+            except:
+                if full:
+                    self.full_poll.set()
+            if self.metrics:
+                self.metrics.observe_tick("StatusPoller.full_poll" if full else "StatusPoller.poll", time.perf_counter() - started)
+            for task in self.tasks:
+                started = time.perf_counter()
+                try:
+                    task()
+                except:
+                    pass
+                if self.metrics:
+                    self.metrics.observe_tick(task.__qualname__, time.perf_counter() - started)
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
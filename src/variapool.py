@@ -0,0 +1,239 @@
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from variabandwidth import parse_limit
+from variadaemon import local_ports
+from variaevents import NotificationListener
+from variarpc import Aria2RPC
+
+# Methods whose first parameter is the gid they act on.
+GID_METHODS = {"aria2.remove", "aria2.forceRemove", "aria2.pause", "aria2.forcePause", "aria2.unpause",
+    "aria2.tellStatus", "aria2.getUris", "aria2.getFiles", "aria2.getPeers", "aria2.getServers",
+    "aria2.changePosition", "aria2.changeUri", "aria2.getOption", "aria2.changeOption", "aria2.removeDownloadResult"}
+ADD_METHODS = {"aria2.addUri", "aria2.addTorrent", "aria2.addMetalink"}
+LIST_METHODS = {"aria2.tellActive", "aria2.tellWaiting", "aria2.tellStopped"}
+# Methods that return the gid they were given.
+GID_RESULT_METHODS = ADD_METHODS | {"aria2.remove", "aria2.forceRemove", "aria2.pause", "aria2.forcePause", "aria2.unpause"}
+STRUCT_METHODS = LIST_METHODS | {"aria2.tellStatus"}
+# Global limits that are shared out between the daemons instead of each
+# one getting the whole of it.
+SHARED_LIMITS = ("max-overall-download-limit", "max-overall-upload-limit")
+
+# Every daemon in varia.conf: the local ones (local_daemons of them, on
+# consecutive ports from 6801) and remote_daemons, each a dict with host,
+# port and an optional secret. One daemon is used directly.
+def connect(appconf, metrics=None):
+    backends = [Aria2RPC(host="http://localhost", port=port, metrics=metrics) for port in local_ports(appconf)]
+    local_count = len(backends)
+    for remote in appconf['remote_daemons']:
+        backends.append(Aria2RPC(host=remote.get("host", "http://localhost"), port=remote["port"], secret=remote.get("secret", ""), metrics=metrics))
+    if (len(backends) == 1):
+        return backends[0]
+    return Aria2Pool(backends, local_count)
+
+# One WebSocket listener per daemon, reporting gids the way the pool does.
+def notification_listeners(rpc, callback, on_connect=None):
+    if not isinstance(rpc, Aria2Pool):
+        return [NotificationListener(rpc, callback, on_connect)]
+    return [NotificationListener(backend, lambda gid, status, index=index: callback(rpc.encode(index, gid), status), on_connect)
+        for index, backend in enumerate(rpc.backends)]
+
+# aria2c writes its session file on shutdown, which is what lets the next
+# launch pick up where this one left off. The window, the headless mode and
+# the command line share the daemons, so only the ones this process started
+# (started being what start_daemons returned) are shut down; the others
+# belong to whoever started them and only save their session.
+def stop_daemons(rpc, started):
+    backends = rpc.backends if isinstance(rpc, Aria2Pool) else [rpc]
+    for index, backend in enumerate(backends):
+        try:
+            if (index < len(started or [])) and started[index]:
+                backend.shutdown()
+            else:
+                backend.save_session()
+        except:
+            pass
+
+# Several aria2 daemons behind the interface of a single Aria2RPC, so the
+# poller, scheduler and everything else see one merged set of downloads.
+# Each multicall becomes at most one multicall per daemon, sent in
+# parallel. Gids of the first daemon are left as they are, so downloads
+# saved before more daemons were added still match; the others get their
+# daemon's index in front ("2:<gid>") since gids are only unique per daemon.
+class Aria2Pool(Aria2RPC):
+    def __init__(self, backends, local_count=1):
+        self.backends = backends
+        self.local_count = local_count
+        first = backends[0]
+        self.host, self.port, self.secret, self.metrics = first.host, first.port, first.secret, first.metrics
+        self.executor = ThreadPoolExecutor(max_workers=len(backends))
+        self.lock = threading.Lock()
+        # numActive + numWaiting from each daemon's last global stat, plus
+        # what has been added to it since.
+        self.loads = [0] * len(backends)
+        # The merged waiting queue as the caller last saw it, so positions
+        # in it can be translated to positions in each daemon's own queue,
+        # with the daemon each one is on alongside.
+        self.waiting_order = []
+        self.waiting_backends = []
+
+    def encode(self, index, gid):
+        return gid if (index == 0) else f"{index}:{gid}"
+
+    def decode(self, gid):
+        index, separator, raw = str(gid).partition(":")
+        if separator and index.isdigit() and (int(index) < len(self.backends)):
+            return int(index), raw
+        return 0, gid
+
+    def encode_struct(self, index, struct):
+        if (index == 0):
+            return struct
+        struct = dict(struct)
+        for key in ("gid", "following", "belongsTo"):
+            if key in struct:
+                struct[key] = self.encode(index, struct[key])
+        if "followedBy" in struct:
+            struct["followedBy"] = [self.encode(index, gid) for gid in struct["followedBy"]]
+        return struct
+
+    # Paths from a remote daemon are on its machine; touching the same path
+    # here would hash or delete some unrelated file.
+    def is_local(self, gid):
+        return self.decode(gid)[0] < self.local_count
+
+    def least_loaded(self):
+        with self.lock:
+            index = min(range(len(self.backends)), key=lambda index: self.loads[index])
+            self.loads[index] += 1
+        return index
+
+    def call(self, method, params=None):
+        result = self.multicall([(method, params or [])])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # A POS_SET position in the merged queue becomes the position among the
+    # same daemon's downloads that come before it.
+    def local_position(self, index, gid, position):
+        with self.lock:
+            try:
+                current = self.waiting_order.index(gid)
+                del self.waiting_order[current]
+                del self.waiting_backends[current]
+            except ValueError:
+                pass
+            self.waiting_order.insert(position, gid)
+            self.waiting_backends.insert(position, index)
+            return self.waiting_backends[:position].count(index)
+
+    def split_options(self, index, options):
+        options = dict(options)
+        count = len(self.backends)
+        if "max-concurrent-downloads" in options:
+            total = int(options["max-concurrent-downloads"])
+            options["max-concurrent-downloads"] = str(max(1, total // count + (1 if index < total % count else 0)))
+        for key in SHARED_LIMITS:
+            if (key in options) and parse_limit(options[key]):
+                options[key] = str(math.ceil(parse_limit(options[key]) / count))
+        return options
+
+    # Returns [(backend index, method, params, slot)] for one call; slot
+    # says where its result goes.
+    def route(self, position, method, params):
+        params = list(params)
+        if method in GID_METHODS and params:
+            index, params[0] = self.decode(params[0])
+            if (method == "aria2.changePosition") and (len(params) > 2) and (params[2] == "POS_SET"):
+                params[1] = self.local_position(index, self.encode(index, params[0]), params[1])
+            return [(index, method, params, position)]
+        if method in ADD_METHODS:
+            return [(self.least_loaded(), method, params, position)]
+        if method in ("aria2.shutdown", "aria2.forceShutdown"):
+            # Remote daemons are someone else's to stop; they only save.
+            return [(index, method if (index < self.local_count) else "aria2.saveSession", params, position) for index in range(len(self.backends))]
+        if (method == "aria2.changeGlobalOption") and params:
+            return [(index, method, [self.split_options(index, params[0])] + params[1:], position) for index in range(len(self.backends))]
+        return [(index, method, params, position) for index in range(len(self.backends))]
+
+    def merge(self, method, params, results):
+        values = [(index, result) for index, result in results if not isinstance(result, Exception)]
+        if not values:
+            return results[0][1]
+        if method in LIST_METHODS:
+            merged = [self.encode_struct(index, struct) for index, result in values for struct in result]
+            if (method == "aria2.tellWaiting"):
+                merged = self.order_waiting(merged, params)
+            return merged
+        if (method == "aria2.getGlobalStat"):
+            stat = {}
+            for index, result in values:
+                with self.lock:
+                    self.loads[index] = int(result.get("numActive", 0)) + int(result.get("numWaiting", 0))
+                for key, value in result.items():
+                    stat[key] = str(int(stat.get(key, 0)) + int(value))
+            return stat
+        if method in GID_RESULT_METHODS:
+            index, result = values[0]
+            return [self.encode(index, gid) for gid in result] if isinstance(result, list) else self.encode(index, result)
+        if method in STRUCT_METHODS:
+            index, result = values[0]
+            return self.encode_struct(index, result)
+        return values[0][1]
+
+    # Downloads keep the order the caller last arranged them in, so a
+    # scheduler that reorders the queue sees its own order come back.
+    def order_waiting(self, merged, params):
+        if not all("gid" in struct for struct in merged):
+            return merged
+        with self.lock:
+            ranks = {gid: rank for rank, gid in enumerate(self.waiting_order)}
+            merged.sort(key=lambda struct: ranks.get(struct["gid"], len(ranks)))
+            if params and (params[0] == 0):
+                self.waiting_order = [struct["gid"] for struct in merged]
+                self.waiting_backends = [self.decode(gid)[0] for gid in self.waiting_order]
+        return merged
+
+    # Returns the daemon's results, or the error that kept the whole
+    # request from getting through.
+    def send(self, index, calls):
+        try:
+            return self.backends[index].multicall(calls), None
+        except Exception as error:
+            return [error] * len(calls), error
+
+    def multicall(self, calls):
+        batches = {}
+        for position, (method, params) in enumerate(calls):
+            for index, backend_method, backend_params, slot in self.route(position, method, params):
+                batches.setdefault(index, []).append((backend_method, backend_params, slot))
+        futures = {index: self.executor.submit(self.send, index, [(method, params) for method, params, slot in batch])
+            for index, batch in batches.items()}
+        answers = [[] for call in calls]
+        errors = []
+        for index, batch in batches.items():
+            results, error = futures[index].result()
+            if error:
+                errors.append(error)
+            for (method, params, slot), result in zip(batch, results):
+                answers[slot].append((index, result))
+        # Only when no daemon answered at all does this fail like a single
+        # daemon that is down would.
+        if errors and (len(errors) == len(batches)):
+            raise errors[0]
+        return [self.merge(method, params, answers[position]) for position, (method, params) in enumerate(calls)]
+
+    def wait_until_ready(self, timeout=10):
+        # Daemons that are slow to start are caught up with by later polls.
+        futures = [self.executor.submit(backend.wait_until_ready, timeout) for backend in self.backends]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as error:
+                errors.append(error)
+        if (len(errors) == len(self.backends)):
+            raise errors[0]
+        return self.get_global_stat()
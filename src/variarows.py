@@ -0,0 +1,41 @@
+import bisect
+
+# Positions of the rows in the download list, without scanning the list.
+# Every row gets a key that sorts in list order: rows added at the end count
+# up and rows moved to the top count down, so the keys of the rows still in
+# the list stay sorted and a row's position is a binary search away.
+class RowIndex:
+    def __init__(self):
+        self.keys = []
+        self.top = 0
+        self.bottom = 0
+
+    def append(self, items):
+        for item in items:
+            self.bottom += 1
+            item.row_key = self.bottom
+            self.keys.append(self.bottom)
+
+    def prepend(self, item):
+        self.top -= 1
+        item.row_key = self.top
+        self.keys.insert(0, self.top)
+
+    # None if the row isn't in the list (any more).
+    def position(self, item):
+        if item.row_key is None:
+            return None
+        position = bisect.bisect_left(self.keys, item.row_key)
+        if (position < len(self.keys)) and (self.keys[position] == item.row_key):
+            return position
+        return None
+
+    def remove(self, item):
+        position = self.position(item)
+        if position is not None:
+            del self.keys[position]
+            item.row_key = None
+        return position
+
+    def clear(self):
+        self.keys = []
@@ -0,0 +1,133 @@
+import json
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# aria2 refuses requests above --rpc-max-request-size (2 MiB by default), so
+# large bulk operations are split into several multicalls of this size.
+MULTICALL_CHUNK_SIZE = 500
+
+class Aria2RPCError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, f"{code}: {message}")
+        self.code = code
+        self.message = message
+
+class Aria2RPC:
+    def __init__(self, host="http://localhost", port=6801, secret="", timeout=60, metrics=None):
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.timeout = timeout
+        self.server = f"{host}:{port}/jsonrpc"
+        self.metrics = metrics
+        # One keep-alive session shared by every thread instead of a new
+        # connection per request.
+        self.session = requests.Session()
+        self.session.mount(self.server, HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+    def params(self, method, params):
+        params = list(params or [])
+        if self.secret and method.startswith("aria2."):
+            params.insert(0, f"token:{self.secret}")
+        return params
+
+    def post(self, method, params):
+        payload = {"jsonrpc": "2.0", "id": "varia", "method": method, "params": params}
+        started = time.perf_counter()
+        error = True
+        try:
+            response = self.session.post(self.server, data=json.dumps(payload), timeout=self.timeout).json()
+            error = "error" in response
+        finally:
+            if self.metrics:
+                self.metrics.observe_request(method, time.perf_counter() - started, error)
+        if error:
+            raise Aria2RPCError(response["error"]["code"], response["error"]["message"])
+        return response["result"]
+
+    def call(self, method, params=None):
+        try:
+            result = self.post(method, self.params(method, params))
+        except Aria2RPCError:
+            if self.metrics:
+                self.metrics.observe_call(method, True)
+            raise
+        if self.metrics:
+            self.metrics.observe_call(method)
+        return result
+
+    def multicall(self, calls):
+        # Takes (method, params) pairs and returns one entry per call: the
+        # call's result, or an Aria2RPCError if that call alone failed.
+        results = []
+        for start in range(0, len(calls), MULTICALL_CHUNK_SIZE):
+            methods = [{"methodName": method, "params": self.params(method, params)} for method, params in calls[start:start + MULTICALL_CHUNK_SIZE]]
+            for call, result in zip(methods, self.post("system.multicall", [methods])):
+                if isinstance(result, list):
+                    results.append(result[0])
+                else:
+                    results.append(Aria2RPCError(result.get("faultCode"), result.get("faultString")))
+                if self.metrics:
+                    self.metrics.observe_call(call["methodName"], not isinstance(result, list))
+        return results
+
+    def wait_until_ready(self, timeout=10):
+        # aria2c is started alongside Varia and may not be listening yet.
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.get_global_stat()
+            except requests.exceptions.ConnectionError:
+                if (time.monotonic() > deadline):
+                    raise
+                time.sleep(0.1)
+
+    def add_uri(self, uris, options=None):
+        return self.call("aria2.addUri", [uris, options or {}])
+
+    def tell_status(self, gid, keys=None):
+        return self.call("aria2.tellStatus", [gid] + ([keys] if keys else []))
+
+    def get_files(self, gid):
+        return self.call("aria2.getFiles", [gid])
+
+    # Whether the paths getFiles gives are on this machine. A single daemon
+    # is always one Varia started here.
+    def is_local(self, gid):
+        return True
+
+    def pause(self, gid, force=False):
+        return self.call("aria2.forcePause" if force else "aria2.pause", [gid])
+
+    def unpause(self, gid):
+        return self.call("aria2.unpause", [gid])
+
+    def pause_all(self, force=False):
+        return self.call("aria2.forcePauseAll" if force else "aria2.pauseAll")
+
+    def unpause_all(self):
+        return self.call("aria2.unpauseAll")
+
+    def remove(self, gids, force=True):
+        # Stopped downloads can't be removed, only have their result purged,
+        # so both calls are sent for every gid and their failures ignored.
+        method = "aria2.forceRemove" if force else "aria2.remove"
+        self.multicall([(method, [gid]) for gid in gids])
+        return self.multicall([("aria2.removeDownloadResult", [gid]) for gid in gids])
+
+    def change_option(self, gid, options):
+        return self.call("aria2.changeOption", [gid, options])
+
+    def change_global_option(self, options):
+        return self.call("aria2.changeGlobalOption", [options])
+
+    def get_global_stat(self):
+        return self.call("aria2.getGlobalStat")
+
+    def save_session(self):
+        return self.call("aria2.saveSession")
+
+    def shutdown(self, force=False):
+        return self.call("aria2.forceShutdown" if force else "aria2.shutdown")
@@ -0,0 +1,141 @@
+import itertools
+import threading
+from collections import Counter
+from urllib.parse import urlparse
+
+from variapoller import MAX_LISTED
+
+class DownloadScheduler:
+    def __init__(self, rpc, max_active=3, max_per_host=0):
+        self.rpc = rpc
+        self.max_active = max_active
+        self.max_per_host = max_per_host
+        self.entries = {}
+        self.held = set()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+
+    def add(self, gid, url, priority=0):
+        with self.lock:
+            self.entries[gid] = [priority, next(self.sequence), urlparse(url).netloc]
+        self.dirty.set()
+
+    def discard(self, gid):
+        with self.lock:
+            self.entries.pop(gid, None)
+            self.held.discard(gid)
+        self.dirty.set()
+
+    def priority(self, gid):
+        with self.lock:
+            return self.entries[gid][0] if gid in self.entries else 0
+
+    def set_priority(self, gid, priority):
+        with self.lock:
+            if gid in self.entries:
+                self.entries[gid][0] = priority
+        self.dirty.set()
+
+    def move_to_top(self, gid):
+        with self.lock:
+            priority = max(entry[0] for entry in self.entries.values()) + 1
+        self.set_priority(gid, priority)
+        return priority
+
+    def move_to_bottom(self, gid):
+        with self.lock:
+            priority = min(entry[0] for entry in self.entries.values()) - 1
+        self.set_priority(gid, priority)
+        return priority
+
+    def is_held(self, gid):
+        with self.lock:
+            return gid in self.held
+
+    # Downloads the scheduler paused to respect a per-host cap become plain
+    # user pauses once the user pauses them (or everything) themselves.
+    def release(self, gid=None):
+        with self.lock:
+            if gid:
+                self.held.discard(gid)
+            else:
+                self.held.clear()
+
+    def set_limits(self, max_active, max_per_host):
+        self.max_active = max_active
+        self.max_per_host = max_per_host
+        self.apply_limits()
+        self.dirty.set()
+
+    def apply_limits(self):
+        self.rpc.change_global_option({"max-concurrent-downloads": str(self.max_active)})
+
+    def mark_dirty(self):
+        self.dirty.set()
+
+    # Run from the status poller's thread after each tick; it does nothing
+    # until something that affects the queue has changed.
+    def schedule(self):
+        if not self.dirty.is_set():
+            return
+        self.dirty.clear()
+        active, waiting = self.rpc.multicall([
+            ("aria2.tellActive", [["gid"]]),
+            ("aria2.tellWaiting", [0, MAX_LISTED, ["gid", "status"]]),
+        ])
+        if isinstance(active, Exception) or isinstance(waiting, Exception):
+            self.dirty.set()
+            return
+        with self.lock:
+            entries = {gid: list(entry) for gid, entry in self.entries.items()}
+            held = set(self.held)
+        current = [struct["gid"] for struct in waiting]
+        statuses = {struct["gid"]: struct["status"] for struct in waiting}
+        # Higher priority first, then the order downloads were added in;
+        # downloads Varia doesn't know about keep their place at the end.
+        rank = lambda gid: (-entries[gid][0], entries[gid][1]) if gid in entries else (0, float("inf"))
+        desired = sorted(current, key=rank)
+
+        calls = []
+        # What changes in held; merged back in at the end.
+        newly_held = set()
+        released = set()
+        hosts = Counter()
+        # aria2 starts downloads as soon as they are added, so several from
+        # one server can already be running; all but the first ones in the
+        # queue are held back like waiting ones.
+        for gid in sorted((struct["gid"] for struct in active), key=rank):
+            host = entries[gid][2] if gid in entries else None
+            if self.max_per_host and host and (hosts[host] >= self.max_per_host):
+                calls.append(("aria2.pause", [gid]))
+                newly_held.add(gid)
+            else:
+                hosts[host] += 1
+        for gid in desired:
+            if (statuses[gid] == "paused") and (gid not in held):
+                continue
+            host = entries[gid][2] if gid in entries else None
+            if self.max_per_host and host and (hosts[host] >= self.max_per_host):
+                if gid not in held:
+                    calls.append(("aria2.pause", [gid]))
+                    newly_held.add(gid)
+            else:
+                if gid in held:
+                    calls.append(("aria2.unpause", [gid]))
+                    released.add(gid)
+                hosts[host] += 1
+
+        for index, gid in enumerate(desired):
+            if (current[index] != gid):
+                calls.append(("aria2.changePosition", [gid, index, "POS_SET"]))
+                current.remove(gid)
+                current.insert(index, gid)
+
+        # Merged rather than replaced, so a release() or discard() on
+        # another thread since the snapshot above isn't undone.
+        with self.lock:
+            self.held -= released
+            self.held |= {gid for gid in newly_held if gid in self.entries}
+        if calls:
+            self.rpc.multicall(calls)
@@ -0,0 +1,39 @@
+from variapoller import RESTORE_KEYS, MAX_LISTED
+
+# How the window and the headless daemon match saved downloads up with
+# aria2's session on startup.
+
+# aria2c restores its own session (--input-file/--save-session in the
+# launcher) with the same gids. Everything it has, by gid.
+def fetch_session(rpc):
+    results = rpc.multicall([
+        ("aria2.tellActive", [RESTORE_KEYS]),
+        ("aria2.tellWaiting", [0, MAX_LISTED, RESTORE_KEYS]),
+        ("aria2.tellStopped", [0, MAX_LISTED, RESTORE_KEYS]),
+    ])
+    return {struct["gid"]: struct for result in results if not isinstance(result, Exception) for struct in result}
+
+# Pairs every saved download with what aria2 restored of it, taking it out
+# of session. struct is None for downloads aria2 lost or removed, which have
+# to be added again. Complete ones are paired like any other, so they go
+# through the checksum check, the cache and the history as if they had just
+# finished. What is left in session afterwards is unknown to Varia.
+def match_session(states, session):
+    for state in states:
+        struct = session.pop(state['gid'], None)
+        if struct and (struct["status"] == "removed"):
+            struct = None
+        yield state, struct
+
+# Varia leaves paused downloads paused, anything else the daemon restored as
+# paused should carry on.
+def unpause_calls(matched):
+    return [("aria2.unpause", [state['gid']]) for state, struct in matched
+        if struct and (struct["status"] == "paused") and (state['status'] != "paused")]
+
+# Downloads left in session that are still going, with their first URL.
+def unknown_downloads(session):
+    for struct in session.values():
+        if (struct["status"] in ("complete", "removed")) or not struct["files"] or not struct["files"][0]["uris"]:
+            continue
+        yield struct, struct["files"][0]["uris"][0]["uri"]
@@ -0,0 +1,99 @@
+import threading
+import time
+from array import array
+
+# Samples kept per download and for the total, one per poll tick; at the
+# default one second interval that is the last minute and two minutes.
+DOWNLOAD_HISTORY_LENGTH = 60
+TOTAL_HISTORY_LENGTH = 120
+# Seconds after which an old sample counts half as much towards the
+# smoothed speed the ETA is based on.
+HALF_LIFE = 5
+
+# A fixed-size ring of float32 speeds, so a download that runs for days
+# takes the same memory as one that runs for a minute. The array is only
+# allocated once the download is first seen active.
+class SpeedHistory:
+    __slots__ = ("capacity", "lock", "samples", "next", "count", "received", "smoothed", "last_time")
+
+    def __init__(self, capacity, lock):
+        self.capacity = capacity
+        self.lock = lock
+        self.samples = None
+        self.next = 0
+        self.count = 0
+        # Samples ever added, which unlike count keeps growing once full.
+        self.received = 0
+        self.smoothed = 0.0
+        self.last_time = None
+
+    def append(self, speed):
+        if self.samples is None:
+            self.samples = array("f", bytes(4 * self.capacity))
+        self.samples[self.next] = speed
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    # Called with the tracker's lock held. Ticks the download was not
+    # active for are filled with zeros so the graph keeps real time.
+    def add(self, speed, now, interval):
+        if self.last_time is not None:
+            elapsed = now - self.last_time
+            for index in range(min(round(elapsed / interval) - 1, self.capacity)):
+                self.append(0)
+            self.smoothed += (speed - self.smoothed) * (1 - 0.5 ** (elapsed / HALF_LIFE))
+        else:
+            self.smoothed = float(speed)
+        self.last_time = now
+        self.received += 1
+        self.append(speed)
+
+    # Oldest first.
+    def values(self):
+        with self.lock:
+            if not self.count:
+                return []
+            start = (self.next - self.count) % self.capacity
+            return [self.samples[(start + index) % self.capacity] for index in range(self.count)]
+
+    def speed(self):
+        with self.lock:
+            return self.smoothed
+
+    # Seconds left at the smoothed speed, or None while it is too slow to tell.
+    def eta(self, remaining):
+        with self.lock:
+            if (self.smoothed < 1) or (remaining <= 0):
+                return None
+            return remaining / self.smoothed
+
+# Fed from the status poller's thread; the window reads the histories on
+# the main loop, so both sides go through one lock.
+class SpeedTracker:
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.histories = {}
+        self.total = SpeedHistory(TOTAL_HISTORY_LENGTH, self.lock)
+
+    def track(self, gid):
+        with self.lock:
+            if gid not in self.histories:
+                self.histories[gid] = SpeedHistory(DOWNLOAD_HISTORY_LENGTH, self.lock)
+            return self.histories[gid]
+
+    def discard(self, gid):
+        with self.lock:
+            self.histories.pop(gid, None)
+
+    # Regular ticks only list active downloads; full polls list everything,
+    # with a status, and only the active ones are sampled.
+    def record(self, statuses, global_stat, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for gid, status in statuses.items():
+                history = self.histories.get(gid)
+                if history and ("downloadSpeed" in status) and (status.get("status", "active") == "active"):
+                    history.add(int(status["downloadSpeed"]), now, self.interval)
+            if global_stat:
+                self.total.add(int(global_stat.get("downloadSpeed", 0)), now, self.interval)
@@ -0,0 +1,96 @@
+import json
+import sqlite3
+import threading
+import time
+
+STATE_COLUMNS = ["url", "options", "completed_length", "total_length", "status", "priority", "bypass", "checksum", "mirrors"]
+
+# Downloads are journalled in one SQLite database in the app data directory.
+# Updates are buffered in memory and written by flush() in a single
+# transaction, and WAL mode keeps the file consistent if Varia dies mid-write.
+class StateStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.removed = set()
+        with self.write_lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS downloads (
+                gid TEXT PRIMARY KEY,
+                url TEXT,
+                options TEXT,
+                completed_length INTEGER,
+                total_length INTEGER,
+                status TEXT,
+                priority INTEGER,
+                bypass INTEGER,
+                checksum TEXT,
+                mirrors TEXT,
+                added REAL,
+                updated REAL
+            )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS downloads_added ON downloads (added)")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(downloads)")]
+            for column, column_type in (("priority", "INTEGER"), ("bypass", "INTEGER"), ("checksum", "TEXT"), ("mirrors", "TEXT")):
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE downloads ADD COLUMN {column} {column_type}")
+
+    def update(self, gid, **fields):
+        for key in ("options", "mirrors"):
+            if key in fields:
+                fields[key] = json.dumps(fields[key])
+        with self.lock:
+            if gid in self.pending:
+                self.pending[gid].update(fields)
+            else:
+                self.pending[gid] = fields
+            self.removed.discard(gid)
+
+    def remove(self, gid):
+        with self.lock:
+            self.pending.pop(gid, None)
+            self.removed.add(gid)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            removed, self.removed = self.removed, set()
+        if not (pending or removed):
+            return
+        now = time.time()
+        rows = [[gid] + [fields.get(column) for column in STATE_COLUMNS] + [now, now] for gid, fields in pending.items()]
+        columns = ", ".join(STATE_COLUMNS)
+        placeholders = ", ".join("?" for column in STATE_COLUMNS)
+        updates = ",\n".join(f"{column} = COALESCE(excluded.{column}, {column})" for column in STATE_COLUMNS)
+        # Columns left out of an update keep their stored value.
+        with self.write_lock, self.connection:
+            self.connection.executemany(f"""INSERT INTO downloads (gid, {columns}, added, updated)
+                VALUES (?, {placeholders}, ?, ?)
+                ON CONFLICT (gid) DO UPDATE SET {updates}, updated = excluded.updated""", rows)
+            self.connection.executemany("DELETE FROM downloads WHERE gid = ?", [[gid] for gid in removed])
+
+    def load(self):
+        with self.write_lock:
+            rows = self.connection.execute("SELECT gid, url, options, completed_length, total_length, status, priority, bypass, checksum, mirrors FROM downloads ORDER BY added").fetchall()
+        return [{
+            "gid": gid,
+            "url": url,
+            "options": json.loads(options or "{}"),
+            "completed_length": completed_length or 0,
+            "total_length": total_length or 0,
+            "status": status,
+            "priority": priority or 0,
+            "bypass": bool(bypass),
+            # aria2's checksum syntax, such as "sha-256=<hex>", or "".
+            "checksum": checksum or "",
+            # Every URL of the file, fastest first once they have been ranked.
+            "mirrors": json.loads(mirrors) if mirrors else [url],
+        } for gid, url, options, completed_length, total_length, status, priority, bypass, checksum, mirrors in rows]
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            self.connection.close()
@@ -0,0 +1,108 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Checksums are kept in the syntax of aria2's checksum option
+# ("sha-256=<hex>"), with the hashlib name each type maps to.
+HASH_TYPES = {"sha-512": "sha512", "sha-256": "sha256", "sha-1": "sha1", "md5": "md5"}
+# Names Metalink 3 files and people typing them tend to use instead.
+HASH_ALIASES = {"sha512": "sha-512", "sha256": "sha-256", "sha1": "sha-1", "sha": "sha-1"}
+HEX_LENGTHS = {128: "sha-512", 64: "sha-256", 40: "sha-1", 32: "md5"}
+CHUNK_SIZE = 8 * 1024 * 1024
+# Times a download is fetched again after its checksum didn't match
+# before Varia gives up on it.
+MAX_REFETCHES = 2
+# How a check turned out, by on_done's matched, as recorded in the history.
+VERIFY_STATUSES = {True: "verified", False: "mismatch", None: "failed"}
+
+def hash_type(name):
+    name = name.strip().lower()
+    name = HASH_ALIASES.get(name, name)
+    return name if name in HASH_TYPES else None
+
+# Accepts "sha-256=<hex>", "sha256:<hex>" or a bare hex digest, whose type
+# is told by its length. Returns aria2's syntax, or None if it isn't one.
+def parse_checksum(text):
+    text = text.strip()
+    match = re.fullmatch(r"(?:([A-Za-z0-9-]+)\s*[=:]\s*)?([0-9A-Fa-f]+)", text)
+    if not match:
+        return None
+    digest = match.group(2).lower()
+    kind = hash_type(match.group(1)) if match.group(1) else HEX_LENGTHS.get(len(digest))
+    if not kind or (HEX_LENGTHS.get(len(digest)) != kind):
+        return None
+    return f"{kind}={digest}"
+
+# The strongest of the hashes a Metalink file gives for a download.
+def best_checksum(hashes):
+    found = {hash_type(name): digest for name, digest in hashes.items() if hash_type(name)}
+    for kind in HASH_TYPES:
+        if kind in found:
+            return parse_checksum(f"{kind}={found[kind]}")
+    return None
+
+# Runs in a worker process. The file is mapped rather than read so pages
+# come straight from the page cache, and fed to the hash a chunk at a time.
+def hash_file(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, len(mapped), CHUNK_SIZE):
+                    digest.update(view[offset:offset + CHUNK_SIZE])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+# Hashes finished downloads in a pool of processes, one file per core, so
+# several large files are checked at once and none of it holds the GIL the
+# window's main loop needs. The pool is only started when first needed.
+class ChecksumVerifier:
+    def __init__(self, rpc, workers=None):
+        self.rpc = rpc
+        self.workers = workers or min(os.cpu_count() or 1, 4)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                # Forking a process that runs GTK and several threads isn't
+                # safe, so the workers are started fresh.
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    # on_done(gid, path, matched) is called from a worker thread, with
+    # matched None if the file couldn't be hashed at all. path is for files
+    # that never went through aria2, such as copies from the cache.
+    def verify(self, gid, checksum, on_done, path=None):
+        threading.Thread(target=self.run, args=(gid, checksum, on_done, path), daemon=True).start()
+
+    def run(self, gid, checksum, on_done, path=None):
+        # A remote daemon's file can't be read from here.
+        if not path and not self.rpc.is_local(gid):
+            on_done(gid, path, None)
+            return
+        try:
+            if not path:
+                path = [file["path"] for file in self.rpc.get_files(gid) if file["path"]][0]
+            kind, expected = checksum.split("=", 1)
+            matched = self.pool().submit(hash_file, path, HASH_TYPES[kind]).result() == expected
+        except:
+            matched = None
+        on_done(gid, path, matched)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None